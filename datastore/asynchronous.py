@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from structs import Dict, List, RedisDataStructure, Set
+
+POOL_SIZE = 16
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the thread pool running the asynchronous calls, created on first use
+    and again in a forked child, where the parent's threads do not exist.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(POOL_SIZE)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def gather(*results):
+    """
+    Wait for every AsyncResult and return their values in order.
+    """
+    return [result.get() for result in results]
+
+
+def _unwrap(value):
+    return value.sync if isinstance(value, AsyncStructure) else value
+
+
+def _call(structure, name, args, kwargs):
+    result = getattr(structure, name)(*args, **kwargs)
+    if isinstance(result, RedisDataStructure):
+        return ASYNC_CLASSES[type(result)].wrap(result)
+    return result
+
+
+def _asynchronous(name):
+    def method(self, *args, **kwargs):
+        args = tuple(_unwrap(arg) for arg in args)
+        kwargs = dict((k, _unwrap(v)) for k, v in kwargs.iteritems())
+        return get_pool().apply_async(_call, (self.sync, name, args, kwargs))
+    method.__name__ = name
+    return method
+
+
+class AsyncStructure(object):
+    """
+    Wraps a structure so that its methods return an AsyncResult instead of blocking:
+    many calls are in flight at once, each on a thread of a shared pool.
+    Call .get() on the result, or gather() many, for the values.
+
+    len(), in, iteration, item assignment and the comparison operators stay
+    blocking because Python needs their results right away.
+    """
+    structure = RedisDataStructure
+
+    def __init__(self, *args, **kwargs):
+        self.sync = self.structure(*args, **kwargs)
+
+    @classmethod
+    def wrap(cls, structure):
+        instance = cls.__new__(cls)
+        instance.sync = structure
+        return instance
+
+    def __getattr__(self, name):
+        # pk, connection, cache, scan...
+        if name == "sync":
+            raise AttributeError(name)
+        return getattr(self.sync, name)
+
+    def __eq__(self, other):
+        return self.sync == _unwrap(other)
+
+    def __ne__(self, other):
+        return self.sync != _unwrap(other)
+
+    def __len__(self):
+        return len(self.sync)
+
+    def __contains__(self, key):
+        return key in self.sync
+
+    def __iter__(self):
+        return iter(self.sync)
+
+    def __str__(self):
+        return str(self.sync)
+
+
+class AsyncDict(AsyncStructure):
+    structure = Dict
+
+    def __setitem__(self, key, value):
+        self.sync[key] = value
+
+    def __delitem__(self, key):
+        del self.sync[key]
+
+for _name in ["__getitem__", "clear", "to_dict", "get", "items", "keys", "pop", "setdefault",
+              "update", "values", "incrby"]:
+    setattr(AsyncDict, _name, _asynchronous(_name))
+
+
+class AsyncSet(AsyncStructure):
+    structure = Set
+
+    def __le__(self, other):
+        return self.sync <= _unwrap(other)
+
+    def __lt__(self, other):
+        return self.sync < _unwrap(other)
+
+    def __ge__(self, other):
+        return self.sync >= _unwrap(other)
+
+    def __gt__(self, other):
+        return self.sync > _unwrap(other)
+
+for _name in ["update", "add", "remove", "discard", "pop", "random", "intersection_update",
+              "intersection", "difference_update", "difference", "union", "isdisjoint",
+              "issubset", "issuperset", "members", "move"]:
+    setattr(AsyncSet, _name, _asynchronous(_name))
+
+
+class AsyncList(AsyncStructure):
+    structure = List
+
+    def __setitem__(self, index, value):
+        self.sync[index] = value
+
+for _name in ["__getitem__", "append", "extend", "insert", "push", "pop", "rpop", "trim"]:
+    setattr(AsyncList, _name, _asynchronous(_name))
+
+
+ASYNC_CLASSES = {
+    Dict: AsyncDict,
+    Set: AsyncSet,
+    List: AsyncList,
+}
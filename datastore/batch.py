@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+
+import redis
+
+import scripts
+
+_local = threading.local()
+
+
+class Deferred(object):
+    """
+    Placeholder for the result of a call queued in a Batch.
+    The value is available once the batch is executed.
+    """
+    def __init__(self):
+        self.ready = False
+        self._value = None
+        self._error = None
+
+    def _resolve(self, value=None, error=None):
+        self.ready = True
+        self._value = value
+        self._error = error
+
+    @property
+    def value(self):
+        """
+        The call result. Raises the call's exception if it failed,
+        and RuntimeError if the batch was not executed yet.
+        """
+        if not self.ready:
+            raise RuntimeError("batch not executed yet")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    def __repr__(self):
+        if not self.ready:
+            return "<Deferred pending>"
+        if self._error is not None:
+            return "<Deferred error %r>" % (self._error,)
+        return "<Deferred %r>" % (self._value,)
+
+
+class QueuedCall(object):
+    """
+    Pipeline view handed to one structure call. Commands go to the batch pipeline;
+    defer() ties the replies of those commands to a Deferred.
+    """
+    def __init__(self, batch):
+        self.batch = batch
+        self.start = len(batch.pipeline.command_stack)
+
+    def __getattr__(self, name):
+        return getattr(self.batch.pipeline, name)
+
+    def defer(self, transform=None, error=None):
+        count = len(self.batch.pipeline.command_stack) - self.start
+        deferred = Deferred()
+        self.batch._pending.append((deferred, self.start, count, transform, error))
+        return deferred
+
+
+class Batch(object):
+    """
+    Queue the calls made on any structure sharing connection into one pipeline.
+
+    Calls return Deferred placeholders, resolved when the batch is executed,
+    either explicitly or when the with block exits. Calls that must return a
+    concrete value (len(), in, iteration) execute the pending commands first.
+    """
+    def __init__(self, connection, transaction=True):
+        self.connection = connection
+        self.transaction = transaction
+        self.pipeline = connection.pipeline(transaction=transaction)
+        self._pending = []
+
+    def __len__(self):
+        return len(self.pipeline.command_stack)
+
+    def __enter__(self):
+        if not hasattr(_local, "batches"):
+            _local.batches = []
+        _local.batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.batches.remove(self)
+        if exc_type is None:
+            self.execute()
+        else:
+            self.pipeline.reset()
+            self._pending = []
+
+    def queue(self):
+        return QueuedCall(self)
+
+    def execute(self):
+        """
+        Send every queued command in one round trip and resolve the placeholders.
+        """
+        pending, self._pending = self._pending, []
+        if not len(self.pipeline):
+            return
+        replies = scripts.execute(self.pipeline, raise_on_error=False)
+        for deferred, start, count, transform, error in pending:
+            results = replies[start:start + count]
+            failures = [r for r in results if isinstance(r, Exception)]
+            if failures:
+                if error is not None and isinstance(failures[0], redis.exceptions.ResponseError):
+                    deferred._resolve(error=error)
+                else:
+                    deferred._resolve(error=failures[0])
+                continue
+            try:
+                deferred._resolve(transform(results) if transform else results)
+            except Exception, e:
+                deferred._resolve(error=e)
+
+
+def current_batch(connection):
+    """
+    Return the innermost active batch of this thread using connection, or None.
+    """
+    for batch in reversed(getattr(_local, "batches", [])):
+        if batch.connection is connection:
+            return batch
+    return None
@@ -0,0 +1,862 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks against a local redis-server. The database is flushed first.
+
+    python benchmarks.py [--json results.json] [name ...]
+
+With --json the results recorded by the benchmarks (see record()) are also
+written to a file, one JSON object per line, to compare versions.
+"""
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import redis
+
+import asynchronous
+import bucketed
+import buffered
+import codec
+import counters
+import loader
+import metrics
+import probabilistic
+import queues
+import scripts
+import structs
+
+RESULTS = []
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def report(name, operations, elapsed):
+    print "%-40s %8d ops %8.3f s %10.0f ops/s" % (name, operations, elapsed, operations / elapsed)
+
+
+def record(**result):
+    RESULTS.append(result)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class CountingConnection(redis.Connection):
+    """
+    Connection counting the commands it sends and the round trips: a whole
+    pipeline is written at once, so it counts as one.
+    """
+    commands = 0
+    round_trips = 0
+
+    def pack_command(self, *args):
+        CountingConnection.commands += 1
+        return super(CountingConnection, self).pack_command(*args)
+
+    def send_packed_command(self, command):
+        CountingConnection.round_trips += 1
+        return super(CountingConnection, self).send_packed_command(command)
+
+
+def server_commands(connection):
+    """
+    Total commands executed by the server, those run by scripts included,
+    less the INFO calls made to read it.
+    """
+    stats = connection.info("commandstats")
+    return sum(v["calls"] for k, v in stats.iteritems() if k != "cmdstat_info")
+
+
+def _method_cases():
+    """
+    (structure, method, fill(structure, other, size), call(structure, other, i), restore(structure, result))
+    restore puts the data back after a call that changes its size; it is not measured.
+    """
+    def fill_dict(d, other, size):
+        d.update(dict(("k%d" % j, j) for j in xrange(size)))
+
+    def fill_set(s, other, size):
+        for start in xrange(0, size, 1000):
+            s.add(*xrange(start, min(size, start + 1000)))
+            other.add(*xrange(start + size // 2, min(size, start + 1000) + size // 2))
+
+    def fill_list(l, other, size):
+        for start in xrange(0, size, 1000):
+            l.extend(range(start, min(size, start + 1000)))
+
+    def add(s, o, value):
+        s.add(value)
+
+    def drop(s, result):
+        s.connection.delete(result.pk)
+
+    def refill_dict(d, result):
+        d.update(dict(("k%d" % j, j) for j in xrange(d.size)))
+
+    def refill_set(s, result):
+        fill_set(s, structs.Set(), s.size)
+
+    def refill_list(l, result):
+        fill_list(l, None, l.size)
+
+    nothing = None
+    return [
+        (structs.Dict, "__getitem__", fill_dict, lambda d, o, i: d["k%d" % (i % d.size)], nothing),
+        (structs.Dict, "__setitem__", fill_dict, lambda d, o, i: d.__setitem__("k%d" % (i % d.size), i), nothing),
+        (structs.Dict, "__delitem__", fill_dict, lambda d, o, i: d.__delitem__("k0"), lambda d, r: d.__setitem__("k0", 0)),
+        (structs.Dict, "__contains__", fill_dict, lambda d, o, i: "k%d" % (i % d.size) in d, nothing),
+        (structs.Dict, "__len__", fill_dict, lambda d, o, i: len(d), nothing),
+        (structs.Dict, "__iter__", fill_dict, lambda d, o, i: list(d), nothing),
+        (structs.Dict, "get", fill_dict, lambda d, o, i: d.get("missing"), nothing),
+        (structs.Dict, "pop", fill_dict, lambda d, o, i: d.pop("k0"), lambda d, r: d.__setitem__("k0", 0)),
+        (structs.Dict, "setdefault", fill_dict, lambda d, o, i: d.setdefault("k0", 0), nothing),
+        (structs.Dict, "update", fill_dict, lambda d, o, i: d.update({"k0": i, "k1": i}), nothing),
+        (structs.Dict, "to_dict", fill_dict, lambda d, o, i: d.to_dict(), nothing),
+        (structs.Dict, "items", fill_dict, lambda d, o, i: d.items(), nothing),
+        (structs.Dict, "keys", fill_dict, lambda d, o, i: d.keys(), nothing),
+        (structs.Dict, "values", fill_dict, lambda d, o, i: d.values(), nothing),
+        (structs.Dict, "incrby", fill_dict, lambda d, o, i: d.incrby("k0", 1), nothing),
+        (structs.Dict, "scan", fill_dict, lambda d, o, i: list(d.scan()), nothing),
+        (structs.Dict, "iteritems", fill_dict, lambda d, o, i: list(d.iteritems()), nothing),
+        (structs.Dict, "iterkeys", fill_dict, lambda d, o, i: list(d.iterkeys()), nothing),
+        (structs.Dict, "itervalues", fill_dict, lambda d, o, i: list(d.itervalues()), nothing),
+        (structs.Dict, "clear", fill_dict, lambda d, o, i: d.clear(), refill_dict),
+
+        (structs.Set, "__contains__", fill_set, lambda s, o, i: str(i % s.size) in s, nothing),
+        (structs.Set, "__len__", fill_set, lambda s, o, i: len(s), nothing),
+        (structs.Set, "__iter__", fill_set, lambda s, o, i: list(s), nothing),
+        (structs.Set, "__str__", fill_set, lambda s, o, i: str(s), nothing),
+        (structs.Set, "scan", fill_set, lambda s, o, i: list(s.scan()), nothing),
+        (structs.Set, "members", fill_set, lambda s, o, i: s.members(), nothing),
+        (structs.Set, "add", fill_set, lambda s, o, i: s.add(i % s.size), nothing),
+        (structs.Set, "remove", fill_set, lambda s, o, i: s.remove(0), lambda s, r: s.add(0)),
+        (structs.Set, "discard", fill_set, lambda s, o, i: s.discard(0), lambda s, r: s.add(0)),
+        (structs.Set, "pop", fill_set, lambda s, o, i: s.pop(), lambda s, r: s.add(r)),
+        (structs.Set, "random", fill_set, lambda s, o, i: s.random(), nothing),
+        (structs.Set, "move", fill_set, lambda s, o, i: s.move(0, o), lambda s, r: s.add(0)),
+        (structs.Set, "union", fill_set, lambda s, o, i: s.union(o), drop),
+        (structs.Set, "intersection", fill_set, lambda s, o, i: s.intersection(o), drop),
+        (structs.Set, "difference", fill_set, lambda s, o, i: s.difference(o), drop),
+        (structs.Set, "update", fill_set, lambda s, o, i: s.update(s), nothing),
+        (structs.Set, "intersection_update", fill_set, lambda s, o, i: s.intersection_update(s), nothing),
+        (structs.Set, "difference_update", fill_set, lambda s, o, i: s.difference_update(structs.Set()), nothing),
+        (structs.Set, "isdisjoint", fill_set, lambda s, o, i: s.isdisjoint(o), nothing),
+        (structs.Set, "issubset", fill_set, lambda s, o, i: s.issubset(s), nothing),
+        (structs.Set, "issuperset", fill_set, lambda s, o, i: s.issuperset(s), nothing),
+        (structs.Set, "__eq__", fill_set, lambda s, o, i: s == o, nothing),
+        (structs.Set, "clear", fill_set, lambda s, o, i: s.clear(), refill_set),
+
+        (structs.List, "__len__", fill_list, lambda l, o, i: len(l), nothing),
+        (structs.List, "__getitem__", fill_list, lambda l, o, i: l[i % l.size], nothing),
+        (structs.List, "__getitem__ slice", fill_list, lambda l, o, i: l[:10], nothing),
+        (structs.List, "__setitem__", fill_list, lambda l, o, i: l.__setitem__(i % l.size, i), nothing),
+        (structs.List, "__iter__", fill_list, lambda l, o, i: list(l), nothing),
+        (structs.List, "scan", fill_list, lambda l, o, i: list(l.scan()), nothing),
+        (structs.List, "append", fill_list, lambda l, o, i: l.append(i), lambda l, r: l.rpop()),
+        (structs.List, "extend", fill_list, lambda l, o, i: l.extend([1, 2]), lambda l, r: l.trim(0, l.size - 1)),
+        (structs.List, "insert", fill_list, lambda l, o, i: l.insert(l.size // 2, -1),
+         lambda l, r: l.connection.execute_command("LREM", l.pk, 1, -1)),
+        (structs.List, "push", fill_list, lambda l, o, i: l.push(i), lambda l, r: l.pop()),
+        (structs.List, "pop", fill_list, lambda l, o, i: l.pop(), lambda l, r: l.push(r)),
+        (structs.List, "rpop", fill_list, lambda l, o, i: l.rpop(), lambda l, r: l.append(r)),
+        (structs.List, "trim", fill_list, lambda l, o, i: l.trim(0, l.size - 1), nothing),
+    ]
+
+
+def bench_counters(operations=200000, fields=10, threads=(1, 4)):
+    """
+    Dict.incrby on a few hot fields: one HINCRBY per call against write_behind
+    counters, with one and several threads, and the server commands per call.
+    """
+    connection = redis.Redis()
+    for thread_count in threads:
+        for mode in ("direct", "write_behind"):
+            connection.flushdb()
+            buffer = counters.CounterBuffer() if mode == "write_behind" else None
+            d = structs.Dict(name="hits", write_behind=buffer)
+            per_thread = operations // thread_count
+            def run():
+                for i in xrange(per_thread):
+                    d.incrby("f%d" % (i % fields))
+            def run_all():
+                workers = [threading.Thread(target=run) for i in xrange(thread_count)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                d.flush()
+            before = server_commands(connection)
+            elapsed = timed(run_all)
+            commands = server_commands(connection) - before
+            assert sum(int(v) for v in d.values()) == per_thread * thread_count
+            name = "Dict.incrby %s %d threads" % (mode, thread_count)
+            report(name, per_thread * thread_count, elapsed)
+            print "%-40s %10.4f commands per call" % ("", float(commands) / (per_thread * thread_count))
+            record(benchmark="counters", mode=mode, threads=thread_count, ops_per_second=operations / elapsed,
+                   commands=commands)
+    connection.flushdb()
+
+
+def bench_expressions(operations=500, size=1000):
+    """
+    (a & b) - c with the *STORE methods, one round trip and one temporary key per
+    operator, against a lazy expression evaluated in one script call.
+    """
+    a = structs.Set(range(0, size))
+    b = structs.Set(range(size // 2, size * 3 // 2))
+    c = structs.Set(range(size * 3 // 4, size * 2))
+
+    def eager():
+        for i in xrange(operations):
+            first = a.intersection(b)
+            result = first.difference(c)
+            len(result)
+            a.connection.delete(first.pk, result.pk)
+
+    def lazy():
+        for i in xrange(operations):
+            len((a & b) - c)
+
+    def lazy_members():
+        for i in xrange(operations):
+            ((a & b) - c).members()
+
+    report("(a & b) - c eager, len", operations, timed(eager))
+    report("(a & b) - c lazy, len", operations, timed(lazy))
+    report("(a & b) - c lazy, members", operations, timed(lazy_members))
+    a.connection.delete(a.pk, b.pk, c.pk)
+
+
+def bench_loader(rows=200000, processes=(1, 4)):
+    """
+    Loading a CSV file: Dict.update with a list of pairs and List.extend from
+    the rows read in this process, against loader.load with one and several processes.
+    """
+    connection = redis.Redis()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "rows.csv")
+    with open(path, "wb") as f:
+        for i in xrange(rows):
+            f.write("key%d,%d,name %d\n" % (i, i * 7, i))
+    try:
+        for kind, structure_class in (("dict", structs.Dict), ("list", structs.List)):
+            connection.flushdb()
+            structure = structure_class(name="loaded")
+            def direct():
+                with open(path, "rb") as f:
+                    data = [(row[0], row[1]) for row in csv.reader(f)]
+                if kind == "dict":
+                    structure.update(data)
+                else:
+                    structure.extend(value for key, value in data)
+            report("%s %s" % (structure_class.__name__, "update" if kind == "dict" else "extend"), rows,
+                   timed(direct))
+            for count in processes:
+                connection.flushdb()
+                result = loader.load(structure, path, format="csv", value=1, processes=count)
+                report("loader %s %d processes" % (kind, count), result["rows"], result["seconds"])
+                record(benchmark="loader", structure=kind, processes=count, rows_per_second=result["rows_per_second"])
+    finally:
+        shutil.rmtree(directory)
+        connection.flushdb()
+
+
+def bench_memoize(operations=200, size=20000):
+    """
+    Repeated intersection of two large sets, computed every time or memoized.
+    """
+    a = structs.Set(range(0, size))
+    b = structs.Set(range(size // 2, size * 3 // 2))
+
+    def plain():
+        for i in xrange(operations):
+            result = a.intersection(b)
+            len(result)
+            a.connection.delete(result.pk)
+
+    def memoized():
+        for i in xrange(operations):
+            len(a.intersection(b, memoize=60))
+
+    report("intersection of %d" % size, operations, timed(plain))
+    report("memoized intersection of %d" % size, operations, timed(memoized))
+    a.connection.delete(a.pk, b.pk)
+
+
+def bench_memory(dicts=20000, fields=200000):
+    """
+    Server memory of many small Dicts, one key each against BucketedDicts,
+    and of one large Dict against a BucketedMap.
+    """
+    connection = redis.Redis()
+
+    def used_memory(create):
+        connection.flushdb()
+        before = connection.info("memory")["used_memory"]
+        elapsed = timed(create)
+        return connection.info("memory")["used_memory"] - before, elapsed
+
+    def small_dicts(structure_class, **kwargs):
+        def create():
+            with structs.batch(transaction=False):
+                for i in xrange(dicts):
+                    structure_class({"name": "user %d" % i, "age": i % 100, "city": "Paris"},
+                                    name="user:%d" % i, **kwargs)
+        return create
+
+    def large_map(structure_class, **kwargs):
+        def create():
+            items = dict(("k%d" % i, i) for i in xrange(fields))
+            structure_class(items, name="map", **kwargs)
+        return create
+
+    cases = [
+        ("%d Dicts of 3 keys" % dicts, dicts, small_dicts(structs.Dict)),
+        ("%d BucketedDicts of 3 keys" % dicts, dicts, small_dicts(bucketed.BucketedDict, items=3 * dicts)),
+        ("Dict of %d keys" % fields, fields, large_map(structs.Dict)),
+        ("BucketedMap of %d keys" % fields, fields, large_map(bucketed.BucketedMap, items=fields)),
+    ]
+    for name, count, create in cases:
+        used, elapsed = used_memory(create)
+        print "%-35s %10d bytes %8.1f bytes per %s  %6.2f s" % (
+            name, used, float(used) / count, "Dict" if count == dicts else "key", elapsed)
+    connection.flushdb()
+
+
+def bench_metrics(operations=20000):
+    """
+    Cost of the instrumentation: Dict reads and writes with metrics disabled and enabled.
+    """
+    d = structs.Dict({"a": 1})
+    def run():
+        for i in xrange(operations // 2):
+            d["a"] = i
+            d["a"]
+    for state in ("disabled", "enabled"):
+        if state == "enabled":
+            metrics.enable()
+        report("Dict set+get metrics " + state, operations, timed(run))
+    metrics.disable()
+    d.clear()
+
+
+def bench_methods(iterations=200, sizes=(10, 1000, 10000)):
+    """
+    Every public Dict, Set and List method at several sizes: throughput,
+    p50/p99 latency, and the commands and round trips of one call, counted on the
+    client and, for the commands that scripts run, on the server.
+    Methods reading the whole structure, and clear, run fewer times on large ones.
+    """
+    connection = redis.Redis(connection_pool=redis.ConnectionPool(connection_class=CountingConnection))
+    scripts.load_scripts(connection)
+    monitor = redis.Redis()
+    for size in sizes:
+        for structure_class, method, fill, call, restore in _method_cases():
+            structure = structure_class(connection=connection)
+            other = structure_class(connection=connection)
+            structure.size = size
+            fill(structure, other, size)
+            whole = method in ("__iter__", "__str__", "to_dict", "items", "keys", "values", "scan", "iteritems",
+                               "iterkeys", "itervalues", "members", "union", "intersection", "difference",
+                               "update", "intersection_update", "isdisjoint", "issubset", "issuperset",
+                               "__eq__", "clear")
+            count = max(5, iterations * 100 // size) if whole and size > 100 else iterations
+            count = min(count, iterations)
+
+            latencies = []
+            commands = round_trips = server = 0
+            for i in xrange(count):
+                commands_before = CountingConnection.commands
+                round_trips_before = CountingConnection.round_trips
+                server_before = server_commands(monitor)
+                start = time.time()
+                result = call(structure, other, i)
+                latencies.append(time.time() - start)
+                commands += CountingConnection.commands - commands_before
+                round_trips += CountingConnection.round_trips - round_trips_before
+                server += server_commands(monitor) - server_before
+                if restore:
+                    restore(structure, result)
+
+            latencies.sort()
+            result = {
+                "structure": structure_class.__name__,
+                "method": method,
+                "size": size,
+                "iterations": count,
+                "ops_per_sec": count / sum(latencies),
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "commands": float(commands) / count,
+                "server_commands": float(server) / count,
+                "round_trips": float(round_trips) / count,
+            }
+            record(benchmark="methods", **result)
+            print "%-5s %-28s %6d %9.0f ops/s p50 %7.3f ms p99 %7.3f ms %7.1f cmds %7.1f server %5.1f rtt" % (
+                result["structure"], method, size, result["ops_per_sec"], result["p50_ms"], result["p99_ms"],
+                result["commands"], result["server_commands"], result["round_trips"])
+            connection.delete(structure.pk, other.pk)
+
+
+def bench_async(operations=5000):
+    """
+    Sync Dict/Set/List calls one after the other against the Async variants
+    with every call in flight at once.
+    """
+    cases = [
+        ("Dict.__getitem__", structs.Dict, asynchronous.AsyncDict,
+         lambda d: d.update(dict(("k%d" % i, i) for i in range(100))),
+         lambda d, i: d["k%d" % (i % 100)]),
+        ("Dict.setdefault", structs.Dict, asynchronous.AsyncDict, None,
+         lambda d, i: d.setdefault("k%d" % (i % 100), i)),
+        ("Set.issubset", structs.Set, asynchronous.AsyncSet,
+         lambda s: s.add(*range(100)),
+         lambda s, i: s.issubset(s)),
+        ("List.append", structs.List, asynchronous.AsyncList, None,
+         lambda l, i: l.append(i)),
+    ]
+    for name, sync_class, async_class, fill, call in cases:
+        sync_structure = sync_class()
+        async_structure = async_class()
+        if fill:
+            fill(sync_structure)
+            fill(async_structure)
+
+        def run_sync():
+            for i in xrange(operations):
+                call(sync_structure, i)
+
+        def run_async():
+            asynchronous.gather(*[call(async_structure, i) for i in xrange(operations)])
+
+        report("sync  " + name, operations, timed(run_sync))
+        report("async " + name, operations, timed(run_async))
+
+
+def bench_codecs(operations=20000):
+    """
+    Payload size and encode/decode cost per codec, then Dict write/read throughput.
+    """
+    record = (123456, 98.25, 7)
+    cases = [
+        ("raw int", codec.RAW, 123456, str),
+        ("integer", codec.INTEGER, 123456, None),
+        ("struct <i", codec.Struct("<i"), 123456, None),
+        ("float", codec.FLOAT, 98.25, None),
+        ("struct <d", codec.Struct("<d"), 98.25, None),
+        ("json record", codec.JSON, list(record), None),
+        ("struct <idh record", codec.Struct("<idh"), record, None),
+        ("json document", codec.JSON, {"id": 123456, "score": 98.25, "tags": ["a", "b", "c"]}, None),
+    ]
+    try:
+        msgpack = codec.Msgpack()
+        cases += [
+            ("msgpack record", msgpack, list(record), None),
+            ("msgpack document", msgpack, {"id": 123456, "score": 98.25, "tags": ["a", "b", "c"]}, None),
+        ]
+    except ImportError:
+        print "msgpack not installed, skipped"
+
+    for name, value_codec, value, convert in cases:
+        encoded = value_codec.encode(value)
+        if convert: # what the application does by hand without a codec
+            encode = lambda v: str(v)
+            decode = convert
+        else:
+            encode = value_codec.encode
+            decode = value_codec.decode
+        encode_time = timed(lambda: [encode(value) for i in xrange(operations)])
+        decode_time = timed(lambda: [decode(encoded) for i in xrange(operations)])
+        print "%-25s %4d bytes  encode %6.2f us  decode %6.2f us" % (
+            name, len(str(encoded)), encode_time / operations * 1e6, decode_time / operations * 1e6)
+
+        d = structs.Dict(codec=value_codec)
+        keys = ["k%d" % (i % 100) for i in xrange(operations // 10)]
+        report("Dict set+get " + name, 2 * len(keys),
+               timed(lambda: [(d.__setitem__(k, value), d[k]) for k in keys]))
+        d.clear()
+
+
+def bench_compression(operations=2000):
+    """
+    Stored size and Dict write/read throughput for multi KB JSON documents,
+    plain and with each compression method.
+    """
+    document = {"items": [{"id": i, "name": "item %d" % i, "tags": ["red", "green"]} for i in range(100)]}
+    cases = [("json", codec.JSON)]
+    for method in sorted(codec.Compressed.METHODS):
+        cases.append(("json+" + method, codec.Compressed(codec.JSON, method=method)))
+
+    for name, value_codec in cases:
+        d = structs.Dict(codec=value_codec)
+        keys = ["k%d" % (i % 100) for i in xrange(operations)]
+        report("Dict set " + name, len(keys), timed(lambda: [d.__setitem__(k, document) for k in keys]))
+        report("Dict get " + name, len(keys), timed(lambda: [d[k] for k in keys]))
+        stored = len(d.connection.hget(d.pk, "k0"))
+        print "%-25s %6d bytes stored, ratio %.1f" % (
+            name, stored, len(codec.JSON.encode(document)) / float(stored))
+        d.clear()
+
+
+def bench_bloom(elements=200000, tests=100000):
+    """
+    Dedup checks over elements ids: server memory, add and test throughput,
+    and measured false positive rate of a Set, a BloomFilter sized for them,
+    and a ScalableBloomFilter starting at a hundredth of them.
+    """
+    connection = redis.Redis()
+    ids = ["id:%d" % i for i in xrange(elements)]
+    others = ["other:%d" % i for i in xrange(tests)]
+
+    def add_set(s):
+        for i in xrange(0, elements, probabilistic.BATCH_SIZE):
+            s.add(*ids[i:i + probabilistic.BATCH_SIZE])
+
+    def test_set(s):
+        pipe = connection.pipeline(transaction=False)
+        for element in ids[:tests]:
+            pipe.sismember(s.pk, element)
+        return pipe.execute()
+
+    cases = [
+        ("Set", lambda: structs.Set(name="ids"), add_set, test_set),
+        ("BloomFilter", lambda: probabilistic.BloomFilter(name="ids", capacity=elements),
+         lambda f: f.add_many(ids), lambda f: f.contains_many(ids[:tests])),
+        ("ScalableBloomFilter", lambda: probabilistic.ScalableBloomFilter(name="ids", capacity=elements // 100),
+         lambda f: f.add_many(ids), lambda f: f.contains_many(ids[:tests])),
+    ]
+    for name, create, add, test in cases:
+        connection.flushdb()
+        before = connection.info("memory")["used_memory"]
+        structure = create()
+        report(name + " add", elements, timed(add, structure))
+        used = connection.info("memory")["used_memory"] - before
+        report(name + " contains", tests, timed(test, structure))
+        false_positives = 0
+        if name != "Set":
+            false_positives = sum(structure.contains_many(others)) / float(tests)
+        print "%-40s %10d bytes %6.1f bytes per element  %.4f false positives" % (
+            name, used, float(used) / elements, false_positives)
+        record(benchmark="bloom", structure=name, elements=elements, bytes=used, false_positives=false_positives)
+    connection.flushdb()
+
+
+def bench_buffered(operations=100000, fields=1000):
+    """
+    Ingestion overwriting the same fields: Dict.__setitem__ against a BufferedDict,
+    and the server commands per write.
+    """
+    connection = redis.Redis()
+    for structure_class in (structs.Dict, buffered.BufferedDict):
+        connection.flushdb()
+        d = structure_class(name="latest")
+        def run():
+            for i in xrange(operations):
+                d["f%d" % (i % fields)] = i
+                if i % 10 == 0:
+                    del d["f%d" % ((i + 1) % fields)]
+            if structure_class is buffered.BufferedDict:
+                d.flush()
+        before = server_commands(connection)
+        elapsed = timed(run)
+        commands = server_commands(connection) - before
+        name = structure_class.__name__
+        report(name + " set/del", operations * 11 // 10, elapsed)
+        print "%-40s %10.4f commands per write" % ("", float(commands) / (operations * 11 // 10))
+        record(benchmark="buffered", structure=name, ops_per_second=operations * 1.1 / elapsed, commands=commands)
+    connection.flushdb()
+
+
+def bench_cardinality(sizes=(1000, 100000, 1000000), days=7, batch_size=1000):
+    """
+    Unique visitor counts: server memory, add throughput and relative error of
+    len() for a HyperLogLog against an exact Set, at several cardinalities,
+    and of the count over several days (union_count against SUNION).
+    """
+    connection = redis.Redis()
+
+    def fill(structure, members):
+        for i in xrange(0, len(members), batch_size):
+            structure.add(*members[i:i + batch_size])
+
+    for size in sizes:
+        members = ["visitor:%d" % i for i in xrange(size)]
+        for structure_class in (structs.Set, structs.HyperLogLog):
+            connection.flushdb()
+            before = connection.info("memory")["used_memory"]
+            structure = structure_class(name="visitors")
+            elapsed = timed(fill, structure, members)
+            used = connection.info("memory")["used_memory"] - before
+            error = abs(len(structure) - size) / float(size)
+            name = "%s %d" % (structure_class.__name__, size)
+            report(name + " add", size, elapsed)
+            print "%-40s %10d bytes %8.2f bytes per member  %.4f error" % (name, used, float(used) / size, error)
+            record(benchmark="cardinality", structure=structure_class.__name__, size=size, bytes=used, error=error)
+
+    # days overlapping by half
+    size = sizes[-1] // 10
+    connection.flushdb()
+    sets, counters = [], []
+    for day in xrange(days):
+        members = ["visitor:%d" % i for i in xrange(day * size // 2, day * size // 2 + size)]
+        sets.append(structs.Set(name="set:%d" % day))
+        counters.append(structs.HyperLogLog(name="hll:%d" % day))
+        fill(sets[-1], members)
+        fill(counters[-1], members)
+    exact = len(connection.sunion([s.pk for s in sets]))
+    elapsed = timed(lambda: [counters[0].union_count(*counters[1:]) for i in xrange(100)])
+    error = abs(counters[0].union_count(*counters[1:]) - exact) / float(exact)
+    report("HyperLogLog union_count of %d days" % days, 100, elapsed)
+    print "%-40s %10d exact %.4f error" % ("union of %d days" % days, exact, error)
+    record(benchmark="cardinality", structure="HyperLogLog union", size=exact, error=error)
+    connection.flushdb()
+
+
+def bench_bitset(size=1000000, density=0.5, operations=20):
+    """
+    Dense integer ids, density of the id space used: server memory and add
+    throughput of a Set against an IntBitSet, and of intersection and len.
+    """
+    connection = redis.Redis()
+    ids = [i for i in xrange(int(size / density)) if i % int(1 / density) == 0]
+    others = ids[::3]
+    for structure_class in (structs.Set, structs.IntBitSet):
+        connection.flushdb()
+        name = structure_class.__name__
+        before = connection.info("memory")["used_memory"]
+        structure = structure_class(name="ids", codec=codec.INTEGER) if structure_class is structs.Set else \
+            structure_class(name="ids")
+        def fill():
+            for i in xrange(0, len(ids), 10000):
+                structure.add(*ids[i:i + 10000])
+        report(name + " add", len(ids), timed(fill))
+        used = connection.info("memory")["used_memory"] - before
+        other = structure_class(others, codec=codec.INTEGER) if structure_class is structs.Set else \
+            structure_class(others)
+        report(name + " intersection+len", operations, timed(
+            lambda: [len(structure.intersection(other)) for i in xrange(operations)]))
+        print "%-40s %10d bytes %8.2f bytes per member" % (name, used, float(used) / len(ids))
+        record(benchmark="bitset", structure=name, size=len(ids), bytes=used)
+    connection.flushdb()
+
+
+def bench_numpy(size=200000, rows=2000, dimensions=100, repeat=5):
+    """
+    Reading numeric Lists and Dicts into numpy arrays: values decoded one by one
+    in Python against to_numpy(), and vectors stored as text Lists against
+    packed NumpyArray values.
+    """
+    if codec.numpy is None:
+        print "numpy not installed, skipped"
+        return
+    numpy = codec.numpy
+    connection = redis.Redis()
+    floats = numpy.random.random(size)
+    integers = numpy.random.randint(0, 10 ** 9, size)
+    def dict_by_element(d, dtype):
+        items = d.items()
+        return numpy.array([int(k) for k, v in items]), numpy.array([dtype(v) for k, v in items], dtype=dtype)
+    cases = [
+        ("List float", structs.List(name="floats"), floats, float,
+         lambda s, dtype: numpy.array([dtype(v) for v in s[:]], dtype=dtype),
+         lambda s, dtype: s.to_numpy(dtype)),
+        ("List int", structs.List(name="integers"), integers, numpy.int64,
+         lambda s, dtype: numpy.array([dtype(v) for v in s[:]], dtype=dtype),
+         lambda s, dtype: s.to_numpy(dtype)),
+        ("Dict int:float", structs.Dict(name="scores"), floats, float, dict_by_element,
+         lambda s, dtype: s.to_numpy(dtype, key_dtype=numpy.int64)),
+    ]
+    for name, structure, array, dtype, read, to_numpy in cases:
+        if isinstance(structure, structs.Dict):
+            structure.from_numpy(numpy.arange(size), array)
+        else:
+            structure.from_numpy(array)
+        by_element = timed(lambda: [read(structure, dtype) for i in xrange(repeat)])
+        vectorized = timed(lambda: [to_numpy(structure, dtype) for i in xrange(repeat)])
+        report(name + " per element", size * repeat, by_element)
+        report(name + " to_numpy", size * repeat, vectorized)
+        record(benchmark="numpy", case=name, size=size, per_element=by_element / repeat,
+               to_numpy=vectorized / repeat)
+
+    # the same matrix as one text List per row, and as packed rows of a List
+    matrix = numpy.random.random((rows, dimensions))
+    text_rows = [structs.List(name="row:%d" % i) for i in xrange(rows)]
+    packed = structs.List(name="packed", codec=codec.NumpyArray("<f8"))
+    for row, values in zip(text_rows, matrix):
+        row.from_numpy(values)
+    packed.from_numpy(matrix)
+    def read_text():
+        pipe = connection.pipeline(transaction=False)
+        for row in text_rows:
+            pipe.lrange(row.pk, 0, -1)
+        return numpy.array([[float(v) for v in values] for values in pipe.execute()])
+    cells = rows * dimensions * repeat
+    report("matrix text rows", cells, timed(lambda: [read_text() for i in xrange(repeat)]))
+    report("matrix packed to_numpy", cells, timed(lambda: [packed.to_numpy() for i in xrange(repeat)]))
+    memory = lambda key: connection.execute_command("MEMORY", "USAGE", key)
+    packed_bytes = memory(packed.pk)
+    text_bytes = sum(memory(row.pk) for row in text_rows)
+    print "%-40s %10d bytes packed %10d bytes as text" % ("matrix", packed_bytes, text_bytes)
+    record(benchmark="numpy", case="matrix", rows=rows, dimensions=dimensions, packed_bytes=packed_bytes,
+           text_bytes=text_bytes)
+    connection.flushdb()
+
+
+def bench_snapshot(sizes=(100, 10000, 1000000)):
+    """
+    Copying a Dict through a local file, by key size: snapshot() and restore()
+    with DUMP payloads and portable chunks, against items() and update().
+    Throughput in fields per second.
+    """
+    connection = redis.Redis()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "snapshot")
+    try:
+        for size in sizes:
+            connection.flushdb()
+            repeat = max(1, 100000 // size)
+            original = structs.Dict(name="original")
+            for start in xrange(0, size, 10000):
+                original.update(dict(("field%d" % i, "value %d" % i) for i in xrange(start, min(start + 10000, size))))
+            clone = structs.Dict(name="clone")
+            fields = size * repeat
+            def copy():
+                clone.clear()
+                items = original.items()
+                for start in xrange(0, size, 10000): # a single HMSET of 1M fields is refused
+                    clone.update(dict(items[start:start + 10000]))
+            report("Dict %d items+update" % size, fields, timed(lambda: [copy() for i in xrange(repeat)]))
+            for portable in (False, True):
+                mode = "portable" if portable else "dump"
+                snapshot = timed(lambda: [original.snapshot(path, portable=portable) for i in xrange(repeat)])
+                restore = timed(lambda: [clone.restore(path) for i in xrange(repeat)])
+                assert len(clone) == size
+                report("Dict %d snapshot %s" % (size, mode), fields, snapshot)
+                report("Dict %d restore %s" % (size, mode), fields, restore)
+                print "%-40s %10d bytes" % ("", os.path.getsize(path))
+                record(benchmark="snapshot", size=size, mode=mode, snapshot=snapshot / repeat,
+                       restore=restore / repeat, bytes=os.path.getsize(path))
+    finally:
+        shutil.rmtree(directory)
+        connection.flushdb()
+
+
+def bench_queue(jobs=50000, consumers=4, batch_size=100):
+    """
+    Job queue throughput with several consumer processes, and the commands the
+    server handled per job and while the queue was empty: List.pop polling,
+    as before Queue, against blocking get(), get_many(), and their reliable
+    forms with ack.
+    """
+    connection = redis.Redis()
+    stop = "stop"
+
+    def poll(q):
+        while True:
+            item = q.pop()
+            if item == stop:
+                return
+            # an empty queue is polled again right away
+
+    def get(q):
+        while q.get(timeout=10) != stop:
+            pass
+
+    def get_many(q):
+        while True:
+            items = q.get_many(batch_size, block=True, timeout=10)
+            if q.reliable:
+                q.ack_many(items)
+            if stop in items:
+                if items.count(stop) > 1: # one for each of the other consumers
+                    q.extend([stop] * (items.count(stop) - 1))
+                return
+
+    def get_ack(q):
+        while True:
+            item = q.get(timeout=10)
+            q.ack(item)
+            if item == stop:
+                return
+
+    cases = [
+        ("List.pop polling", poll, False),
+        ("Queue.get", get, False),
+        ("Queue.get_many(%d)" % batch_size, get_many, False),
+        ("reliable Queue.get+ack", get_ack, True),
+        ("reliable Queue.get_many(%d)+ack_many" % batch_size, get_many, True),
+    ]
+    payload = "x" * 100
+    for name, consume, reliable in cases:
+        connection.flushdb()
+        children = []
+        for i in range(consumers):
+            pid = os.fork()
+            if pid == 0:
+                consume(queues.Queue(name="jobs", reliable=reliable, consumer="worker%d" % i))
+                os._exit(0)
+            children.append(pid)
+        commands = connection.info("stats")["total_commands_processed"]
+        time.sleep(1) # consumers waiting on an empty queue
+        idle = connection.info("stats")["total_commands_processed"] - commands
+        commands += idle
+        start = time.time()
+        producer = queues.Queue(name="jobs")
+        for i in xrange(0, jobs, 1000):
+            producer.extend([payload] * 1000)
+        producer.extend([stop] * consumers)
+        for pid in children:
+            os.waitpid(pid, 0)
+        elapsed = time.time() - start
+        per_job = float(connection.info("stats")["total_commands_processed"] - commands) / jobs
+        report("%s, %d consumers" % (name, consumers), jobs, elapsed)
+        print "%-40s %8.2f commands per job %8d commands per idle second" % ("", per_job, idle)
+        record(benchmark="queue", case=name, consumers=consumers, jobs_per_second=jobs / elapsed,
+               commands_per_job=per_job, idle_commands_per_second=idle)
+    connection.flushdb()
+
+
+BENCHMARKS = {
+    "async": bench_async,
+    "bitset": bench_bitset,
+    "bloom": bench_bloom,
+    "buffered": bench_buffered,
+    "cardinality": bench_cardinality,
+    "codecs": bench_codecs,
+    "compression": bench_compression,
+    "counters": bench_counters,
+    "expressions": bench_expressions,
+    "loader": bench_loader,
+    "memoize": bench_memoize,
+    "memory": bench_memory,
+    "methods": bench_methods,
+    "metrics": bench_metrics,
+    "numpy": bench_numpy,
+    "queue": bench_queue,
+    "snapshot": bench_snapshot,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    output = None
+    if names[:1] == ["--json"]:
+        output, names = names[1], names[2:]
+    redis.Redis().flushdb()
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+    if output:
+        with open(output, "w") as f:
+            for result in RESULTS:
+                f.write(json.dumps(result, sort_keys=True) + "\n")
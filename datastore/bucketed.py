@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bucketed hashes: structures stored in small hashes that redis keeps in its
+compact listpack (ziplist before redis 7) encoding, instead of one key each.
+A top level key costs tens of bytes of overhead, plus a hash table for a
+hash, while a listpack entry costs a few bytes.
+
+BucketedDict packs many small logical Dicts of a namespace into shared buckets.
+BucketedMap spreads the keys of one large map over buckets.
+Both are sized from the server's hash-max-listpack-entries setting, and hash
+fields and values must stay under hash-max-listpack-value bytes for the
+buckets to keep the encoding.
+"""
+import fnmatch
+import math
+import threading
+import zlib
+
+import redis
+
+import registry
+import scripts
+from sharded import ShardedDict
+from structs import RedisDataStructure
+
+NAMESPACE = "buckets"
+SEPARATOR = "\x00"
+FILL = 0.5 # average share of a bucket in use, the rest is headroom for uneven hashing
+
+# Server defaults, when CONFIG is not allowed
+DEFAULT_ENTRIES = 128
+DEFAULT_VALUE = 64
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def listpack_limits(connection):
+    """
+    CONFIG GET
+
+    Return (entries, value bytes), the largest hash the server keeps in a listpack
+    (hash-max-listpack-*, hash-max-ziplist-* before redis 7). Read once per connection pool.
+    """
+    pool = connection.connection_pool
+    with _limits_lock:
+        if id(pool) in _limits:
+            return _limits[id(pool)]
+    try:
+        config = connection.config_get("hash-max-*")
+    except redis.exceptions.ResponseError: # CONFIG renamed or disabled
+        config = {}
+    entries = config.get("hash-max-listpack-entries") or config.get("hash-max-ziplist-entries") or DEFAULT_ENTRIES
+    value = config.get("hash-max-listpack-value") or config.get("hash-max-ziplist-value") or DEFAULT_VALUE
+    limits = (int(entries), int(value))
+    with _limits_lock:
+        _limits[id(pool)] = limits
+    return limits
+
+
+def bucket_count(items, connection, fill=FILL):
+    """
+    Number of buckets for items hash fields, so that buckets hold fill times
+    the listpack entries limit on average.
+    """
+    entries, value = listpack_limits(connection)
+    return max(1, int(math.ceil(items / (entries * fill))))
+
+
+class BucketedDict(RedisDataStructure):
+    """
+    A Dict sharing a hash bucket with the other Dicts of its namespace: its keys
+    are stored as "<name>\\0<key>" fields of the bucket "<namespace>:<n>",
+    with n chosen by hashing the name.
+
+    Accepts name, namespace, and either buckets, the number of buckets of the
+    namespace, or items, the expected number of keys of all the Dicts of the
+    namespace to size it from. Every BucketedDict of a namespace must be created
+    with the same number of buckets. Plus connection and codec, as Dict.
+
+    Operations on the whole Dict (len, keys, items, clear...) read the whole bucket
+    in a script: buckets are small, but this is no mode for large Dicts.
+    There is no near cache, and no expiry: the bucket is shared.
+    """
+    def __init__(self, *args, **kwargs):
+        if "cache_size" in kwargs and kwargs["cache_size"]:
+            raise ValueError("BucketedDict has no near cache")
+        if "ttl" in kwargs and kwargs["ttl"]:
+            raise ValueError("BucketedDict shares its bucket, it cannot expire")
+        super(BucketedDict, self).__init__(*args, **kwargs)
+        if SEPARATOR in self.pk:
+            raise ValueError("name must not contain \\0")
+        self.namespace = kwargs["namespace"] if "namespace" in kwargs and kwargs["namespace"] else NAMESPACE
+        if "buckets" in kwargs and kwargs["buckets"]:
+            self.buckets = kwargs["buckets"]
+        elif "items" in kwargs and kwargs["items"]:
+            self.buckets = bucket_count(kwargs["items"], self.connection)
+        else:
+            raise ValueError("buckets or items required")
+        self.bucket = "%s:%d" % (self.namespace, zlib.crc32(self.pk) % self.buckets)
+        self.prefix = self.pk + SEPARATOR
+        self.expiry = None # not even ANONYMOUS_TTL
+        if args: # initial data
+            self.update(args[0])
+
+    def expire(self, seconds):
+        raise TypeError("BucketedDict shares its bucket, it cannot expire")
+
+    def persist(self):
+        raise TypeError("BucketedDict shares its bucket, it cannot expire")
+
+    def ttl(self):
+        raise TypeError("BucketedDict shares its bucket, it cannot expire")
+
+    def snapshot(self, path, portable=False, chunk_size=None):
+        raise TypeError("BucketedDict shares its bucket, it cannot be snapshot")
+
+    def restore(self, path):
+        raise TypeError("BucketedDict shares its bucket, it cannot be restored")
+
+    def _field(self, key):
+        return "%s%s" % (self.prefix, key)
+
+    def _items(self, transform):
+        return self._script(scripts.HASH_PREFIX_ITEMS, [self.bucket], [self.prefix], transform=transform)
+
+    def __setitem__(self, key, value):
+        """
+        HSET
+        """
+        return self._command("hset", self.bucket, self._field(key), self._encode(value))
+
+    def __getitem__(self, key):
+        """
+        HGET
+        """
+        def result(value):
+            if value is None:
+                raise KeyError(key)
+            return self.codec.decode(value)
+        return self._command("hget", self.bucket, self._field(key), transform=result)
+
+    def __delitem__(self, key):
+        """
+        HDEL
+        """
+        return self._command("hdel", self.bucket, self._field(key))
+
+    def __contains__(self, key):
+        """
+        HEXISTS
+        """
+        self._flush()
+        return self.connection.hexists(self.bucket, self._field(key))
+
+    def __len__(self):
+        self._flush()
+        return scripts.HASH_PREFIX_LEN(self.connection, [self.bucket], [self.prefix])
+
+    def clear(self):
+        """
+        Remove all items from the dictionary.
+        """
+        return self._script(scripts.HASH_PREFIX_DELETE, [self.bucket], [self.prefix])
+
+    def to_dict(self):
+        decode = self.codec.decode
+        return self._items(lambda values: dict((k, decode(v)) for k, v in zip(values[::2], values[1::2])))
+
+    def items(self):
+        decode = self.codec.decode
+        return self._items(lambda values: [(k, decode(v)) for k, v in zip(values[::2], values[1::2])])
+
+    def keys(self):
+        return self._items(lambda values: values[::2])
+
+    def values(self):
+        return self._items(lambda values: self._decode_all(values[1::2]))
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def scan(self, count=None, match=None):
+        """
+        The (key, value) pairs, optionally only the keys matching the glob-style pattern match.
+        The bucket is small, so it is read at once and count is ignored.
+        """
+        self._flush()
+        items = self.items()
+        if match is not None:
+            items = [(k, v) for k, v in items if fnmatch.fnmatchcase(k, match)]
+        return iter(items)
+
+    def iteritems(self):
+        return self.scan()
+
+    def iterkeys(self):
+        return (k for k, v in self.scan())
+
+    def itervalues(self):
+        return (v for k, v in self.scan())
+
+    def get(self, key, *args):
+        """
+        HGET with sugar.
+        """
+        default = args[0] if args else None
+        result = lambda value: self.codec.decode(value) if value is not None else default
+        return self._command("hget", self.bucket, self._field(key), transform=result)
+
+    def pop(self, key, *args):
+        def result(key_value):
+            if key_value is not None:
+                return self.codec.decode(key_value)
+            if args:
+                return args[0]
+            raise KeyError(key)
+        return self._script(scripts.DICT_POP, [self.bucket], [self._field(key)], transform=result)
+
+    def setdefault(self, key, *args):
+        """
+        HSETNX
+        """
+        default = args[0] if args else None
+        result = lambda key_value: self.codec.decode(key_value) if key_value is not None else default
+        return self._script(scripts.DICT_SETDEFAULT, [self.bucket], [self._field(key), self._encode(default)],
+                            transform=result)
+
+    def update(self, *args, **kwargs):
+        """
+        HMSET
+
+        Accepts the same arguments as Dict.update().
+        """
+        items = {}
+        for arg in args:
+            items.update(arg)
+        items.update(kwargs)
+        if not items:
+            return None
+        fields = dict((self._field(k), self._encode(v)) for k, v in items.iteritems())
+        return self._command("hmset", self.bucket, fields, transform=lambda reply: None)
+
+    def incrby(self, key, value=1):
+        """
+        HINCRBY
+        HINCRBYFLOAT
+        """
+        if type(value) == int:
+            op = "hincrby"
+        elif type(value) == float:
+            op = "hincrbyfloat"
+        else:
+            raise TypeError("value must be int or float")
+        return self._command(op, self.bucket, self._field(key), value,
+                             error=TypeError("key's value must be int or float"))
+
+
+class BucketedMap(ShardedDict):
+    """
+    A large Dict split into listpack sized hashes, "<name>:<i>": a ShardedDict
+    with its number of shards computed from items, the expected number of keys.
+    Accepts the ShardedDict arguments otherwise.
+    """
+    def __init__(self, *args, **kwargs):
+        if not ("shards" in kwargs and kwargs["shards"]):
+            if not ("items" in kwargs and kwargs["items"]):
+                raise ValueError("shards or items required")
+            if "connections" in kwargs and kwargs["connections"]:
+                connection = registry.resolve(kwargs["connections"][0])
+            else:
+                name = kwargs["name"] if "name" in kwargs and kwargs["name"] else ""
+                connection = registry.get_connection(registry.connection_name(name))
+            kwargs["shards"] = bucket_count(kwargs["items"], connection)
+        super(BucketedMap, self).__init__(*args, **kwargs)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write buffered Dicts: sets and deletes kept in process, the last write of
+each field only, and sent together in one round trip.
+
+    with BufferedDict(name="latest") as d:
+        for event in events:
+            d[event.id] = event.state       # nothing sent yet
+    # one HMSET and one HDEL here
+
+Pending writes are sent when max_pending fields are pending, when the oldest
+is interval seconds old (checked on writes), on flush() and when the with
+block exits. Reads on the instance see its pending writes, other clients and
+instances only once flushed. Writes still pending when the instance is
+dropped are lost.
+"""
+import time
+
+from structs import Dict
+
+MAX_PENDING = 1000 # fields pending before a flush
+INTERVAL = 1.0 # seconds the oldest pending write waits at most, at the next write
+
+_DELETED = object()
+_MISSING = object() # no pending write: an encoded value may be None
+
+
+def _field(key):
+    """
+    The field redis-py writes for key, so that d[1] and d["1"] are the same pending write.
+    """
+    if isinstance(key, unicode):
+        return key.encode("utf-8")
+    if isinstance(key, float):
+        return repr(key)
+    return str(key)
+
+
+class BufferedDict(Dict):
+    """
+    A Dict whose __setitem__, __delitem__ and update() are buffered and coalesced.
+    Accepts max_pending and interval (0 for no time threshold), plus the Dict
+    arguments. Not thread safe, as the other structures.
+
+    As a context manager, the pending writes are flushed when the block exits,
+    and dropped if it raises, as a Batch.
+    """
+    def __init__(self, *args, **kwargs):
+        self.max_pending = kwargs["max_pending"] if "max_pending" in kwargs and kwargs["max_pending"] else MAX_PENDING
+        self.interval = kwargs["interval"] if "interval" in kwargs and kwargs["interval"] is not None else INTERVAL
+        self._writes = {} # field: encoded value, or _DELETED
+        self._oldest = None
+        super(BufferedDict, self).__init__(*args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def pending(self):
+        """
+        Return the number of fields with a pending write.
+        """
+        return len(self._writes)
+
+    def discard(self):
+        """
+        Drop the pending writes.
+        """
+        self._writes = {}
+        self._oldest = None
+
+    def _write(self, key, value):
+        if not self._writes:
+            self._oldest = time.time()
+        self._writes[_field(key)] = value
+        if len(self._writes) >= self.max_pending or \
+                (self.interval and time.time() - self._oldest >= self.interval):
+            self.flush()
+
+    def flush(self):
+        """
+        HMSET
+        HDEL
+
+        Send the pending writes in one round trip, and the write_behind increments
+        if any. Returns how many fields were written.
+        """
+        written = 0
+        if self._writes:
+            writes = self._writes
+            self.discard()
+            sets = dict((field, value) for field, value in writes.iteritems() if value is not _DELETED)
+            deletes = [field for field, value in writes.iteritems() if value is _DELETED]
+            pipe = self._pipeline()
+            if sets:
+                pipe.hmset(self.pk, sets)
+            if deletes:
+                pipe.hdel(self.pk, *deletes)
+            self._execute(pipe, lambda replies: self._invalidate_cache())
+            written = len(writes)
+        return written + super(BufferedDict, self).flush()
+
+    def __setitem__(self, key, value):
+        self._write(key, self._encode(value))
+
+    def __delitem__(self, key):
+        self._write(key, _DELETED)
+
+    def update(self, *args, **kwargs):
+        """
+        Buffer the key/value pairs, as Dict.update().
+        """
+        for arg in args:
+            for key, value in (arg.iteritems() if isinstance(arg, dict) else arg):
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def __getitem__(self, key):
+        value = self._writes.get(_field(key), _MISSING)
+        if value is _MISSING:
+            return super(BufferedDict, self).__getitem__(key)
+        if value is _DELETED:
+            raise KeyError(key)
+        return self.codec.decode(value)
+
+    def get(self, key, *args):
+        value = self._writes.get(_field(key), _MISSING)
+        if value is _MISSING:
+            return super(BufferedDict, self).get(key, *args)
+        if value is _DELETED:
+            return args[0] if args else None
+        return self.codec.decode(value)
+
+    def __contains__(self, key):
+        value = self._writes.get(_field(key), _MISSING)
+        if value is _MISSING:
+            return super(BufferedDict, self).__contains__(key)
+        return value is not _DELETED
+
+    def pop(self, key, *args):
+        field = _field(key)
+        value = self._writes.get(field, _MISSING)
+        if value is _MISSING:
+            return super(BufferedDict, self).pop(key, *args)
+        self._write(field, _DELETED) # also removes the stored value, if any
+        if value is not _DELETED:
+            return self.codec.decode(value)
+        if args:
+            return args[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, *args):
+        field = _field(key)
+        value = self._writes.get(field, _MISSING)
+        if value is _MISSING:
+            return super(BufferedDict, self).setdefault(key, *args)
+        if value is not _DELETED:
+            return self.codec.decode(value)
+        default = args[0] if args else None
+        self[key] = default
+        return default
+
+    def clear(self):
+        self.discard()
+        return super(BufferedDict, self).clear()
+
+    # Reads of the whole hash and increments go to the server: flush first
+
+    def __len__(self):
+        self.flush()
+        return super(BufferedDict, self).__len__()
+
+    def to_dict(self):
+        self.flush()
+        return super(BufferedDict, self).to_dict()
+
+    def scan(self, count=None, match=None):
+        self.flush()
+        return super(BufferedDict, self).scan(count=count, match=match)
+
+    def items(self):
+        self.flush()
+        return super(BufferedDict, self).items()
+
+    def keys(self):
+        self.flush()
+        return super(BufferedDict, self).keys()
+
+    def values(self):
+        self.flush()
+        return super(BufferedDict, self).values()
+
+    def to_numpy(self, dtype=None, key_dtype=None):
+        self.flush()
+        return super(BufferedDict, self).to_numpy(dtype, key_dtype)
+
+    def from_numpy(self, keys, values):
+        self.flush()
+        return super(BufferedDict, self).from_numpy(keys, values)
+
+    def incrby(self, key, value=1):
+        if _field(key) in self._writes:
+            self.flush()
+        return super(BufferedDict, self).incrby(key, value)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import atexit
+import select
+import socket
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import redis
+
+# Keyspace events needed to see every change to a hash or set:
+# K = keyspace channel, g = DEL/RENAME/EXPIRE..., h = hash, s = set,
+# x = expired, e = evicted
+KEYSPACE_EVENTS = "Kghsxe"
+
+# Cache entry holding the structure length
+LENGTH = ("__len__",)
+
+# Whether the first near cache on a server adds the missing KEYSPACE_EVENTS to
+# its configuration. When False, a server without them is an error.
+ENABLE_KEYSPACE_EVENTS = True
+
+
+class LRUCache(object):
+    """
+    Bounded in-process LRU used as a near cache in front of one structure.
+
+    Every invalidation bumps the generation. Readers take the generation
+    before going to the server and store the answer only if it did not
+    change meanwhile, so a reply that raced with a write is never cached.
+    """
+    def __init__(self, maxsize=1024):
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def lookup(self, key):
+        """
+        Return a (found, value) tuple. Found entries become the most recently used.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self._data[key] = value
+            self.hits += 1
+            return True, value
+
+    def store(self, key, value, generation):
+        """
+        Cache value unless the cache was invalidated after generation was read.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """
+        Drop every cached entry.
+        """
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._data.clear()
+
+    def stats(self):
+        """
+        Return a dict with hits, misses, evictions, invalidations and current size.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+
+def enable_keyspace_events(connection, events=KEYSPACE_EVENTS):
+    """
+    CONFIG SET notify-keyspace-events
+
+    Add the flags in events to the server configuration, keeping the ones already set.
+    """
+    current = connection.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+    missing = "".join([flag for flag in events if flag not in current])
+    if missing:
+        connection.config_set("notify-keyspace-events", current + missing)
+
+
+def check_keyspace_events(connection, enable=None):
+    """
+    CONFIG GET notify-keyspace-events
+
+    Make sure the server publishes the KEYSPACE_EVENTS near caches rely on,
+    adding them if enable (ENABLE_KEYSPACE_EVENTS by default). Raises
+    RuntimeError if they are missing, or if the configuration cannot be read
+    or changed: cached values would never be invalidated.
+    """
+    enable = ENABLE_KEYSPACE_EVENTS if enable is None else enable
+    try:
+        current = connection.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        missing = [flag for flag in KEYSPACE_EVENTS if flag not in current]
+        if missing and enable:
+            enable_keyspace_events(connection)
+            return
+    except redis.exceptions.ResponseError, e:
+        raise RuntimeError("near cache: cannot configure notify-keyspace-events (%s), set it to "
+                           "%r on the server" % (e, KEYSPACE_EVENTS))
+    if missing:
+        raise RuntimeError("near cache: notify-keyspace-events is %r, it needs %r" % (current, KEYSPACE_EVENTS))
+
+
+class _InvalidatorPubSub(redis.client.PubSub):
+    def __init__(self, invalidator, *args, **kwargs):
+        super(_InvalidatorPubSub, self).__init__(*args, **kwargs)
+        self.invalidator = invalidator
+
+    def on_connect(self, connection):
+        # redis-py reconnects and resubscribes on its own. Events may have
+        # been lost while we were away, so nothing cached can be trusted.
+        self.invalidator.invalidate_all()
+        super(_InvalidatorPubSub, self).on_connect(connection)
+
+
+class KeyspaceInvalidator(object):
+    """
+    Subscribes to the keyspace channel of every cached key and drops the
+    near caches of a key whenever any client changes it. The channel of a key
+    is unsubscribed once none of its caches is left.
+    """
+    poll_timeout = 0.05
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.db = connection.connection_pool.connection_kwargs.get("db", 0)
+        self.pubsub = _InvalidatorPubSub(self, connection.connection_pool,
+                                         ignore_subscribe_messages=True)
+        self._caches = {}  # channel -> weak references to the caches of that key
+        self._released = [] # channels that lost a cache, appended by weakref callbacks
+        self._lock = threading.Lock() # of the pubsub connection and _caches
+        self._thread = None
+        self.stopped = False # set at exit: an attribute, still readable once the module is torn down
+
+    def channel(self, pk):
+        return "__keyspace@%s__:%s" % (self.db, pk)
+
+    def register(self, pk, cache):
+        """
+        Start invalidating cache on changes to the key pk.
+        The first registration checks the server configuration, see check_keyspace_events().
+        """
+        channel = self.channel(pk)
+        with self._lock:
+            if self._thread is None:
+                check_keyspace_events(self.connection)
+            if channel not in self._caches:
+                self._caches[channel] = []
+                self.pubsub.subscribe(channel)
+            if not any(ref() is cache for ref in self._caches[channel]):
+                # no lock in the callback: it may run during a collection in any thread
+                self._caches[channel].append(
+                    weakref.ref(cache, lambda ref, channel=channel: self._released.append(channel)))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="datastore-invalidator")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _invalidate(self, refs):
+        for ref in list(refs):
+            cache = ref()
+            if cache is not None:
+                cache.invalidate()
+
+    def invalidate_all(self):
+        for refs in self._caches.values():
+            self._invalidate(refs)
+
+    def _dispatch(self, message):
+        if message is None or message["type"] != "message":
+            return
+        refs = self._caches.get(message["channel"])
+        if refs:
+            self._invalidate(refs)
+
+    def _unsubscribe_released(self):
+        released = set()
+        while self._released:
+            released.add(self._released.pop())
+        with self._lock:
+            unused = []
+            for channel in released:
+                if channel in self._caches:
+                    refs = [ref for ref in self._caches[channel] if ref() is not None]
+                    if refs:
+                        self._caches[channel] = refs
+                    else:
+                        del self._caches[channel]
+                        unused.append(channel)
+            if unused:
+                self.pubsub.unsubscribe(*unused)
+
+    def _wait(self):
+        """
+        Wait up to poll_timeout for the pubsub socket to be readable, without the lock.
+        """
+        connection = self.pubsub.connection
+        if connection is not None and connection._sock is not None and connection._parser.can_read():
+            return # already read from the socket, not parsed yet
+        sock = connection._sock if connection is not None else None
+        if sock is None: # reconnected by the next get_message()
+            time.sleep(self.poll_timeout)
+            return
+        try:
+            select.select([sock], [], [], self.poll_timeout)
+        except (select.error, socket.error, ValueError): # closed meanwhile
+            pass
+
+    def _run(self):
+        while not self.stopped:
+            try:
+                if self._released:
+                    self._unsubscribe_released()
+                # the lock is only held to read what is already there, so that
+                # register() is never kept waiting for the poll timeout
+                with self._lock:
+                    message = self.pubsub.get_message()
+                if message is None:
+                    self._wait()
+                else:
+                    self._dispatch(message)
+            except redis.exceptions.ConnectionError:
+                self.invalidate_all()
+                time.sleep(self.poll_timeout)
+
+
+_invalidators = {}
+_invalidators_lock = threading.Lock()
+
+
+@atexit.register
+def _stop_invalidators():
+    for invalidator in _invalidators.values():
+        invalidator.stopped = True
+
+
+def get_invalidator(connection):
+    """
+    Return the invalidator shared by every structure using the connection pool.
+    """
+    pool = connection.connection_pool
+    with _invalidators_lock:
+        invalidator = _invalidators.get(id(pool))
+        if invalidator is None or invalidator.connection.connection_pool is not pool:
+            invalidator = KeyspaceInvalidator(connection)
+            _invalidators[id(pool)] = invalidator
+        return invalidator
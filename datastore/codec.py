@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Value codecs. A structure created with codec=... encodes the values it writes
+and decodes the values it reads, so they come back with their original type
+instead of as strings.
+"""
+import bz2
+import json
+import struct
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("numpy required")
+
+
+def _parse(text, count, dtype):
+    """
+    Parse count numbers separated by whitespace into an array of dtype, in one step.
+    """
+    array = numpy.fromstring(text, dtype=dtype, sep=" ")
+    if len(array) != count or len(text.split()) != count: # each value exactly one number
+        raise ValueError("not a list of %s numbers" % numpy.dtype(dtype))
+    return array
+
+
+class Codec(object):
+    """
+    Base codec: values are written as redis-py writes them and read back as strings.
+    """
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return data
+
+    def encode_array(self, array):
+        """
+        Encode the elements of a numpy array, returning the list of stored values.
+        """
+        values = array.tolist() if hasattr(array, "tolist") else array
+        return [self.encode(value) for value in values]
+
+    def decode_array(self, values, dtype=None):
+        """
+        Decode a list of stored values into a numpy array of dtype (float64 when None).
+        """
+        _require_numpy()
+        return numpy.array([self.decode(data) for data in values], dtype=dtype)
+
+    def joins(self, dtype=None):
+        """
+        Whether arrays of dtype are read from the values joined by spaces,
+        with decode_joined(): one string to transfer and parse.
+        """
+        return False
+
+
+class Text(Codec):
+    """
+    Values stored as text: numbers decode into arrays in one vectorized parse.
+    """
+    def decode_array(self, values, dtype=None):
+        if self.joins(dtype):
+            return _parse(" ".join(values), len(values), dtype)
+        return numpy.array(values, dtype=dtype)
+
+    def joins(self, dtype=None):
+        _require_numpy()
+        return numpy.dtype(dtype).kind in "iuf"
+
+    def decode_joined(self, text, count, dtype=None):
+        """
+        Decode count numbers joined by spaces into an array of dtype (float64 when None).
+        """
+        return _parse(text, count, dtype)
+
+
+class Raw(Text):
+    """
+    Strings in, strings out. The default.
+    """
+
+
+class Integer(Text):
+    """
+    Decimal text, so HINCRBY and friends keep working on the stored values.
+    """
+    def encode(self, value):
+        return "%d" % value
+
+    def decode(self, data):
+        return int(data)
+
+
+class Float(Text):
+    """
+    Shortest text that reads back as the same float. HINCRBYFLOAT keeps working.
+    """
+    def encode(self, value):
+        return repr(float(value))
+
+    def decode(self, data):
+        return float(data)
+
+
+class Json(Codec):
+    """
+    Compact JSON with sorted keys, so equal values encode equally (Set members).
+    """
+    def encode(self, value):
+        return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class Msgpack(Codec):
+    """
+    MessagePack binary encoding. Requires the msgpack package.
+    """
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def encode(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class Struct(Codec):
+    """
+    Fixed size binary records packed with the struct module format fmt.
+    Values are tuples, or instances of record (a namedtuple class, for example)
+    when given. Single field formats encode and decode plain values.
+    Decoding reads the reply through a memoryview, without copying it.
+    """
+    def __init__(self, fmt, record=None):
+        self.struct = struct.Struct(fmt)
+        self.record = record
+        self.single = len(self.struct.unpack("\0" * self.struct.size)) == 1
+
+    def encode(self, value):
+        if self.single:
+            return self.struct.pack(value)
+        return self.struct.pack(*value)
+
+    def decode(self, data):
+        values = self.struct.unpack_from(memoryview(data))
+        if self.single:
+            return values[0]
+        return self.record(*values) if self.record else values
+
+
+class NumpyArray(Codec):
+    """
+    numpy arrays of dtype packed as their raw bytes, a whole array per value.
+    Decoding is numpy.frombuffer on the reply, without copying or parsing it:
+    the arrays returned are read-only. Arrays are flat, or of shape when given.
+    dtype should give the byte order ("<f8") when other machines read them.
+    Requires numpy.
+    """
+    def __init__(self, dtype, shape=None):
+        _require_numpy()
+        self.dtype = numpy.dtype(dtype)
+        self.shape = tuple(shape) if shape is not None else None
+
+    def encode(self, value):
+        return numpy.ascontiguousarray(value, dtype=self.dtype).tobytes()
+
+    def decode(self, data):
+        array = numpy.frombuffer(data, dtype=self.dtype)
+        return array.reshape(self.shape) if self.shape is not None else array
+
+    def encode_array(self, array):
+        """
+        The rows of a numpy array, each packed as one value.
+        """
+        array = numpy.ascontiguousarray(array, dtype=self.dtype)
+        return [row.tobytes() for row in array]
+
+    def decode_array(self, values, dtype=None):
+        """
+        Stack the arrays of values as the rows of one array, converted to dtype when given.
+        """
+        shape = self.shape if self.shape is not None else (-1,)
+        if not values:
+            array = numpy.empty((0,) + (self.shape if self.shape is not None else (0,)), dtype=self.dtype)
+        else:
+            array = numpy.frombuffer("".join(values), dtype=self.dtype).reshape((len(values),) + shape)
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+
+class Compressed(Codec):
+    """
+    Compress what codec encodes when it is at least threshold bytes long.
+    Compressed values start with MAGIC and a byte telling the method, so any
+    method can be read back; the others are stored as codec encodes them, so
+    small numbers still work with HINCRBY and the values written before
+    compression was enabled are still read. A plain value starting with MAGIC,
+    unlikely, is stored escaped with the PLAIN method byte.
+
+    method is "zlib", "bz2" or "lzma" (Python 2 needs the backports.lzma package for it).
+    stats() reports the compression achieved by this instance.
+    """
+    MAGIC = "\x00\xffZ"
+    PLAIN = "\x00"
+    METHODS = {
+        "zlib": ("\x01", lambda data, level: zlib.compress(data, level), zlib.decompress),
+        "bz2": ("\x02", lambda data, level: bz2.compress(data, level), bz2.decompress),
+    }
+    if lzma is not None:
+        METHODS["lzma"] = ("\x03", lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+
+    def __init__(self, codec=None, method="zlib", threshold=1024, level=6):
+        if method not in self.METHODS:
+            raise ValueError("unknown compression method %s" % method)
+        self.codec = codec or RAW
+        self.marker, self.compress, decompress = self.METHODS[method]
+        self.decompressors = dict((marker, d) for marker, c, d in self.METHODS.values())
+        self.threshold = threshold
+        self.level = level
+        self._lock = threading.Lock()
+        self.values = 0
+        self.compressed = 0
+        self.input_bytes = 0
+        self.stored_bytes = 0
+
+    def encode(self, value):
+        data = self.codec.encode(value)
+        data = data.encode("utf-8") if isinstance(data, unicode) else str(data)
+        stored = self.MAGIC + self.PLAIN + data if data.startswith(self.MAGIC) else data
+        compressed = False
+        if len(data) >= self.threshold:
+            candidate = self.MAGIC + self.marker + self.compress(data, self.level)
+            if len(candidate) < len(stored):
+                stored, compressed = candidate, True
+        with self._lock:
+            self.values += 1
+            self.compressed += compressed
+            self.input_bytes += len(data)
+            self.stored_bytes += len(stored)
+        return stored
+
+    def decode(self, data):
+        if not data.startswith(self.MAGIC):
+            return self.codec.decode(data)
+        start = len(self.MAGIC)
+        marker = data[start:start + 1]
+        if marker == self.PLAIN:
+            return self.codec.decode(data[start + 1:])
+        try:
+            decompress = self.decompressors[marker]
+        except KeyError:
+            raise ValueError("unknown compression method byte %r" % marker)
+        return self.codec.decode(decompress(data[start + 1:]))
+
+    def stats(self):
+        """
+        Return the number of values encoded and compressed, the bytes before and 
+        after and their ratio.
+        """
+        with self._lock:
+            return {
+                "values": self.values,
+                "compressed": self.compressed,
+                "input_bytes": self.input_bytes,
+                "stored_bytes": self.stored_bytes,
+                "ratio": float(self.input_bytes) / self.stored_bytes if self.stored_bytes else 1.0,
+            }
+
+
+RAW = Raw()
+INTEGER = Integer()
+FLOAT = Float()
+JSON = Json()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write-behind counters: Dict.incrby() calls added up in process, per Dict and
+field, and written together in one transaction per connection instead of one
+HINCRBY per call.
+
+    hits = Dict(name="hits", write_behind=True)
+    hits.incrby("home")                 # nothing sent yet
+    hits.flush()                        # or wait for a threshold
+
+Pending increments are written when max_pending fields are pending, every
+interval seconds from a background thread, at exit, and on flush(). A crash
+loses at most the increments of the last interval, of up to max_pending fields.
+Reads do not see pending increments: flush() first for exact values.
+
+If the connection fails during a flush the increments are pending again and
+retried with the next one. A flush whose reply is lost after the server ran it
+is retried as well: counters may then count twice, never lose.
+"""
+import atexit
+import os
+import threading
+import time
+import weakref
+
+import redis
+
+import scripts
+
+MAX_PENDING = 10000 # fields pending before a flush
+INTERVAL = 1.0 # seconds between background flushes
+
+_buffers = weakref.WeakSet()
+_default = None
+_default_lock = threading.Lock()
+
+
+class CounterBuffer(object):
+    """
+    Increments pending for any number of Dicts. Thread safe. Accepts max_pending,
+    the number of fields pending that triggers a flush, and interval, the seconds
+    between flushes of the background thread (none when 0).
+
+    After a fork the child drops the increments inherited from its parent,
+    which flushes them.
+    """
+    def __init__(self, max_pending=MAX_PENDING, interval=INTERVAL):
+        self.max_pending = max_pending
+        self.interval = interval
+        self.flushes = 0
+        self.dropped = 0 # increments of fields holding something else than a number
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # one flush at a time, so a retry is not overtaken
+        # Keyed by connection too: Dicts of the same name on different servers or dbs are different counters
+        self._pending = {} # (id of the connection, pk, field): total
+        self._structures = {} # (id of the connection, pk): Dict
+        self._pid = os.getpid()
+        self._thread = None
+        self.stopped = False # set at exit: an attribute, still readable once the module is torn down
+        _buffers.add(self)
+
+    def pending(self):
+        """
+        Return the number of fields with pending increments.
+        """
+        with self._lock:
+            self._check_fork()
+            return len(self._pending)
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = {}
+            self._structures = {}
+            self._thread = None
+
+    def add(self, structure, field, value):
+        """
+        Add value to the pending increment of field of the Dict structure.
+        Flushes, raising as flush(), once max_pending fields are pending.
+        """
+        target = (id(structure.connection), structure.pk)
+        with self._lock:
+            self._check_fork()
+            key = target + (field,)
+            self._pending[key] = self._pending.get(key, 0) + value
+            self._structures[target] = structure
+            full = len(self._pending) >= self.max_pending
+            if self._thread is None and self.interval:
+                self._thread = threading.Thread(target=self._run, name="datastore-counters")
+                self._thread.daemon = True
+                self._thread.start()
+        if full:
+            self.flush()
+
+    def _take(self):
+        with self._lock:
+            self._check_fork()
+            pending, structures = self._pending, self._structures
+            self._pending, self._structures = {}, {}
+        return pending, structures
+
+    def _restore(self, pending, structures):
+        with self._lock:
+            for key, value in pending.iteritems():
+                self._pending[key] = self._pending.get(key, 0) + value
+            for target, structure in structures.iteritems():
+                self._structures.setdefault(target, structure)
+
+    def flush(self):
+        """
+        MULTI
+        HINCRBY
+        HINCRBYFLOAT
+        EXEC
+
+        Write the pending increments, one transaction per connection, and return
+        how many fields were written. Raises the ConnectionError of a failed
+        connection once the others are written; its increments stay pending.
+        Raises TypeError if fields held something else than a number: their
+        increments are dropped.
+        """
+        with self._flush_lock:
+            pending, structures = self._take()
+            if not pending:
+                return 0
+            groups = {}
+            for (connection_id, pk, field), value in pending.iteritems():
+                target = (connection_id, pk)
+                connection = structures[target].connection
+                groups.setdefault(connection, {}).setdefault(target, []).append((field, value))
+
+            written = 0
+            failed = []
+            error = None
+            for connection, fields_by_target in groups.iteritems():
+                pipe = connection.pipeline()
+                positions = [] # (key, index of its reply)
+                for target, fields in fields_by_target.iteritems():
+                    pk = target[1]
+                    for field, value in fields:
+                        positions.append((target + (field,), len(pipe.command_stack)))
+                        if isinstance(value, float):
+                            pipe.hincrbyfloat(pk, field, value)
+                        else:
+                            pipe.hincrby(pk, field, value)
+                    structures[target]._queue_expiry(pipe)
+                try:
+                    replies = scripts.execute(pipe, raise_on_error=False)
+                except redis.exceptions.ConnectionError, e:
+                    self._restore(dict((key, pending[key]) for key, index in positions),
+                                  dict((target, structures[target]) for target in fields_by_target))
+                    error = e
+                    continue
+                for key, index in positions:
+                    if isinstance(replies[index], redis.exceptions.ResponseError):
+                        failed.append(key[1:])
+                    else:
+                        written += 1
+                for target in fields_by_target:
+                    structures[target]._invalidate_cache()
+            self.flushes += 1
+            self.dropped += len(failed)
+        if error is not None:
+            raise error
+        if failed:
+            raise TypeError("values of %s must be int or float" % ", ".join("%s[%r]" % key for key in failed))
+        return written
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.stopped:
+                return
+            try:
+                self.flush()
+            except (redis.exceptions.RedisError, TypeError): # retried next time, or counted in dropped
+                pass
+
+
+def get_buffer():
+    """
+    Return the CounterBuffer of the Dicts created with write_behind=True.
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = CounterBuffer()
+        return _default
+
+
+def flush_all():
+    """
+    Flush every CounterBuffer. Runs at exit. Raises the first error once every
+    buffer was flushed.
+    """
+    error = None
+    for buffer in list(_buffers):
+        try:
+            buffer.flush()
+        except (redis.exceptions.RedisError, TypeError), e:
+            error = error or e
+    if error is not None:
+        raise error
+
+
+@atexit.register
+def _exit():
+    for buffer in list(_buffers):
+        buffer.stopped = True
+    flush_all()
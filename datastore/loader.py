@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk loading of Dicts, Sets and Lists from CSV or JSON lines files.
+
+    loader.load(Dict(name="prices"), "prices.csv.gz", key="sku", value="price", header=True)
+
+    python loader.py --type dict --name prices --key sku --value price --header prices.csv.gz
+
+The input is streamed and cut into chunks of chunk_size rows, which a pool of
+processes parses, encodes and writes, one pipeline per chunk, into a staging
+key. Once everything is loaded the staging key replaces the structure in one
+atomic step (RENAME): readers see the old content until then, never a
+partial load, and a failed load leaves the structure as it was.
+
+Rows are lists (CSV, or CSV with header as dicts) or the values of JSON lines.
+key and value are the column index or name of each row to store, or ROW for
+the whole row, encoded by the structure codec (CSV fields are parsed first
+with the Integer and Float codecs). Dicts take key and value
+(columns 0 and 1 by default), Sets and Lists value (column 0 by default).
+Lists keep the order of the file. When a Dict key appears several times with
+more than one process, which row wins is undefined.
+"""
+import argparse
+import collections
+import csv
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+import redis
+
+import codec
+import registry
+import scripts
+from structs import VERSIONS, Dict, List, Set
+
+CHUNK_SIZE = 10000 # rows per pipeline
+PROCESSES = multiprocessing.cpu_count()
+WINDOW = 2 # chunks in flight per process, bounding the memory used
+STAGING_TTL = 86400 # seconds, for the staging key of a load that died
+ROW = "*"
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl"}
+CODECS = {"raw": codec.RAW, "integer": codec.INTEGER, "float": codec.FLOAT, "json": codec.JSON}
+
+_settings = {} # of the load running in this process
+
+
+def _kind(structure):
+    for cls, kind in ((Dict, "dict"), (Set, "set"), (List, "list")):
+        if isinstance(structure, cls):
+            return kind
+    raise TypeError("only a Dict, Set or List can be loaded")
+
+
+def _open(path):
+    """
+    Open path, decompressing .gz files. Returns the file and its format from its extension.
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    f = gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+    return f, FORMATS.get(os.path.splitext(name)[1].lower())
+
+
+def _chunks(rows, size):
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _connection_spec(structure):
+    """
+    What a worker needs to connect as structure: its registry connection name,
+    or the settings of its client's pool.
+    """
+    spec = structure._connection_spec()
+    if isinstance(spec, basestring):
+        return spec
+    pool = spec.connection_pool
+    return dict(pool.connection_kwargs, connection_class=pool.connection_class)
+
+
+def _init(settings):
+    _settings.clear()
+    _settings.update(settings)
+
+
+def _client():
+    if "client" not in _settings:
+        spec = _settings["connection"]
+        _settings["client"] = registry.get_connection(spec) if isinstance(spec, basestring) else \
+            redis.Redis(connection_pool=redis.ConnectionPool(**spec))
+    return _settings["client"]
+
+
+def _pick(row, column):
+    if column == ROW:
+        return row
+    try:
+        return row[column]
+    except (IndexError, KeyError, TypeError):
+        raise ValueError("no column %r in row %r" % (column, row))
+
+
+def _load_chunk(rows):
+    """
+    Parse, encode and write a chunk of rows to the staging key. Runs in the workers.
+    Returns the number of rows and, for a List, the encoded values, pushed in
+    order by the parent.
+    """
+    s = _settings
+    if s["format"] == "jsonl":
+        rows = [json.loads(row) for row in rows]
+    elif s["columns"]:
+        rows = [dict(zip(s["columns"], row)) for row in rows]
+    encode = s["codec"].encode
+    if s["format"] == "csv" and isinstance(s["codec"], codec.Text): # numbers arrive as text
+        decode = s["codec"].decode
+        encode = lambda value: s["codec"].encode(decode(value)) if isinstance(value, basestring) else \
+            s["codec"].encode(value)
+    if s["kind"] == "list":
+        return len(rows), [encode(_pick(row, s["value"])) for row in rows]
+    pipe = _client().pipeline(transaction=False)
+    if s["kind"] == "dict":
+        pipe.hmset(s["staging"], dict((_pick(row, s["key"]), encode(_pick(row, s["value"]))) for row in rows))
+    else:
+        pipe.sadd(s["staging"], *[encode(_pick(row, s["value"])) for row in rows])
+    pipe.expire(s["staging"], STAGING_TTL)
+    pipe.execute()
+    return len(rows), None
+
+
+def load(structure, source, format=None, key=0, value=None, header=False, chunk_size=CHUNK_SIZE,
+         processes=PROCESSES, progress=None):
+    """
+    Replace the content of the Dict, Set or List structure by the rows of source,
+    a path (.gz files are decompressed) or a file object. format is "csv" or
+    "jsonl", from the file extension by default. With header, the first CSV row
+    names the columns. processes 0 or 1 loads in this process.
+    progress(rows) is called with the rows loaded so far after each chunk.
+
+    Returns {"rows", "chunks", "seconds", "rows_per_second"}.
+    """
+    kind = _kind(structure)
+    start = time.time()
+    if isinstance(source, basestring):
+        f, detected = _open(source)
+    else:
+        f, detected = source, None
+    format = format or detected
+    if format not in ("csv", "jsonl"):
+        raise ValueError("unknown format %r: csv or jsonl" % (format,))
+
+    if format == "csv":
+        rows = csv.reader(f)
+        columns = next(rows, None) if header else None
+    else:
+        rows = (line for line in f if line.strip())
+        columns = None
+    if value is None:
+        value = 1 if kind == "dict" else 0
+    staging = "%s:loading:%s" % (structure.pk, uuid.uuid4().hex)
+    settings = {"kind": kind, "format": format, "columns": columns, "key": key, "value": value,
+                "codec": structure.codec, "staging": staging, "connection": _connection_spec(structure)}
+
+    structure._flush()
+    connection = structure.connection
+    pool = multiprocessing.Pool(processes, _init, (settings,)) if processes > 1 else None
+    if pool is None:
+        _init(settings)
+    loaded = [0, 0] # rows, chunks
+
+    def collect(result):
+        count, values = result.get() if pool is not None else result
+        if values:
+            pipe = connection.pipeline(transaction=False)
+            pipe.rpush(staging, *values)
+            pipe.expire(staging, STAGING_TTL)
+            pipe.execute()
+        loaded[0] += count
+        loaded[1] += 1
+        if progress is not None:
+            progress(loaded[0])
+
+    try:
+        try:
+            pending = collections.deque()
+            for chunk in _chunks(rows, chunk_size):
+                if pool is None:
+                    collect(_load_chunk(chunk))
+                    continue
+                pending.append(pool.apply_async(_load_chunk, (chunk,)))
+                if len(pending) >= processes * WINDOW:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+        finally:
+            # stop the workers first: one still running could write the staging key again
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if isinstance(source, basestring):
+                f.close()
+    except Exception:
+        connection.delete(staging)
+        raise
+
+    keys = [staging, structure.pk] + ([VERSIONS] if kind == "set" else [])
+    structure._script(scripts.LOAD_SWAP, keys, [])
+    structure._invalidate_cache()
+    seconds = time.time() - start
+    return {"rows": loaded[0], "chunks": loaded[1], "seconds": seconds,
+            "rows_per_second": loaded[0] / seconds if seconds else 0.0}
+
+
+def _column(argument):
+    return int(argument) if argument.isdigit() else argument
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load a CSV or JSON lines file into a redis Dict, Set or List, "
+                                                 "replacing its content.")
+    parser.add_argument("source", help="input file, .gz files are decompressed")
+    parser.add_argument("--type", required=True, choices=["dict", "set", "list"])
+    parser.add_argument("--name", required=True, help="name of the structure")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="from the file extension by default")
+    parser.add_argument("--key", type=_column, default=0, help="column of the Dict keys, index or name")
+    parser.add_argument("--value", type=_column, help="column of the values, index or name, %s for the row" % ROW)
+    parser.add_argument("--header", action="store_true", help="the first CSV row names the columns")
+    parser.add_argument("--codec", choices=sorted(CODECS), default="raw")
+    parser.add_argument("--url", help="redis URL, the default registry connection otherwise")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--processes", type=int, default=PROCESSES)
+    args = parser.parse_args(argv)
+
+    if args.url:
+        registry.configure(url=args.url)
+    structure_class = {"dict": Dict, "set": Set, "list": List}[args.type]
+    structure = structure_class(name=args.name, codec=CODECS[args.codec])
+    last = [time.time()]
+    def progress(rows):
+        if time.time() - last[0] >= 1:
+            last[0] = time.time()
+            sys.stderr.write("%d rows\n" % rows)
+    result = load(structure, args.source, format=args.format, key=args.key, value=args.value, header=args.header,
+                  chunk_size=args.chunk_size, processes=args.processes, progress=progress)
+    print "%d rows in %d chunks, %.1f s, %.0f rows/s" % (
+        result["rows"], result["chunks"], result["seconds"], result["rows_per_second"])
+
+
+if __name__ == "__main__":
+    main()
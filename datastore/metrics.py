@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the structure methods.
+
+    metrics.enable()
+    ...
+    metrics.REGISTRY.snapshot()
+
+Once enabled, every call of a structure method (any RedisDataStructure
+subclass imported by then, and SetExpression) and every batch execution records the redis commands sent, the request and response
+bytes, the round trips and their pipeline sizes, and the latency, tagged with
+the structure type, the key namespace and the method. Inherited methods are
+tagged with the class of the instance they are called on. Calls made by a method
+on other structures are part of the outer call. Generators (scan, iteration)
+are measured while they are consumed.
+
+Hooks added with add_hook() receive every finished Call, to forward them to
+statsd, logs, etc.
+
+Nothing is measured until enable() is called: it installs the wrappers, and
+disable() removes them, so that a disabled process runs the plain methods.
+"""
+import bisect
+import functools
+import threading
+import time
+import types
+
+import redis
+
+from batch import Batch
+from structs import RedisDataStructure, SetExpression
+
+STRUCTURES = [SetExpression] # instrumented besides the RedisDataStructure classes
+SPECIAL_METHODS = ["__getitem__", "__setitem__", "__delitem__", "__contains__", "__len__", "__iter__"]
+
+# Upper bounds of the histogram buckets, the last one collects the rest
+LATENCY_BUCKETS = [0.00005 * 2 ** i for i in range(18)] # 50us to 6.5s
+PIPELINE_BUCKETS = [2 ** i for i in range(13)] # 1 to 4096 commands
+
+_local = threading.local()
+_hooks = []
+_original = {}
+
+# The connection methods, as imported: the wrappers call them even while disable() runs
+_PACK_COMMAND = redis.Connection.__dict__["pack_command"]
+_SEND_PACKED_COMMAND = redis.Connection.__dict__["send_packed_command"]
+_READ_RESPONSE = redis.Connection.__dict__["read_response"]
+
+
+def namespace(pk):
+    """
+    The namespace of a key: what comes before its first ":", "" if none.
+    Replace with metrics.namespace = function to tag differently.
+    """
+    head, separator, tail = pk.partition(":")
+    return head if separator else ""
+
+
+def resp_size(reply):
+    """
+    Size of reply in the redis protocol. Status replies are counted as bulk strings.
+    """
+    if reply is None:
+        return 5
+    if isinstance(reply, (int, long)):
+        return len(str(reply)) + 3
+    if isinstance(reply, list):
+        return len(str(len(reply))) + 3 + sum(resp_size(r) for r in reply)
+    if isinstance(reply, Exception):
+        return len(str(reply)) + 3
+    return len(reply) + len(str(len(reply))) + 5
+
+
+class Histogram(object):
+    """
+    Counts of observations per bucket, with bounds the sorted upper limits.
+    """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the given fraction of the observations,
+        None when empty or in the last bucket.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        return {"bounds": self.bounds, "counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+
+class Call(object):
+    """
+    What one structure method call did.
+    """
+    def __init__(self, structure, namespace, method):
+        self.structure = structure
+        self.namespace = namespace
+        self.method = method
+        self.commands = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.pipelines = [] # commands sent in each round trip
+        self.elapsed = 0.0
+        self.error = None
+        self._unsent = 0
+
+
+class MethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.commands = 0
+        self.round_trips = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.pipeline_sizes = Histogram(PIPELINE_BUCKETS)
+
+    def add(self, call):
+        self.calls += 1
+        self.errors += call.error is not None
+        self.commands += call.commands
+        self.round_trips += len(call.pipelines)
+        self.request_bytes += call.request_bytes
+        self.response_bytes += call.response_bytes
+        self.latency.observe(call.elapsed)
+        for size in call.pipelines:
+            self.pipeline_sizes.observe(size)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "commands": self.commands,
+            "round_trips": self.round_trips,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "latency": self.latency.to_dict(),
+            "pipeline_sizes": self.pipeline_sizes.to_dict(),
+        }
+
+
+class MetricsRegistry(object):
+    """
+    MethodStats per (structure type, namespace, method).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def __call__(self, call):
+        key = (call.structure, call.namespace, call.method)
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = MethodStats()
+            stats.add(call)
+
+    def get(self, structure, namespace, method):
+        with self._lock:
+            return self.stats.get((structure, namespace, method))
+
+    def snapshot(self):
+        """
+        Return a list of dicts, one per tag combination, ready to be serialized.
+        """
+        with self._lock:
+            return [dict(stats.to_dict(), structure=structure, namespace=namespace, method=method)
+                    for (structure, namespace, method), stats in sorted(self.stats.iteritems())]
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+
+REGISTRY = MetricsRegistry()
+
+
+def add_hook(hook):
+    """
+    Call hook(call) with every finished Call.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def enabled():
+    return bool(_original)
+
+
+def structures():
+    """
+    Return the classes whose methods are measured: RedisDataStructure, its
+    subclasses in every module imported so far, and STRUCTURES.
+    """
+    classes = []
+    pending = [RedisDataStructure]
+    while pending:
+        cls = pending.pop(0)
+        if cls not in classes:
+            classes.append(cls)
+            pending.extend(cls.__subclasses__())
+    return classes + [cls for cls in STRUCTURES if cls not in classes]
+
+
+def enable():
+    """
+    Start measuring: wrap the structure methods and the redis connection I/O.
+    Classes defined after this call are not measured.
+    """
+    if _original:
+        return
+    for cls in structures():
+        for name, method in cls.__dict__.items():
+            if isinstance(method, types.FunctionType) and (not name.startswith("_") or name in SPECIAL_METHODS):
+                _original[(cls, name)] = method
+                setattr(cls, name, _instrumented(method))
+    _original[(Batch, "execute")] = Batch.__dict__["execute"]
+    Batch.execute = _instrumented_batch(Batch.__dict__["execute"])
+    for name, wrapper in [("pack_command", _pack_command),
+                          ("send_packed_command", _send_packed_command),
+                          ("read_response", _read_response)]:
+        _original[(redis.Connection, name)] = redis.Connection.__dict__[name]
+        setattr(redis.Connection, name, wrapper)
+
+
+def disable():
+    """
+    Stop measuring and restore the plain methods. Calls running meanwhile in
+    other threads finish with the wrappers.
+    """
+    global _original
+    original, _original = _original, {}
+    for (cls, name), method in original.items():
+        setattr(cls, name, method)
+
+
+def _begin(structure, namespace, method):
+    if getattr(_local, "call", None) is not None: # inner call, part of the outer one
+        return None
+    call = _local.call = Call(structure, namespace, method)
+    return call
+
+
+def _finish(call):
+    REGISTRY(call)
+    for hook in _hooks:
+        hook(call)
+
+
+def _measure(call, function, *args, **kwargs):
+    _local.call = call
+    start = time.time()
+    try:
+        return function(*args, **kwargs)
+    except Exception, e:
+        call.error = e
+        raise
+    finally:
+        call.elapsed += time.time() - start
+        _local.call = None
+
+
+def _iterate(call, iterator):
+    try:
+        while True:
+            try:
+                value = _measure(call, next, iterator)
+            except StopIteration:
+                call.error = None
+                return
+            yield value
+    finally:
+        _finish(call)
+
+
+def _pk(structure):
+    return structure.first.pk if isinstance(structure, SetExpression) else structure.pk
+
+
+def _instrumented(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        call = _begin(type(self).__name__, namespace(_pk(self)), method.__name__)
+        if call is None:
+            return method(self, *args, **kwargs)
+        try:
+            result = _measure(call, method, self, *args, **kwargs)
+        except Exception:
+            _finish(call)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return _iterate(call, result)
+        _finish(call)
+        return result
+    return wrapper
+
+
+def _instrumented_batch(execute):
+    @functools.wraps(execute)
+    def wrapper(self):
+        call = _begin("Batch", "", "execute")
+        if call is None:
+            return execute(self)
+        try:
+            return _measure(call, execute, self)
+        finally:
+            _finish(call)
+    return wrapper
+
+
+def _pack_command(self, *args):
+    output = _PACK_COMMAND(self, *args)
+    call = getattr(_local, "call", None)
+    if call is not None:
+        call.commands += 1
+        call._unsent += 1
+        call.request_bytes += sum(len(chunk) for chunk in output)
+    return output
+
+
+def _send_packed_command(self, command):
+    call = getattr(_local, "call", None)
+    if call is not None:
+        call.pipelines.append(call._unsent)
+        call._unsent = 0
+    return _SEND_PACKED_COMMAND(self, command)
+
+
+def _read_response(self):
+    call = getattr(_local, "call", None)
+    if call is None:
+        return _READ_RESPONSE(self)
+    try:
+        response = _READ_RESPONSE(self)
+    except redis.exceptions.ResponseError, e:
+        call.response_bytes += resp_size(e)
+        raise
+    call.response_bytes += resp_size(response)
+    return response
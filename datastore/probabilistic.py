@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Probabilistic structures: approximate answers in a fraction of the memory of
+the exact structures.
+
+BloomFilter answers membership like a Set, with false positives (never false
+negatives), in a bitmap whose size depends on the expected count and error
+rate only: about 1.2 bytes per element at 1%, whatever the elements.
+ScalableBloomFilter adds filters as it fills, when the count is not known upfront.
+"""
+import hashlib
+import math
+
+import scripts
+from batch import current_batch
+from structs import RedisDataStructure
+
+ERROR_RATE = 0.01
+BATCH_SIZE = 1000 # elements per script call in add_many and contains_many
+MAX_BITS = 2 ** 32 # a redis string holds at most 512MB
+
+# ScalableBloomFilter: each filter is GROWTH times larger than the previous one,
+# with TIGHTENING times its error rate, so the error rates sum under error_rate
+GROWTH = 2
+TIGHTENING = 0.8
+
+
+def bloom_size(capacity, error_rate):
+    """
+    Return (bits, hashes), the optimal bitmap size and number of hash functions
+    of a bloom filter holding capacity elements with the given false positive rate.
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+    return bits, hashes
+
+
+def max_capacity(error_rate, bits=MAX_BITS):
+    """
+    Return the capacity of the largest bloom filter of the given error rate fitting in bits.
+    """
+    return int(bits * math.log(2) ** 2 / -math.log(error_rate))
+
+
+def _digest(data):
+    """
+    Two 32 bits hashes of data, as 8 bytes. The BLOOM script combines them into
+    the positions of every hash function (Kirsch and Mitzenmacher): elements are
+    hashed once, client side, and sent as 8 bytes whatever the number of hashes.
+    """
+    return hashlib.md5(data).digest()[:8]
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for value in iterable:
+        chunk.append(value)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _queue(pipe, mode, filters, digests):
+    """
+    Queue the BLOOM script getting or setting the bits of digests in filters.
+    """
+    args = [mode]
+    for f in filters:
+        args.extend((f.bits, f.hashes))
+    args.append("".join(digests))
+    scripts.BLOOM.queue(pipe, [f.pk for f in filters], args)
+
+
+class BloomFilter(RedisDataStructure):
+    """
+    A set of elements that can only be added and tested: "element in filter"
+    is always True for an added element, and True with probability error_rate
+    for the others, as long as no more than capacity elements are added.
+
+    Stored in the bitmap "<name>", of bits bits (up to 2^32), where every element
+    sets hashes bits. Accepts capacity (required), error_rate (default 1%), and
+    name, connection, codec and ttl as the other structures. Every BloomFilter of
+    a name must be created with the same capacity and error_rate.
+    Elements are hashed encoded by the codec.
+
+    Redis allocates the bitmap up to the highest bit set: a large filter takes
+    its whole size with its first elements.
+    """
+    def __init__(self, *args, **kwargs):
+        if "cache_size" in kwargs and kwargs["cache_size"]:
+            raise ValueError("BloomFilter has no near cache")
+        super(BloomFilter, self).__init__(*args, **kwargs)
+        if not ("capacity" in kwargs and kwargs["capacity"]):
+            raise ValueError("capacity required")
+        self.capacity = kwargs["capacity"]
+        self.error_rate = kwargs["error_rate"] if "error_rate" in kwargs and kwargs["error_rate"] else ERROR_RATE
+        self.bits, self.hashes = bloom_size(self.capacity, self.error_rate)
+        if self.bits > MAX_BITS:
+            raise ValueError("%d bits needed, more than a redis string holds: lower the capacity "
+                             "or use a ScalableBloomFilter" % self.bits)
+        if args: # initial data
+            self.add_many(args[0])
+
+    def _run(self, elements, mode, single=False, pipe=None):
+        """
+        Run the BLOOM script on elements, return the list of flags or the only one if single.
+        pipe, the active batch or a new pipeline by default.
+        """
+        if not elements:
+            return []
+        pipe = pipe if pipe is not None else self._pipeline()
+        _queue(pipe, mode, [self], [_digest(self._encode(element)) for element in elements])
+        def transform(replies):
+            flags = [flag == "1" for flag in replies[0]]
+            return flags[0] if single else flags
+        return self._execute(pipe, transform, command="setbit" if mode == "SET" else "getbit")
+
+    def _run_many(self, elements, mode, batch_size):
+        if current_batch(self.connection) is not None: # all in the batch pipeline
+            return self._run(list(elements), mode)
+        flags = []
+        for chunk in _chunks(elements, batch_size or BATCH_SIZE):
+            flags.extend(self._run(chunk, mode))
+        return flags
+
+    def add(self, element):
+        """
+        SETBIT
+
+        Add element. Returns False if it was (probably) in the filter already.
+        """
+        return self._run([element], "SET", single=True)
+
+    def __contains__(self, element):
+        """
+        GETBIT
+        """
+        self._flush()
+        return self._run([element], "GET", single=True, pipe=self.connection.pipeline())
+
+    def add_many(self, elements, batch_size=None):
+        """
+        SETBIT
+
+        Add the elements of an iterable, in one script call per batch_size elements.
+        Returns the list of add() results.
+        """
+        return self._run_many(elements, "SET", batch_size)
+
+    def contains_many(self, elements, batch_size=None):
+        """
+        GETBIT
+
+        Test the elements of an iterable, in one script call per batch_size elements.
+        Returns the list of booleans.
+        """
+        return self._run_many(elements, "GET", batch_size)
+
+    def __len__(self):
+        """
+        BITCOUNT
+
+        Estimate of the number of elements added, from the share of bits set.
+        """
+        self._flush()
+        fraction = min(float(self.connection.bitcount(self.pk)) / self.bits, 1 - 1.0 / self.bits)
+        return int(round(-float(self.bits) / self.hashes * math.log(1 - fraction)))
+
+    def clear(self):
+        """
+        DEL
+        """
+        return self._command("delete", self.pk)
+
+
+class ScalableBloomFilter(RedisDataStructure):
+    """
+    A BloomFilter without a capacity limit (Almeida et al.): once the filter in
+    use holds its capacity, a new one is added, growth times larger and with a
+    lower error rate. Elements are tested against every filter and added to the
+    last one, and the false positive rate stays under error_rate overall.
+
+    The filters are the BloomFilters "<name>:<i>"; the hash "<name>" keeps their
+    number and counts. Accepts capacity (of the first filter, required),
+    error_rate, growth, and name, connection, codec and ttl as the other structures.
+    Not batched: calls in a batch execute it first.
+
+    Every call reads the number of filters, so that clients sharing the filter
+    see its growth. A filter may end up slightly over capacity when several
+    clients fill it at the same time.
+    """
+    def __init__(self, *args, **kwargs):
+        if "cache_size" in kwargs and kwargs["cache_size"]:
+            raise ValueError("ScalableBloomFilter has no near cache")
+        super(ScalableBloomFilter, self).__init__(*args, **kwargs)
+        if not ("capacity" in kwargs and kwargs["capacity"]):
+            raise ValueError("capacity required")
+        self.capacity = kwargs["capacity"]
+        self.error_rate = kwargs["error_rate"] if "error_rate" in kwargs and kwargs["error_rate"] else ERROR_RATE
+        self.growth = kwargs["growth"] if "growth" in kwargs and kwargs["growth"] else GROWTH
+        self.filters = []
+        self._count = 1 # filters seen by the last call
+        if args: # initial data
+            self.add_many(args[0])
+
+    def _filter(self, i):
+        while len(self.filters) <= i:
+            n = len(self.filters)
+            error_rate = self.error_rate * (1 - TIGHTENING) * TIGHTENING ** n
+            capacity = min(self.capacity * self.growth ** n, max_capacity(error_rate))
+            self.filters.append(BloomFilter(name="%s:%d" % (self.pk, n), capacity=capacity,
+                                            error_rate=error_rate, connection=self._connection_spec(),
+                                            codec=self.codec, ttl=self.expiry, sliding=self.sliding))
+        return self.filters[i]
+
+    def _lookup(self, digests):
+        """
+        HMGET
+        GETBIT
+
+        Return the number of filters, the count of the last one and, per digest,
+        whether a filter holds it. Repeated if the number of filters changed since the last call.
+        """
+        while True:
+            count = self._count
+            filters = [self._filter(i) for i in xrange(count)]
+            pipe = self.connection.pipeline(transaction=False)
+            pipe.hmget(self.pk, ["filters", "count:%d" % (count - 1)])
+            _queue(pipe, "GET", filters, digests)
+            for structure in [self] + filters:
+                structure._queue_expiry(pipe, "getbit")
+            replies = scripts.execute(pipe)
+            self._count = int(replies[0][0] or 1)
+            if self._count == count:
+                break
+        return count, int(replies[0][1] or 0), [flag == "1" for flag in replies[1]]
+
+    def _add_chunk(self, elements):
+        """
+        Add the elements missing from every filter to the last one, up to its
+        capacity, then to new filters.
+        """
+        digests = [_digest(self._encode(element)) for element in elements]
+        count, used, found = self._lookup(digests)
+        new = []
+        seen = set()
+        for digest, present in zip(digests, found):
+            new.append(not present and digest not in seen)
+            seen.add(digest)
+        added = [digest for digest, is_new in zip(digests, new) if is_new]
+        if not added:
+            return new
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.hsetnx(self.pk, "filters", 1)
+        self._queue_expiry(pipe)
+        while added:
+            last = self._filter(count - 1)
+            room = max(last.capacity - used, 0)
+            part, added = added[:room], added[room:]
+            if part:
+                pipe.hincrby(self.pk, "count:%d" % (count - 1), len(part))
+                _queue(pipe, "SET", [last], part)
+                last._queue_expiry(pipe)
+                used += len(part)
+            if used >= last.capacity: # full, the next elements go to a new filter
+                count += 1
+                used = 0
+                pipe.hset(self.pk, "filters", count) # the same count from every client filling it
+        scripts.execute(pipe)
+        self._count = count
+        return new
+
+    def add(self, element):
+        """
+        Add element. Returns False if it was (probably) in the filter already.
+        """
+        return self.add_many([element])[0]
+
+    def __contains__(self, element):
+        self._flush()
+        return self._lookup([_digest(self._encode(element))])[2][0]
+
+    def add_many(self, elements, batch_size=None):
+        """
+        Add the elements of an iterable, two round trips per batch_size elements.
+        Returns the list of add() results.
+        """
+        self._flush()
+        results = []
+        for chunk in _chunks(elements, batch_size or BATCH_SIZE):
+            results.extend(self._add_chunk(chunk))
+        return results
+
+    def contains_many(self, elements, batch_size=None):
+        """
+        Test the elements of an iterable, one round trip per batch_size elements.
+        Returns the list of booleans.
+        """
+        self._flush()
+        results = []
+        for chunk in _chunks(elements, batch_size or BATCH_SIZE):
+            results.extend(self._lookup([_digest(self._encode(element)) for element in chunk])[2])
+        return results
+
+    def __len__(self):
+        """
+        HGETALL
+
+        The number of elements added, as counted when they were added.
+        """
+        self._flush()
+        counts = self.connection.hgetall(self.pk)
+        return sum(int(v) for k, v in counts.iteritems() if k.startswith("count:"))
+
+    def _keys(self):
+        self._count = int(self.connection.hget(self.pk, "filters") or 1)
+        return [self.pk] + [self._filter(i).pk for i in xrange(self._count)]
+
+    def clear(self):
+        """
+        DEL the hash and every filter.
+        """
+        self._flush()
+        self.connection.delete(*self._keys())
+        self._count = 1
+
+    def expire(self, seconds):
+        """
+        EXPIRE the hash and every filter.
+        """
+        self._flush()
+        pipe = self.connection.pipeline(transaction=False)
+        for key in self._keys():
+            pipe.expire(key, seconds)
+        return any(pipe.execute())
+
+    def persist(self):
+        """
+        PERSIST the hash and every filter, and stop applying the ttl given on construction.
+        """
+        self._flush()
+        self.expiry = None
+        for f in self.filters:
+            f.expiry = None
+        pipe = self.connection.pipeline(transaction=False)
+        for key in self._keys():
+            pipe.persist(key)
+        return any(pipe.execute())
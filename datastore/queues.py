@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Work queues on lists: producers append() items at the tail, consumers take
+them from the head, blocking on the server until one is available instead
+of polling.
+
+    jobs = Queue(name="jobs")
+    jobs.append(job)                    # producers
+    job = jobs.get(timeout=5)           # consumers: None after 5s without a job
+    batch = jobs.get_many(100)          # up to 100 jobs in one round trip
+
+With reliable=True every item taken is moved, by the same command, to the
+processing list of the consumer, "<name>:processing:<consumer>", where it
+stays until ack(): the items of a consumer that dies are not lost, and
+recover() puts them back at the head of the queue.
+
+A blocking call holds its connection for up to timeout seconds: the client
+socket_timeout, if set, must be longer. Blocking reliable get() needs
+redis 6.2 (BLMOVE).
+"""
+import os
+import socket
+
+import scripts
+from structs import List
+
+
+class Queue(List):
+    """
+    A List consumed as a FIFO queue. Accepts reliable and consumer, the name of
+    the processing list of this consumer (host:pid of the current process by
+    default, so that a forked child has its own), plus the List arguments.
+    """
+    def __init__(self, *args, **kwargs):
+        super(Queue, self).__init__(*args, **kwargs)
+        self.reliable = bool(kwargs["reliable"]) if "reliable" in kwargs else False
+        self._consumer = kwargs["consumer"] if "consumer" in kwargs and kwargs["consumer"] else None
+        self._current = None # (consumer, its processing list)
+
+    @property
+    def consumer(self):
+        if self._consumer is not None:
+            return self._consumer
+        return "%s:%d" % (socket.gethostname(), os.getpid())
+
+    @property
+    def processing(self):
+        consumer = self.consumer
+        if self._current is None or self._current[0] != consumer: # first call, or first call after a fork
+            self._current = (consumer, self._processing(consumer))
+        return self._current[1]
+
+    def _processing(self, consumer):
+        return List(name="%s:processing:%s" % (self.pk, consumer), connection=self._connection_spec(),
+                    codec=self.codec)
+
+    def get(self, block=True, timeout=None):
+        """
+        BLPOP
+        BLMOVE (reliable)
+
+        Remove and return the item at the head of the queue. If block, wait up to
+        timeout seconds for one (forever when None or 0, as redis), else return None.
+        """
+        self._flush()
+        wait = timeout or 0
+        if self.reliable:
+            if block:
+                item = self.connection.execute_command("BLMOVE", self.pk, self.processing.pk,
+                                                       "LEFT", "RIGHT", wait)
+            else:
+                item = scripts.QUEUE_POP(self.connection, [self.pk, self.processing.pk], [1])
+                item = item[0] if item else None
+            return self._decode(item)
+        if block:
+            reply = self.connection.blpop([self.pk], wait)
+            return self._decode(reply[1]) if reply else None
+        return self._decode(self.connection.lpop(self.pk))
+
+    def _pop_many(self, count):
+        keys = [self.pk, self.processing.pk] if self.reliable else [self.pk]
+        return self._decode_all(scripts.QUEUE_POP(self.connection, keys, [count]))
+
+    def get_many(self, count, block=False, timeout=None):
+        """
+        LRANGE
+        LTRIM
+
+        Remove and return up to count items from the head of the queue, in one
+        round trip. If the queue is empty and block, wait up to timeout seconds
+        as get() for the first item, and take the others with it.
+        Returns a list, empty if there was no item.
+        """
+        self._flush()
+        items = self._pop_many(count)
+        if items or not block:
+            return items
+        first = self.get(timeout=timeout)
+        if first is None:
+            return []
+        return [first] + (self._pop_many(count - 1) if count > 1 else [])
+
+    def ack(self, item):
+        """
+        LREM
+
+        Acknowledge an item taken in reliable mode: remove it from the processing list.
+        Returns False if it was not there.
+        """
+        return self.processing._command("execute_command", "LREM", self.processing.pk, 1, self._encode(item),
+                                        transform=bool)
+
+    def ack_many(self, items):
+        """
+        LREM
+
+        Acknowledge items taken in reliable mode, in one round trip.
+        """
+        pipe = self.processing._pipeline()
+        for item in items:
+            pipe.execute_command("LREM", self.processing.pk, 1, self._encode(item))
+        return self.processing._execute(pipe, lambda replies: None)
+
+    def nack(self, item):
+        """
+        LREM
+        LPUSH
+
+        Give back an item taken in reliable mode: move it from the processing list
+        to the head of the queue, for another consumer. Returns False if it was
+        not in the processing list.
+        """
+        return self._script(scripts.QUEUE_REQUEUE, [self.pk, self.processing.pk], [self._encode(item)],
+                            transform=bool)
+
+    def recover(self, consumer=None):
+        """
+        Move the items left in the processing list of consumer (this one by default),
+        a consumer that stopped without acknowledging them, back to the head of the queue.
+        Returns how many.
+        """
+        processing = self.processing if consumer is None else self._processing(consumer)
+        return self._script(scripts.QUEUE_RECOVER, [self.pk, processing.pk], [])
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Named connections. A client is created from its configuration the first time
+it is used, and created again in a forked child (gunicorn and multiprocessing
+workers), which must not use the sockets it inherited from its parent.
+
+    registry.configure(url="redis://cache:6379/0", max_connections=50)
+    registry.configure("sessions", url="redis://sessions:6379/0", blocking=True, timeout=5)
+    registry.route("session:", "sessions")
+
+    Dict()                             # "default"
+    Dict(connection="sessions")        # "sessions"
+    Dict(name="session:42")            # "sessions", by its name prefix
+
+Structures given a connection name, or none, look the client up here on every
+call, so structures created before a fork work in the child. Structures given
+a client object keep using that client.
+"""
+import os
+import threading
+
+import redis
+
+DEFAULT = "default"
+
+_configs = {DEFAULT: {}}
+_routes = []
+_clients = {}
+_lock = threading.Lock()
+
+
+def configure(name=DEFAULT, url=None, max_connections=None, blocking=False, timeout=20, **connection_kwargs):
+    """
+    Set the configuration of the connection name: a redis URL or the keyword
+    arguments of redis.Redis (host, port, db, socket_timeout...), the pool size,
+    and whether the pool blocks up to timeout seconds for a free connection
+    instead of raising when all max_connections are in use.
+    A client already created for name is closed and created again on next use.
+    """
+    config = dict(connection_kwargs, url=url, max_connections=max_connections,
+                  blocking=blocking, timeout=timeout)
+    with _lock:
+        _configs[name] = config
+        entry = _clients.pop(name, None)
+    if entry is not None:
+        _release(entry)
+
+
+def load(config):
+    """
+    Apply a whole configuration, as read from a JSON or YAML file:
+
+        {"connections": {"default": {"url": "redis://localhost:6379/0", "max_connections": 20},
+                         "sessions": {"db": 2, "blocking": true}},
+         "routes": {"session:": "sessions"}}
+    """
+    for name, options in config.get("connections", {}).iteritems():
+        configure(name, **options)
+    for prefix, name in config.get("routes", {}).iteritems():
+        route(prefix, name)
+
+
+def route(prefix, name):
+    """
+    Use the connection name for the structures whose name starts with prefix
+    and that are not given a connection. The longest matching prefix wins.
+    """
+    with _lock:
+        _routes[:] = [(p, n) for p, n in _routes if p != prefix] + [(prefix, name)]
+        _routes.sort(key=lambda r: len(r[0]), reverse=True)
+
+
+def connection_name(pk):
+    """
+    Return the name of the connection routed to the structure named pk.
+    """
+    for prefix, name in _routes:
+        if pk.startswith(prefix):
+            return name
+    return DEFAULT
+
+
+def get_connection(name=DEFAULT):
+    """
+    Return the client of the connection name, creating it on first use in this process.
+    Raises KeyError if name was never configured.
+    """
+    entry = _clients.get(name)
+    pid = os.getpid()
+    if entry is not None and entry[0] == pid:
+        return entry[1]
+    with _lock:
+        entry = _clients.get(name)
+        if entry is not None and entry[0] == pid:
+            return entry[1]
+        if name not in _configs:
+            raise KeyError("no connection named %s" % name)
+        if entry is not None: # inherited from the parent process
+            _detach(entry[1].connection_pool)
+        client = _create(_configs[name])
+        _clients[name] = (pid, client)
+        return client
+
+
+def resolve(connection):
+    """
+    Return the client for connection: a client, a connection name, or None for the default.
+    """
+    if connection is None:
+        return get_connection()
+    if isinstance(connection, basestring):
+        return get_connection(connection)
+    return connection
+
+
+def reset():
+    """
+    Close every client and forget the configuration and routes.
+    """
+    with _lock:
+        entries = _clients.values()
+        _clients.clear()
+        _configs.clear()
+        _configs[DEFAULT] = {}
+        del _routes[:]
+    for entry in entries:
+        _release(entry)
+
+
+def _create(config):
+    options = dict(config)
+    url = options.pop("url", None)
+    max_connections = options.pop("max_connections", None)
+    blocking = options.pop("blocking", False)
+    timeout = options.pop("timeout", 20)
+    if blocking:
+        pool_class = redis.BlockingConnectionPool
+        options["timeout"] = timeout
+        options["max_connections"] = max_connections or 50
+    else:
+        pool_class = redis.ConnectionPool
+        options["max_connections"] = max_connections
+    if url:
+        pool = pool_class.from_url(url, **options)
+    else:
+        pool = pool_class(**options)
+    return redis.Redis(connection_pool=pool)
+
+
+def _release(entry):
+    pid, client = entry
+    if pid == os.getpid():
+        client.connection_pool.disconnect()
+    else:
+        _detach(client.connection_pool)
+
+
+def _detach(pool):
+    """
+    Drop the connections a forked child inherited without shutting their sockets
+    down, which would also cut them in the parent (redis-py disconnect() does).
+    """
+    connections = getattr(pool, "_connections", None) # BlockingConnectionPool
+    if connections is None:
+        connections = pool._available_connections + list(pool._in_use_connections)
+    for connection in connections:
+        if connection is not None and connection._sock is not None:
+            connection._sock.close()
+            connection._sock = None
+    pool.reset()
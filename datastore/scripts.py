@@ -0,0 +1,653 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+
+import redis
+
+
+class Script(object):
+    """
+    Lua script run with EVALSHA, falling back to EVAL (which also caches it
+    on the server) when the server answers NOSCRIPT.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+    def __call__(self, client, keys=(), args=()):
+        arguments = tuple(keys) + tuple(args)
+        try:
+            return client.evalsha(self.sha, len(keys), *arguments)
+        except redis.exceptions.NoScriptError:
+            return client.eval(self.source, len(keys), *arguments)
+
+    def queue(self, pipe, keys=(), args=()):
+        """
+        Queue the script on a pipeline, as EVALSHA. Execute the pipeline with
+        execute(), which loads the script in the same round trip.
+        """
+        arguments = tuple(keys) + tuple(args)
+        return pipe.evalsha(self.sha, len(keys), *arguments)
+
+
+def execute(pipe, raise_on_error=True):
+    """
+    SCRIPT LOAD
+
+    Execute pipe and return its replies, as pipe.execute(). Each script queued
+    is loaded first, in the same round trip (and transaction): its source is
+    sent once per pipeline instead of once per call, and no EVALSHA gets a
+    NOSCRIPT reply, after a server restart or a SCRIPT FLUSH, that would run
+    the other commands out of order.
+    """
+    shas = []
+    for args, options in pipe.command_stack:
+        if args[0] == "EVALSHA" and args[1] not in shas:
+            shas.append(args[1])
+    pipe.command_stack[:0] = [(("SCRIPT", "LOAD", _BY_SHA[sha].source), {}) for sha in shas]
+    replies = pipe.execute(raise_on_error=False)[len(shas):]
+    if raise_on_error:
+        for reply in replies:
+            if isinstance(reply, redis.exceptions.ResponseError):
+                raise reply
+    return replies
+
+
+# KEYS[1] hash, ARGV[1] field
+# Returns the removed value, nil if the field did not exist
+DICT_POP = Script("""
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if value then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return value
+""")
+
+# KEYS[1] hash, ARGV[1] field, ARGV[2] default
+# Returns the current value, nil if the default was just stored
+DICT_SETDEFAULT = Script("""
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    return nil
+end
+return redis.call('HGET', KEYS[1], ARGV[1])
+""")
+
+# KEYS[1] list, ARGV[1] index, ARGV[2] value, ARGV[3] unique marker
+# LINSERT works on values, so the element at index is swapped for a marker
+# to insert before the right element when there are duplicates.
+# Returns the new length, -1 if index is out of range
+LIST_INSERT = Script("""
+local index = tonumber(ARGV[1])
+local reference = redis.call('LINDEX', KEYS[1], index)
+if not reference then
+    return -1
+end
+redis.call('LSET', KEYS[1], index, ARGV[3])
+local length = redis.call('LINSERT', KEYS[1], 'BEFORE', ARGV[3], ARGV[2])
+if index >= 0 then
+    index = index + 1
+end
+redis.call('LSET', KEYS[1], index, reference)
+return length
+""")
+
+# KEYS[1] set, KEYS[2] other set
+# Returns {SCARD set, SCARD other, 1 if every member of set is in other else 0}
+SET_SUBSET = Script("""
+local len_self = redis.call('SCARD', KEYS[1])
+local len_other = redis.call('SCARD', KEYS[2])
+if len_self > len_other then
+    return {len_self, len_other, 0}
+end
+for _, member in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if redis.call('SISMEMBER', KEYS[2], member) == 0 then
+        return {len_self, len_other, 0}
+    end
+end
+return {len_self, len_other, 1}
+""")
+
+# KEYS[1] hash, ARGV[1] field prefix
+# Returns {field, value, ...} of the fields starting with prefix, prefix removed
+HASH_PREFIX_ITEMS = Script("""
+local prefix = ARGV[1]
+local items = {}
+local all = redis.call('HGETALL', KEYS[1])
+for i = 1, #all, 2 do
+    if string.sub(all[i], 1, #prefix) == prefix then
+        items[#items + 1] = string.sub(all[i], #prefix + 1)
+        items[#items + 1] = all[i + 1]
+    end
+end
+return items
+""")
+
+# KEYS[1] hash, ARGV[1] field prefix
+# Returns the number of fields starting with prefix
+HASH_PREFIX_LEN = Script("""
+local prefix = ARGV[1]
+local count = 0
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(field, 1, #prefix) == prefix then
+        count = count + 1
+    end
+end
+return count
+""")
+
+# KEYS[1] hash, ARGV[1] field prefix
+# Deletes the fields starting with prefix, returns how many
+HASH_PREFIX_DELETE = Script("""
+local prefix = ARGV[1]
+local count = 0
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(field, 1, #prefix) == prefix then
+        count = count + redis.call('HDEL', KEYS[1], field)
+    end
+end
+return count
+""")
+
+# KEYS sets, then for store the destination set and the versions hash,
+# for memo the destination set
+# ARGV[1] mode: count, members, contains, store or memo,
+# ARGV[2] member for contains, seconds to live for memo,
+# ARGV[3]... expression in postfix notation: "k<i>" pushes KEYS[i], "<op><n>"
+# replaces the n top values with their intersection (&), union (|),
+# difference (-) or symmetric difference (^, members in an odd number of them)
+# store bumps the version of the destination when tracked (drops it when the
+# result is empty, the set gone), memo stores the result with
+# a time to live unless the destination exists, and then extends its life
+# Returns the size, the members, 1 or 0, or the size of the stored set (-1 when memo found it)
+SET_EXPRESSION = Script("""
+local mode = ARGV[1]
+local member = ARGV[2]
+
+if mode == 'memo' and redis.call('EXPIRE', KEYS[#KEYS], ARGV[2]) == 1 then
+    return -1
+end
+
+-- A value is a set key {key = name}, or an evaluated {list = unique members}
+
+local function members(v)
+    if v.key then
+        return redis.call('SMEMBERS', v.key)
+    end
+    return v.list
+end
+
+-- Whether each member of list is in v, with SMISMEMBER (redis 6.2) when v is a key
+local function flags(v, list)
+    local result = {}
+    if not v.key then
+        if not v.set then
+            v.set = {}
+            for _, m in ipairs(v.list) do
+                v.set[m] = true
+            end
+        end
+        for i, m in ipairs(list) do
+            result[i] = v.set[m] ~= nil
+        end
+        return result
+    end
+    for i = 1, #list, 5000 do
+        local last = math.min(i + 4999, #list)
+        local reply = redis.pcall('SMISMEMBER', v.key, unpack(list, i, last))
+        if reply.err then
+            reply = {}
+            for j = i, last do
+                reply[#reply + 1] = redis.call('SISMEMBER', v.key, list[j])
+            end
+        end
+        for _, flag in ipairs(reply) do
+            result[#result + 1] = flag == 1
+        end
+    end
+    return result
+end
+
+local function keep(list, found, wanted)
+    local kept = {}
+    for i, m in ipairs(list) do
+        if found[i] == wanted then
+            kept[#kept + 1] = m
+        end
+    end
+    return kept
+end
+
+local function size(v)
+    if v.key then
+        return redis.call('SCARD', v.key)
+    end
+    return #v.list
+end
+
+local function evaluate(op, operands)
+    local keys = {}
+    for _, v in ipairs(operands) do
+        if not v.key then
+            keys = nil
+            break
+        end
+        keys[#keys + 1] = v.key
+    end
+    local list = {}
+    if op == '&' then
+        if keys then
+            return {list = redis.call('SINTER', unpack(keys))}
+        end
+        local smallest = 1
+        for i = 2, #operands do
+            if size(operands[i]) < size(operands[smallest]) then
+                smallest = i
+            end
+        end
+        list = members(operands[smallest])
+        for i, v in ipairs(operands) do
+            if i ~= smallest then
+                list = keep(list, flags(v, list), true)
+            end
+        end
+    elseif op == '|' then
+        if keys then
+            return {list = redis.call('SUNION', unpack(keys))}
+        end
+        local seen = {}
+        for _, v in ipairs(operands) do
+            for _, m in ipairs(members(v)) do
+                if not seen[m] then
+                    seen[m] = true
+                    list[#list + 1] = m
+                end
+            end
+        end
+    elseif op == '-' then
+        if keys then
+            return {list = redis.call('SDIFF', unpack(keys))}
+        end
+        list = members(operands[1])
+        for i = 2, #operands do
+            list = keep(list, flags(operands[i], list), false)
+        end
+    else
+        local counts = {}
+        for _, v in ipairs(operands) do
+            for _, m in ipairs(members(v)) do
+                counts[m] = (counts[m] or 0) + 1
+            end
+        end
+        for m, count in pairs(counts) do
+            if count % 2 == 1 then
+                list[#list + 1] = m
+            end
+        end
+    end
+    return {list = list}
+end
+
+-- Membership only needs SISMEMBER on every set
+local function test(op, values)
+    local result = values[1]
+    for i = 2, #values do
+        if op == '&' then
+            result = result and values[i]
+        elseif op == '|' then
+            result = result or values[i]
+        elseif op == '-' then
+            result = result and not values[i]
+        else
+            result = result ~= values[i]
+        end
+    end
+    return result
+end
+
+local stack = {}
+for i = 3, #ARGV do
+    local kind = string.sub(ARGV[i], 1, 1)
+    local number = tonumber(string.sub(ARGV[i], 2))
+    if kind == 'k' then
+        if mode == 'contains' then
+            stack[#stack + 1] = redis.call('SISMEMBER', KEYS[number], member) == 1
+        else
+            stack[#stack + 1] = {key = KEYS[number]}
+        end
+    else
+        local operands = {}
+        for j = #stack - number + 1, #stack do
+            operands[#operands + 1] = stack[j]
+        end
+        for j = 1, number do
+            stack[#stack] = nil
+        end
+        if mode == 'contains' then
+            stack[#stack + 1] = test(kind, operands)
+        else
+            stack[#stack + 1] = evaluate(kind, operands)
+        end
+    end
+end
+
+local result = stack[1]
+if mode == 'contains' then
+    return result and 1 or 0
+elseif mode == 'count' then
+    return size(result)
+end
+local list = members(result)
+if mode == 'members' then
+    return list
+end
+local destination = KEYS[#KEYS]
+if mode == 'store' then
+    destination = KEYS[#KEYS - 1]
+end
+redis.call('DEL', destination)
+for i = 1, #list, 5000 do
+    redis.call('SADD', destination, unpack(list, i, math.min(i + 4999, #list)))
+end
+if mode == 'store' then
+    if #list == 0 then
+        redis.call('HDEL', KEYS[#KEYS], destination)
+    elseif redis.call('HEXISTS', KEYS[#KEYS], destination) == 1 then
+        redis.call('HINCRBY', KEYS[#KEYS], destination, 1)
+    end
+elseif #list > 0 then
+    redis.call('EXPIRE', destination, ARGV[2])
+end
+return #list
+""")
+
+# KEYS[1] versions hash, KEYS[2]... keys of the command, the changed sets first
+# ARGV[1] command, ARGV[2] number of changed sets, ARGV[3]... other arguments
+# Runs the command and bumps the versions of the changed sets that are
+# tracked in the hash (see SetExpression.memoize), or drops them for the sets
+# the command removed. Large SADDs run in chunks.
+# Returns the reply of the command
+SET_WRITE = Script("""
+local reply
+if ARGV[1] == 'sadd' and #ARGV > 5002 then
+    reply = 0
+    for i = 3, #ARGV, 5000 do
+        reply = reply + redis.call('SADD', KEYS[2], unpack(ARGV, i, math.min(i + 4999, #ARGV)))
+    end
+else
+    local arguments = {}
+    for i = 2, #KEYS do
+        arguments[#arguments + 1] = KEYS[i]
+    end
+    for i = 3, #ARGV do
+        arguments[#arguments + 1] = ARGV[i]
+    end
+    reply = redis.call(ARGV[1], unpack(arguments))
+end
+for i = 2, tonumber(ARGV[2]) + 1 do
+    if redis.call('EXISTS', KEYS[i]) == 0 then
+        redis.call('HDEL', KEYS[1], KEYS[i])
+    elseif redis.call('HEXISTS', KEYS[1], KEYS[i]) == 1 then
+        redis.call('HINCRBY', KEYS[1], KEYS[i], 1)
+    end
+end
+return reply
+""")
+
+# KEYS[1] key, ARGV[1] seconds
+# Sets the time to live of a key that has none, after a write created it
+EXPIRE_NEW = Script("""
+if redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+""")
+
+# KEYS[1] key, ARGV[1] seconds, ARGV[2] a write command on the key, then its
+# arguments after the key
+# Runs the command and sets the time to live of the key if it has none (the
+# command created it), in one call. Returns the reply of the command
+WRITE_EXPIRE = Script("""
+local reply = redis.call(ARGV[2], KEYS[1], unpack(ARGV, 3))
+if redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return reply
+""")
+
+# KEYS bloom filter bitmaps, ARGV[1] "GET" or "SET", then the bits and number
+# of hashes of each filter, then two little endian 32 bits hashes per element,
+# packed in one string, combined into the positions of its bits
+# (first + i * second) modulo bits.
+# GET: per element "1" if one of the filters has all its bits set.
+# SET: sets the bits of each element in the filters, "1" if one of them was not set.
+# Returns the flags as a string, one character per element.
+BLOOM = Script("""
+local sizes = {}
+local argument = 2
+for i = 1, #KEYS do
+    sizes[i] = {tonumber(ARGV[argument]), tonumber(ARGV[argument + 1])}
+    argument = argument + 2
+end
+local digests = ARGV[argument]
+local flags = {}
+for position = 1, #digests, 8 do
+    local first, second = struct.unpack('<I4<I4', digests, position)
+    local flag = '0'
+    for i = 1, #KEYS do
+        local bits, hashes = sizes[i][1], sizes[i][2]
+        if ARGV[1] == 'SET' then
+            for h = 0, hashes - 1 do
+                if redis.call('SETBIT', KEYS[i], (first + h * second) % bits, 1) == 0 then
+                    flag = '1'
+                end
+            end
+        else
+            local found = true
+            for h = 0, hashes - 1 do
+                if redis.call('GETBIT', KEYS[i], (first + h * second) % bits) == 0 then
+                    found = false
+                    break
+                end
+            end
+            if found then
+                flag = '1'
+                break
+            end
+        end
+    end
+    flags[#flags + 1] = flag
+end
+return table.concat(flags)
+""")
+
+# KEYS[1] bitmap, ARGV[1] bit positions, little endian 32 bits integers packed in one string
+# Returns the number of bits that were not set
+BITSET_ADD = Script("""
+local data = ARGV[1]
+local added = 0
+for position = 1, #data, 4 do
+    if redis.call('SETBIT', KEYS[1], struct.unpack('<I4', data, position), 1) == 0 then
+        added = added + 1
+    end
+end
+return added
+""")
+
+# KEYS[1] bitmap
+# Clears the first bit set. Returns its position, -1 if none
+BITSET_POP = Script("""
+local position = redis.call('BITPOS', KEYS[1], 1)
+if position >= 0 then
+    redis.call('SETBIT', KEYS[1], position, 0)
+end
+return position
+""")
+
+# KEYS[1] queue, KEYS[2] processing list (optional), ARGV[1] count
+# Removes up to count items from the head of the queue, appended to the
+# processing list if given. Returns them
+QUEUE_POP = Script("""
+local count = tonumber(ARGV[1])
+local items = redis.call('LRANGE', KEYS[1], 0, count - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    if KEYS[2] then
+        for i = 1, #items, 1000 do
+            redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+        end
+    end
+end
+return items
+""")
+
+# KEYS[1] queue, KEYS[2] processing list, ARGV[1] item
+# Moves item from the processing list back to the head of the queue.
+# Returns 1, 0 if it was not in the processing list
+QUEUE_REQUEUE = Script("""
+if redis.call('LREM', KEYS[2], 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+return 1
+""")
+
+# KEYS[1] queue, KEYS[2] processing list
+# Moves every item of the processing list back to the head of the queue, in order.
+# Returns how many
+QUEUE_RECOVER = Script("""
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+return #items
+""")
+
+# KEYS[1] list
+# Returns {length, the elements joined by spaces}: one string for the client
+# to parse instead of a reply per element
+LIST_JOIN = Script("""
+local values = redis.call('LRANGE', KEYS[1], 0, -1)
+return {#values, table.concat(values, ' ')}
+""")
+
+# KEYS[1] hash, ARGV[1] "1" to join the fields too
+# Returns {length, the fields (joined by spaces with ARGV[1]), the values joined by spaces}
+HASH_JOIN = Script("""
+local items = redis.call('HGETALL', KEYS[1])
+local fields, values = {}, {}
+for i = 1, #items, 2 do
+    fields[#fields + 1] = items[i]
+    values[#values + 1] = items[i + 1]
+end
+if ARGV[1] == '1' then
+    fields = table.concat(fields, ' ')
+end
+return {#values, fields, table.concat(values, ' ')}
+""")
+
+# KEYS[1] staging key, KEYS[2] key, KEYS[3] hash of Set versions (optional)
+# Replaces key by the staging key, or deletes it when nothing was loaded, and
+# bumps its version if it is a memoized Set (drops it when deleted).
+# Returns 1, 0 if nothing was loaded
+LOAD_SWAP = Script("""
+local loaded = redis.call('EXISTS', KEYS[1])
+if loaded == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('PERSIST', KEYS[2])
+else
+    redis.call('DEL', KEYS[2])
+end
+if KEYS[3] and loaded == 0 then
+    redis.call('HDEL', KEYS[3], KEYS[2])
+elseif KEYS[3] and redis.call('HEXISTS', KEYS[3], KEYS[2]) == 1 then
+    redis.call('HINCRBY', KEYS[3], KEYS[2], 1)
+end
+return loaded
+""")
+
+# KEYS[1] key, ARGV[1] type (h, s, z, l or b for a string), ARGV[2] scan cursor
+# or start index, "0" first, ARGV[3] elements (bytes for a string) to read
+# Returns {the next cursor or start, "0" when done, a chunk record of a snapshot
+# file: "E", the length of the rest, then each item as <I length> bytes}
+SNAPSHOT_READ = Script("""
+local kind, cursor, count = ARGV[1], ARGV[2], tonumber(ARGV[3])
+local items, next = {}, '0'
+if kind == 'h' or kind == 's' or kind == 'z' then
+    local command = ({h = 'HSCAN', s = 'SSCAN', z = 'ZSCAN'})[kind]
+    local reply = redis.call(command, KEYS[1], cursor, 'COUNT', count)
+    next, items = reply[1], reply[2]
+elseif kind == 'l' then
+    local start = tonumber(cursor)
+    items = redis.call('LRANGE', KEYS[1], start, start + count - 1)
+    if #items == count then
+        next = tostring(start + count)
+    end
+else
+    local start = tonumber(cursor)
+    local data = redis.call('GETRANGE', KEYS[1], start, start + count - 1)
+    if #data > 0 then
+        items = {data}
+    end
+    if #data == count then
+        next = tostring(start + count)
+    end
+end
+if #items == 0 then
+    return {next, ''}
+end
+local parts = {}
+for i = 1, #items do
+    parts[#parts + 1] = struct.pack('<I4', #items[i])
+    parts[#parts + 1] = items[i]
+end
+local body = table.concat(parts)
+return {next, 'E' .. struct.pack('<I4', #body) .. body}
+""")
+
+# KEYS[1] key, ARGV[1] type (h, s, z, l or b), ARGV[2] the items of a snapshot
+# chunk record, each <I length> bytes
+# Writes them to key, fields and values, members, members and scores, elements
+# or parts of a string. Returns the number of items
+SNAPSHOT_WRITE = Script("""
+local kind, data = ARGV[1], ARGV[2]
+local items = {}
+local position = 1
+while position <= #data do
+    items[#items + 1], position = struct.unpack('<I4c0', data, position)
+end
+if kind == 'b' then
+    for i = 1, #items do
+        redis.call('APPEND', KEYS[1], items[i])
+    end
+    return #items
+end
+if kind == 'z' then
+    for i = 1, #items, 2 do
+        items[i], items[i + 1] = items[i + 1], items[i]
+    end
+end
+local command = ({h = 'HSET', s = 'SADD', z = 'ZADD', l = 'RPUSH'})[kind]
+for i = 1, #items, 1000 do
+    redis.call(command, KEYS[1], unpack(items, i, math.min(i + 999, #items)))
+end
+return #items
+""")
+
+SCRIPTS = [DICT_POP, DICT_SETDEFAULT, LIST_INSERT, SET_SUBSET,
+           HASH_PREFIX_ITEMS, HASH_PREFIX_LEN, HASH_PREFIX_DELETE, SET_EXPRESSION, SET_WRITE,
+           EXPIRE_NEW, WRITE_EXPIRE,
+           BLOOM, BITSET_ADD, BITSET_POP, QUEUE_POP, QUEUE_REQUEUE, QUEUE_RECOVER,
+           LIST_JOIN, HASH_JOIN, LOAD_SWAP, SNAPSHOT_READ, SNAPSHOT_WRITE]
+
+_BY_SHA = dict((script.sha, script) for script in SCRIPTS)
+
+def load_scripts(connection):
+    """
+    SCRIPT LOAD
+
+    Preload every script, in one round trip, so that the first calls do not get a NOSCRIPT reply.
+    """
+    pipe = connection.pipeline(transaction=False)
+    for script in SCRIPTS:
+        pipe.script_load(script.source)
+    pipe.execute()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+import itertools
+import random
+import zlib
+
+import scripts
+from asynchronous import gather, get_pool
+from structs import TEMPORARY_TTL, Dict, RedisDataStructure, Set
+
+SHARDS = 16
+
+
+class HashRing(object):
+    """
+    Consistent hashing of names over connections: adding or removing a connection
+    only moves the names that hash next to it.
+    """
+    def __init__(self, connections, replicas=100):
+        self.connections = list(connections)
+        if not self.connections:
+            raise ValueError("at least one connection")
+        self._points = []
+        self._nodes = {}
+        for i, connection in enumerate(self.connections):
+            for replica in range(replicas):
+                point = self._hash("%d:%d" % (i, replica))
+                self._points.append(point)
+                self._nodes[point] = connection
+        self._points.sort()
+
+    def _hash(self, name):
+        return long(hashlib.md5(name).hexdigest()[:16], 16)
+
+    def node(self, name):
+        """
+        Return the connection owning name.
+        """
+        index = bisect.bisect(self._points, self._hash(name)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+def shard_index(key, shards):
+    return zlib.crc32(str(key)) % shards
+
+
+class ShardedStructure(RedisDataStructure):
+    """
+    One logical structure spread over several keys, "<name>:<i>", each an ordinary
+    structure of type structure. Keys are hashed to a shard with crc32 and shards
+    are placed on connections with a HashRing keyed by the shard number, so shard i
+    of every sharded structure with the same connections lives on the same server.
+
+    Accepts name, shards (number of shards), connections (a list of clients or
+    registry connection names, the one routed to name by default), and
+    cache_size, codec, ttl and sliding, passed on to every shard.
+    Calls on every shard send one pipeline per connection, connections in parallel.
+    """
+    structure = RedisDataStructure
+
+    def __init__(self, *args, **kwargs):
+        cache_size = kwargs.pop("cache_size", None) # for the shards, not the logical name
+        if "connections" in kwargs and kwargs["connections"]:
+            connections = kwargs["connections"]
+            kwargs["connection"] = connections[0]
+            super(ShardedStructure, self).__init__(**kwargs)
+        else:
+            super(ShardedStructure, self).__init__(**kwargs)
+            connections = [self._connection_spec()]
+
+        count = kwargs["shards"] if "shards" in kwargs and kwargs["shards"] else SHARDS
+        self.ring = HashRing(connections)
+        self.shards = [self.structure(name="%s:%d" % (self.pk, i),
+                                      connection=self.ring.node("shard:%d" % i),
+                                      cache_size=cache_size,
+                                      codec=self.codec,
+                                      ttl=self.expiry,
+                                      sliding=self.sliding)
+                       for i in range(count)]
+
+    def shard(self, key):
+        """
+        Return the structure holding key.
+        """
+        return self.shards[shard_index(key, len(self.shards))]
+
+    def _group(self, items):
+        """
+        Group (shard, value) pairs into {shard: [values]}.
+        """
+        groups = {}
+        for shard, value in items:
+            groups.setdefault(shard, []).append(value)
+        return groups
+
+    def _fan_out(self, command, shards=None, write=False):
+        """
+        Run command(pipe, shard) for every shard and return the replies in shard order.
+        With write, the expiry of each shard written is queued after its command.
+        """
+        shards = self.shards if shards is None else shards
+        by_connection = {}
+        for position, shard in enumerate(shards):
+            by_connection.setdefault(shard.connection, []).append((position, shard))
+
+        def run(connection, group):
+            pipe = connection.pipeline(transaction=False)
+            starts = []
+            for position, shard in group:
+                starts.append((position, len(pipe.command_stack)))
+                command(pipe, shard)
+                if write:
+                    shard._queue_expiry(pipe)
+            replies = scripts.execute(pipe)
+            return [(position, replies[start]) for position, start in starts]
+
+        if len(by_connection) == 1:
+            results = [run(*by_connection.items()[0])]
+        else:
+            pool = get_pool()
+            results = gather(*[pool.apply_async(run, group) for group in by_connection.items()])
+
+        replies = [None] * len(shards)
+        for position, reply in itertools.chain(*results):
+            replies[position] = reply
+        return replies
+
+    def _check_compatible(self, other):
+        if not isinstance(other, type(self)):
+            raise TypeError("not a %s" % type(self).__name__)
+        if len(other.shards) != len(self.shards) or \
+                any(a.connection is not b.connection for a, b in zip(self.shards, other.shards)):
+            raise ValueError("sharded structures must have the same shards and connections")
+
+    def __len__(self):
+        return sum(self._fan_out(self._len_command))
+
+    def clear(self):
+        """
+        Remove every shard.
+        """
+        self._fan_out(lambda pipe, shard: pipe.delete(shard.pk))
+        for shard in self.shards:
+            shard._invalidate_cache()
+
+    def __iter__(self):
+        return itertools.chain(*self.shards)
+
+    def expire(self, seconds):
+        """
+        EXPIRE every shard. Returns False if none exists.
+        """
+        return any(self._fan_out(lambda pipe, shard: pipe.expire(shard.pk, seconds)))
+
+    def persist(self):
+        """
+        PERSIST every shard, and stop applying the ttl given on construction.
+        """
+        self.expiry = None
+        for shard in self.shards:
+            shard.expiry = None
+        return any(self._fan_out(lambda pipe, shard: pipe.persist(shard.pk)))
+
+    def ttl(self):
+        """
+        TTL of the shard expiring first, None if no shard expires.
+        """
+        seconds = [t for t in self._fan_out(lambda pipe, shard: pipe.ttl(shard.pk)) if t is not None and t >= 0]
+        return min(seconds) if seconds else None
+
+    def snapshot(self, path, portable=False, chunk_size=None):
+        raise TypeError("shards may be on several servers: snapshot each shard")
+
+    def restore(self, path):
+        raise TypeError("shards may be on several servers: restore each shard")
+
+
+class ShardedDict(ShardedStructure):
+    structure = Dict
+    _len_command = staticmethod(lambda pipe, shard: pipe.hlen(shard.pk))
+
+    def __init__(self, *args, **kwargs):
+        super(ShardedDict, self).__init__(*args, **kwargs)
+        if args: # initial data
+            self.update(args[0])
+
+    def __setitem__(self, key, value):
+        self.shard(key)[key] = value
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+    def get(self, key, *args):
+        return self.shard(key).get(key, *args)
+
+    def pop(self, key, *args):
+        return self.shard(key).pop(key, *args)
+
+    def setdefault(self, key, *args):
+        return self.shard(key).setdefault(key, *args)
+
+    def incrby(self, key, value=1):
+        return self.shard(key).incrby(key, value)
+
+    def update(self, *args, **kwargs):
+        """
+        HMSET on every shard concerned, shards in parallel.
+        Accepts the same arguments as Dict.update().
+        """
+        items = []
+        for arg in args:
+            items.extend(arg.iteritems() if isinstance(arg, dict) else arg)
+        items.extend(kwargs.iteritems())
+        groups = self._group((self.shard(k), (k, v)) for k, v in items)
+        shards = groups.keys()
+        encode = self.codec.encode
+        self._fan_out(lambda pipe, shard: pipe.hmset(shard.pk, dict((k, encode(v)) for k, v in groups[shard])), shards, write=True)
+        for shard in shards:
+            shard._invalidate_cache()
+
+    def to_dict(self):
+        result = {}
+        decode = self.codec.decode
+        for values in self._fan_out(lambda pipe, shard: pipe.hgetall(shard.pk)):
+            result.update((k, decode(v)) for k, v in values.iteritems())
+        return result
+
+    def items(self):
+        return self.to_dict().items()
+
+    def keys(self):
+        return list(itertools.chain(*self._fan_out(lambda pipe, shard: pipe.hkeys(shard.pk))))
+
+    def values(self):
+        return self._decode_all(itertools.chain(*self._fan_out(lambda pipe, shard: pipe.hvals(shard.pk))))
+
+    def scan(self, count=None, match=None):
+        """
+        HSCAN over each shard in turn.
+        """
+        return itertools.chain(*[shard.scan(count=count, match=match) for shard in self.shards])
+
+    def iteritems(self):
+        return self.scan()
+
+    def iterkeys(self):
+        return (k for k, v in self.scan())
+
+    def itervalues(self):
+        return (v for k, v in self.scan())
+
+
+class ShardedSet(ShardedStructure):
+    structure = Set
+    _len_command = staticmethod(lambda pipe, shard: pipe.scard(shard.pk))
+
+    def __init__(self, *args, **kwargs):
+        super(ShardedSet, self).__init__(*args, **kwargs)
+        if args: # initial data
+            self.add(*args[0])
+
+    def shard(self, element):
+        """
+        Return the structure holding element. Members are hashed encoded,
+        the form that is unique for equal values.
+        """
+        return self.shards[shard_index(self._encode(element), len(self.shards))]
+
+    def __contains__(self, element):
+        return element in self.shard(element)
+
+    def add(self, *elements):
+        """
+        SADD on every shard concerned, shards in parallel.
+        """
+        groups = self._group((self.shard(e), self._encode(e)) for e in elements)
+        shards = groups.keys()
+        self._fan_out(lambda pipe, shard: pipe.sadd(shard.pk, *groups[shard]), shards, write=True)
+        for shard in shards:
+            shard._invalidate_cache()
+
+    def remove(self, element):
+        return self.shard(element).remove(element)
+
+    def discard(self, element):
+        return self.shard(element).discard(element)
+
+    def pop(self):
+        """
+        SPOP from a random non empty shard.
+        Raises KeyError if the set is empty.
+        """
+        shards = list(self.shards)
+        random.shuffle(shards)
+        for shard in shards:
+            try:
+                return shard.pop()
+            except KeyError:
+                pass
+        raise KeyError("empty set")
+
+    def members(self):
+        return set(self._decode_all(itertools.chain(*self._fan_out(lambda pipe, shard: pipe.smembers(shard.pk)))))
+
+    def scan(self, count=None, match=None):
+        """
+        SSCAN over each shard in turn.
+        """
+        return itertools.chain(*[shard.scan(count=count, match=match) for shard in self.shards])
+
+    def _set_operation(self, operator, *other_sets, **kwargs):
+        if "destination" in kwargs and kwargs["destination"] is not None: # empty ones are false
+            destination = kwargs["destination"]
+        else:
+            ttl = kwargs["ttl"] if "ttl" in kwargs and kwargs["ttl"] else TEMPORARY_TTL
+            destination = ShardedSet(shards=len(self.shards), connections=self.ring.connections, codec=self.codec,
+                                     ttl=ttl)
+        for os in (destination,) + other_sets:
+            self._check_compatible(os)
+
+        # A member always hashes to the same shard number, so each shard is
+        # combined with the same shard of the other sets, on its own server.
+        def command(pipe, position):
+            ids = [s.shards[position].pk for s in (self,) + other_sets]
+            getattr(pipe, operator)(destination.shards[position].pk, *ids)
+        positions = dict((shard, i) for i, shard in enumerate(destination.shards))
+        self._fan_out(lambda pipe, shard: command(pipe, positions[shard]), destination.shards, write=True)
+        for shard in destination.shards:
+            shard._invalidate_cache()
+        return destination
+
+    def union(self, *other_sets, **kwargs):
+        return self._set_operation("sunionstore", *other_sets, **kwargs)
+
+    def intersection(self, *other_sets, **kwargs):
+        return self._set_operation("sinterstore", *other_sets, **kwargs)
+
+    def difference(self, *other_sets, **kwargs):
+        return self._set_operation("sdiffstore", *other_sets, **kwargs)
+
+    def update(self, *other_sets):
+        return self.union(*other_sets, destination=self)
+
+    def intersection_update(self, *other_sets):
+        return self.intersection(*other_sets, destination=self)
+
+    def difference_update(self, *other_sets):
+        return self.difference(*other_sets, destination=self)
+
+    def _subset(self, subset, superset):
+        self._check_compatible(subset)
+        self._check_compatible(superset)
+        positions = dict((shard, i) for i, shard in enumerate(subset.shards))
+        def command(pipe, shard):
+            other = superset.shards[positions[shard]]
+            scripts.SET_SUBSET.queue(pipe, [shard.pk, other.pk])
+        replies = self._fan_out(command, subset.shards)
+        return all(reply[2] for reply in replies)
+
+    def issubset(self, other):
+        return self._subset(self, other)
+
+    def issuperset(self, other):
+        return self._subset(other, self)
+
+    def isdisjoint(self, other):
+        self._check_compatible(other)
+        positions = dict((shard, i) for i, shard in enumerate(self.shards))
+        replies = self._fan_out(lambda pipe, shard: pipe.sinter(shard.pk, other.shards[positions[shard]].pk))
+        return not any(replies)
@@ -1,10 +1,148 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import random
+import fnmatch
+import hashlib
+import mmap
+import os
 import redis
-import time
+import struct
+import uuid
+
+import registry
+import scripts
+from batch import Batch, QueuedCall, current_batch
+from cache import LENGTH, LRUCache, get_invalidator
+from codec import RAW
+from counters import CounterBuffer, get_buffer
+
+_SINTERCARD = {} # connection pool id: False when the server has no SINTERCARD
+
+VERSIONS = "datastore:versions" # hash of Set versions, by pk
+MEMO_PREFIX = "datastore:memo:"
+MEMO_TTL = 300
+
+TEMPORARY_TTL = 3600 # seconds, default life of the results of set operations
+ANONYMOUS_TTL = None # seconds, default life of the structures created without a name
+
+# Commands that leave the key as it is: a fixed ttl is not applied after them
+READ_COMMANDS = frozenset([
+    "exists", "type", "hget", "hmget", "hexists", "hlen", "hgetall", "hkeys", "hvals",
+    "scard", "sismember", "smembers", "srandmember", "sinter", "sunion", "sdiff",
+    "llen", "lindex", "lrange", "pfcount", "get", "getbit", "getrange", "strlen", "bitcount", "bitpos", "zcard", "zscore", "zrank", "zrevrank", "zcount",
+    "zrange", "zrevrange", "zrangebyscore", "zrevrangebyscore", "zrangebylex", "zrevrangebylex",
+])
+EXPIRY_COMMANDS = frozenset(["expire", "persist", "ttl"])
+# Writes reading other keys too: not run in a WRITE_EXPIRE script, that only declares the written key
+MULTI_KEY_COMMANDS = frozenset(["PFMERGE", "SMOVE", "SINTERSTORE", "SUNIONSTORE", "SDIFFSTORE",
+                                "ZUNIONSTORE", "ZINTERSTORE"])
+
+BITMAP_MAX = 2 ** 32 - 1 # highest bit of a redis string
+BITMAP_CHUNK = 10000 # IntBitSet members per script call in add()
+BITMAP_SCAN = 65536 # IntBitSet bytes read per GETRANGE when iterating
+
+# The members of each byte value, bit 0 being the most significant
+_BYTE_MEMBERS = [[bit for bit in range(8) if byte & (0x80 >> bit)] for byte in range(256)]
+
+
+def _bitmap_members(data, start=0):
+    """
+    Generate the positions of the bits set in data, a part of a bitmap starting at byte start.
+    """
+    for index, byte in enumerate(bytearray(data), start):
+        if byte:
+            for bit in _BYTE_MEMBERS[byte]:
+                yield index * 8 + bit
+
+# Snapshot files: SNAPSHOT_MAGIC, "C" <H length> class name of the structure, then per key
+#   "K" <H length> name suffix after pk
+#   "N" (no such key) | "D" <I length> DUMP payload | "T" type, then "E" chunks
+#   "Z" end of key
+# where a chunk is "E" <I length> items, each <I length> bytes (see SNAPSHOT_READ)
+SNAPSHOT_MAGIC = "RDSSNAP1"
+SNAPSHOT_CHUNK = 1000 # elements per chunk
+SNAPSHOT_RANGE = 1024 * 1024 # string bytes per chunk
+SNAPSHOT_BATCH = 4 * 1024 * 1024 # bytes sent per restore pipeline
+DUMP_MAX_ELEMENTS = 10000 # larger keys are read in chunks, not dumped in one call
+DUMP_MAX_BYTES = 8 * 1024 * 1024 # same for strings
+_LENGTHS = {"hash": "HLEN", "set": "SCARD", "zset": "ZCARD", "list": "LLEN", "string": "STRLEN"}
+_TYPES = {"hash": "h", "set": "s", "zset": "z", "list": "l", "string": "b"}
+
+
+def _snapshot_key(connection, key, f, portable, chunk_size):
+    """
+    Write the records of key to f: its DUMP payload, or its content in chunks
+    when it is large or portable is set.
+    """
+    kind = connection.type(key)
+    if kind == "none":
+        f.write("N")
+        return
+    size = connection.execute_command(_LENGTHS[kind], key) if kind in _LENGTHS else 0
+    limit = DUMP_MAX_BYTES if kind == "string" else DUMP_MAX_ELEMENTS
+    if (not portable and size <= limit) or kind not in _TYPES:
+        if portable:
+            raise ValueError("no portable snapshot of a %s" % kind)
+        payload = connection.dump(key)
+        if payload is None: # expired meanwhile
+            f.write("N")
+        else:
+            f.write("D" + struct.pack("<I", len(payload)))
+            f.write(payload)
+        return
+    f.write("T" + _TYPES[kind])
+    count = SNAPSHOT_RANGE if kind == "string" else chunk_size
+    cursor = "0"
+    while True:
+        cursor, record = scripts.SNAPSHOT_READ(connection, [key], [_TYPES[kind], cursor, count])
+        f.write(record)
+        if cursor == "0":
+            return
+
+
+def _read_snapshot(data):
+    """
+    Generate the records of a snapshot file: ("C", class name) first, then
+    ("K", suffix), ("N", None), ("D", payload), ("T", type), ("E", items) and ("Z", None).
+    """
+    if data[:len(SNAPSHOT_MAGIC) + 1] != SNAPSHOT_MAGIC + "C":
+        raise ValueError("not a snapshot file")
+    offset = len(SNAPSHOT_MAGIC)
+    end = len(data)
+    try:
+        while offset < end:
+            tag = data[offset]
+            offset += 1
+            if tag in "CK":
+                length, = struct.unpack_from("<H", data, offset)
+                offset += 2
+            elif tag in "DE":
+                length, = struct.unpack_from("<I", data, offset)
+                offset += 4
+            elif tag == "T":
+                length = 1
+            elif tag in "NZ":
+                yield tag, None
+                continue
+            else:
+                raise ValueError("corrupt snapshot file at byte %d" % (offset - 1))
+            if offset + length > end:
+                raise ValueError("truncated snapshot file")
+            yield tag, data[offset:offset + length]
+            offset += length
+    except struct.error:
+        raise ValueError("truncated snapshot file")
+
+
+def batch(connection=None, transaction=True):
+    """
+    with batch(connection) as b:
 
-REDIS = redis.Redis()
+    Queue the calls on every structure using connection (a client or a registry
+    connection name, the default connection when omitted) into one pipeline,
+    sent in a single round trip when the block exits.
+    Calls return Deferred placeholders instead of their results.
+    """
+    return Batch(registry.resolve(connection), transaction=transaction)
 
 
 class RedisDataStructure(object):
@@ -12,10 +150,355 @@ class RedisDataStructure(object):
         if "name" in kwargs and kwargs["name"]:
             self.pk = kwargs["name"]
         else:
-            random_integer = int(time.time()) * 1000 + random.randint(1, 1000)
-            self.pk = "%d:%d" % (id(self), random_integer)
+            self.pk = uuid.uuid4().hex
+
+        # A client, or the name of a registry connection, looked up on every call
+        connection = kwargs["connection"] if "connection" in kwargs and kwargs["connection"] else registry.connection_name(self.pk)
+        if isinstance(connection, basestring):
+            self._connection_name, self._connection = connection, None
+        else:
+            self._connection_name, self._connection = None, connection
+        self.codec = kwargs["codec"] if "codec" in kwargs and kwargs["codec"] else RAW
+
+        # Expiry: ttl seconds after creation, or after the last access when sliding
+        if "ttl" in kwargs and kwargs["ttl"]:
+            self.expiry = kwargs["ttl"]
+        else:
+            self.expiry = ANONYMOUS_TTL if not ("name" in kwargs and kwargs["name"]) else None
+        self.sliding = bool(kwargs["sliding"]) if "sliding" in kwargs else False
+
+        # Near cache: reads are answered in process and dropped by keyspace notifications
+        self.cache = None
+        connection = self.connection
+        if "cache_size" in kwargs and kwargs["cache_size"]:
+            self.cache = LRUCache(kwargs["cache_size"])
+            get_invalidator(connection).register(self.pk, self.cache)
+
+    @property
+    def connection(self):
+        if self._connection_name is None:
+            return self._connection
+        connection = registry.get_connection(self._connection_name)
+        if connection is not self._connection: # first call, or first call after a fork
+            self._connection = connection
+            if self.cache is not None:
+                self.cache.invalidate()
+                get_invalidator(connection).register(self.pk, self.cache)
+        return connection
+
+    def _connection_spec(self):
+        """
+        Return what to pass as connection= for a new structure on the same connection.
+        """
+        return self._connection_name or self._connection
+
+    def _encode(self, value):
+        return self.codec.encode(value)
+
+    def _decode(self, data):
+        return data if data is None else self.codec.decode(data)
+
+    def _decode_all(self, values):
+        decode = self.codec.decode
+        return [decode(v) for v in values]
+
+    def _invalidate_cache(self, reply=None):
+        if self.cache is not None:
+            self.cache.invalidate()
+        return reply
+
+    def _cached(self, key, fetch, transform=None):
+        """
+        Return transform() of the near cache entry for key.
+        On a miss fetch(None) is called and its result cached.
+        Inside a batch the cache is bypassed and fetch(transform) is returned.
+        """
+        if self.cache is None or current_batch(self.connection) is not None:
+            return fetch(transform)
+        found, value = self.cache.lookup(key)
+        if not found:
+            generation = self.cache.generation
+            value = fetch(None)
+            self.cache.store(key, value, generation)
+        return transform(value) if transform else value
+
+    def _flush(self):
+        """
+        Execute the commands queued in the active batch, if any, and return 
+        whether there is one. Used before calls that must return a concrete value.
+        """
+        batch = current_batch(self.connection)
+        if batch is not None:
+            batch.execute()
+        return batch is not None
+
+    def _pipeline(self):
+        """
+        Return the pipeline for the commands of one call: a view of the active 
+        batch pipeline, or a new pipeline.
+        """
+        batch = current_batch(self.connection)
+        if batch is not None:
+            return batch.queue()
+        return self.connection.pipeline()
+
+    def _queue_expiry(self, pipe, command=None):
+        """
+        Queue after command what keeps the structure's expiry: with sliding expiry
+        EXPIRE after any access, otherwise EXPIRE after writes when the key has none
+        (it was just created). Scripts and pipelines (command None) count as writes.
+        Returns how many replies were added.
+        """
+        if self.expiry is None or command in EXPIRY_COMMANDS:
+            return 0
+        if self.sliding:
+            pipe.expire(self.pk, self.expiry)
+        elif command in READ_COMMANDS:
+            return 0
+        else:
+            scripts.EXPIRE_NEW.queue(pipe, [self.pk], [self.expiry])
+        return 1
+
+    def _execute(self, pipe, transform=None, error=None, command=None):
+        """
+        Execute pipe and return transform(replies).
+        Inside a batch return a Deferred instead.
+        A ResponseError is replaced by error, when given.
+        command, the name of the commands queued, tells whether they read or write (see _queue_expiry).
+        """
+        if self._queue_expiry(pipe, command):
+            final = transform
+            transform = lambda replies: final(replies[:-1]) if final else replies[:-1]
+        if isinstance(pipe, QueuedCall):
+            return pipe.defer(transform, error)
+        try:
+            replies = scripts.execute(pipe)
+        except redis.exceptions.ResponseError:
+            if error is None:
+                raise
+            raise error
+        return transform(replies) if transform else replies
+
+    def _write_expiring(self, name, args, kwargs, transform, error):
+        """
+        Run the write command name on the key with a fixed ttl as one WRITE_EXPIRE
+        call, which sets the expiry when the command created the key: no second
+        command per write. Returns NotImplemented for the commands it cannot wrap.
+        """
+        capture = self.connection.pipeline(transaction=False) # the command as redis-py sends it
+        getattr(capture, name)(*args, **kwargs)
+        (command, options), = capture.command_stack
+        if len(command) < 2 or command[1] != self.pk or command[0] in MULTI_KEY_COMMANDS:
+            return NotImplemented
+        callback = capture.response_callbacks.get(command[0])
+        def result(reply):
+            reply = callback(reply, **options) if callback else reply
+            return transform(reply) if transform else reply
+        keys, arguments = [self.pk], [self.expiry, command[0]] + list(command[2:])
+        batch = current_batch(self.connection)
+        if batch is not None:
+            pipe = batch.queue()
+            scripts.WRITE_EXPIRE.queue(pipe, keys, arguments)
+            return pipe.defer(lambda replies: result(replies[0]), error)
+        try:
+            reply = scripts.WRITE_EXPIRE(self.connection, keys, arguments)
+        except redis.exceptions.ResponseError:
+            if error is None:
+                raise
+            raise error
+        return result(reply)
+
+    def _command(self, name, *args, **kwargs):
+        """
+        Run a single command and return transform(reply).
+        Inside a batch the command is queued and a Deferred returned.
+        """
+        transform = kwargs.pop("transform", None)
+        error = kwargs.pop("error", None)
+        if self.expiry is not None and not self.sliding and name not in READ_COMMANDS and \
+                name not in EXPIRY_COMMANDS:
+            result = self._write_expiring(name, args, kwargs, transform, error)
+            if result is not NotImplemented:
+                return result
+        batch = current_batch(self.connection)
+        if batch is not None:
+            pipe = batch.queue()
+            getattr(pipe, name)(*args, **kwargs)
+            self._queue_expiry(pipe, name)
+            return pipe.defer(lambda replies: transform(replies[0]) if transform else replies[0], error)
+        if self.expiry is not None and name not in EXPIRY_COMMANDS and (self.sliding or name not in READ_COMMANDS):
+            pipe = self.connection.pipeline(transaction=False)
+            getattr(pipe, name)(*args, **kwargs)
+            self._queue_expiry(pipe, name)
+            return self._run_pipeline(pipe, transform, error)
+        try:
+            reply = getattr(self.connection, name)(*args, **kwargs)
+        except redis.exceptions.ResponseError:
+            if error is None:
+                raise
+            raise error
+        return transform(reply) if transform else reply
+
+    def _script(self, script, keys, args, transform=None, error=None):
+        """
+        Run a script from the scripts module and return transform(reply).
+        Inside a batch the script is queued and a Deferred returned.
+        """
+        batch = current_batch(self.connection)
+        if batch is not None:
+            pipe = batch.queue()
+            script.queue(pipe, keys, args)
+            self._queue_expiry(pipe)
+            return pipe.defer(lambda replies: transform(replies[0]) if transform else replies[0], error)
+        if self.expiry is not None:
+            pipe = self.connection.pipeline(transaction=False)
+            script.queue(pipe, keys, args)
+            self._queue_expiry(pipe)
+            return self._run_pipeline(pipe, transform, error)
+        try:
+            reply = script(self.connection, keys, args)
+        except redis.exceptions.ResponseError:
+            if error is None:
+                raise
+            raise error
+        return transform(reply) if transform else reply
+
+    def _run_pipeline(self, pipe, transform, error):
+        """
+        Execute a command followed by expiry commands and return transform(reply of the command).
+        """
+        try:
+            reply = scripts.execute(pipe)[0]
+        except redis.exceptions.ResponseError:
+            if error is None:
+                raise
+            raise error
+        return transform(reply) if transform else reply
+
+    def expire(self, seconds):
+        """
+        EXPIRE
+
+        Remove the structure in seconds. Returns False if it does not exist.
+        """
+        return self._command("expire", self.pk, seconds, transform=bool)
+
+    def persist(self):
+        """
+        PERSIST
+
+        Keep the structure forever, and stop applying the ttl given on construction.
+        """
+        self.expiry = None
+        return self._command("persist", self.pk, transform=bool)
+
+    def ttl(self):
+        """
+        TTL
+
+        Return the seconds the structure has left, None if it does not expire or does not exist.
+        """
+        return self._command("ttl", self.pk, transform=lambda seconds: seconds if seconds >= 0 else None)
+
+    def _keys(self):
+        """
+        The keys holding the structure, all named after pk.
+        """
+        return [self.pk]
+
+    def snapshot(self, path, portable=False, chunk_size=SNAPSHOT_CHUNK):
+        """
+        DUMP
+        HSCAN SSCAN ZSCAN LRANGE GETRANGE for large keys
 
-        self.connection = kwargs["connection"] if "connection" in kwargs and kwargs["connection"] else REDIS
+        Write the structure to the file path, streamed: the DUMP payload of each
+        key, or its content read in chunks of chunk_size elements if larger than
+        DUMP_MAX_ELEMENTS (DUMP_MAX_BYTES for strings), packed by a script into
+        one string per chunk. DUMP payloads only restore
+        on a redis of the same or a later version: with portable, every key is
+        read in chunks. A key read in chunks is not a point in time copy when it
+        is written meanwhile. Returns the size of the file.
+        """
+        self._flush()
+        connection = self.connection
+        temporary = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        try:
+            with open(temporary, "wb") as f:
+                name = type(self).__name__
+                f.write(SNAPSHOT_MAGIC + "C" + struct.pack("<H", len(name)) + name)
+                for key in self._keys():
+                    suffix = key[len(self.pk):]
+                    f.write("K" + struct.pack("<H", len(suffix)) + suffix)
+                    _snapshot_key(connection, key, f, portable, chunk_size)
+                    f.write("Z")
+                size = f.tell()
+            os.rename(temporary, path)
+        except Exception:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return size
+
+    def restore(self, path):
+        """
+        RESTORE, or HSET SADD ZADD RPUSH APPEND for the keys read in chunks
+
+        Replace the structure by the content of the snapshot file path, taken
+        from this structure or any other of the same class (to clone it), TypeError
+        otherwise. The file is read through mmap and sent in pipelines of about
+        SNAPSHOT_BATCH bytes, chunks as they are stored, unpacked by a script.
+        Each key is rebuilt in a staging key. Once all are written, one transaction
+        replaces every key by its staging key, or deletes it if it did not exist.
+        Returns the number of keys restored.
+        """
+        self._flush()
+        connection = self.connection
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                raise ValueError("not a snapshot file")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stagings = []
+        swaps = []
+        try:
+            pipe = connection.pipeline(transaction=False)
+            queued = 0
+            key = staging = kind = None
+            for tag, value in _read_snapshot(data):
+                if tag == "C":
+                    if value != type(self).__name__:
+                        raise TypeError("snapshot of a %s, not a %s" % (value, type(self).__name__))
+                elif tag == "K":
+                    key = self.pk + value
+                    staging = "%s:restoring:%s" % (key, uuid.uuid4().hex)
+                    stagings.append(staging)
+                elif tag == "D":
+                    pipe.execute_command("RESTORE", staging, 0, value)
+                    queued += len(value)
+                elif tag == "T":
+                    kind = value
+                elif tag == "E":
+                    scripts.SNAPSHOT_WRITE.queue(pipe, [staging], [kind, value])
+                    queued += len(value)
+                elif tag == "Z":
+                    swaps.append((staging, key))
+                if queued >= SNAPSHOT_BATCH:
+                    scripts.execute(pipe)
+                    queued = 0
+            scripts.execute(pipe) # the writes must have succeeded before the swap
+            pipe = connection.pipeline()
+            for staging, key in swaps:
+                scripts.LOAD_SWAP.queue(pipe, [staging, key] + ([VERSIONS] if isinstance(self, Set) else []))
+                if key == self.pk:
+                    self._queue_expiry(pipe)
+            scripts.execute(pipe)
+        except Exception:
+            if stagings:
+                connection.delete(*stagings)
+            raise
+        finally:
+            data.close()
+        self._invalidate_cache()
+        return len(swaps)
 
     def __eq__(self, other):
         return self.pk == other.pk
@@ -27,6 +510,11 @@ class RedisDataStructure(object):
 class Dict(RedisDataStructure):
     def __init__(self, *args, **kwargs):
         super(Dict, self).__init__(*args, **kwargs)        
+        # Write-behind counters: incrby() adds up in process, see the counters module
+        self.counters = None
+        if "write_behind" in kwargs and kwargs["write_behind"]:
+            write_behind = kwargs["write_behind"]
+            self.counters = write_behind if isinstance(write_behind, CounterBuffer) else get_buffer()
         if args: # initial data
             self.update(args[0])
 
@@ -34,44 +522,52 @@ class Dict(RedisDataStructure):
         """
         HSET
         """
-        self.connection.hset(self.pk, key, value)
+        return self._command("hset", self.pk, key, self._encode(value), transform=self._invalidate_cache)
 
     def __getitem__(self, key):
         """
         HGET
         """
-        pipe = self.connection.pipeline()
-        pipe.hexists(self.pk, key)
-        pipe.hget(self.pk, key)
-        key_exists, key_value = pipe.execute()
-        if key_exists:
-            return key_value
-        else:
-            raise KeyError(key)
+        def result(value):
+            if value is None:
+                raise KeyError(key)
+            return self.codec.decode(value)
+        return self._cached(key, lambda transform: self._fetch(key, transform), result)
+
+    def _fetch(self, key, transform=None):
+        """
+        HGET
+
+        Return transform() of the value of key, None if key is not in the dictionary.
+        """
+        return self._command("hget", self.pk, key, transform=transform)
 
     def __delitem__(self, key):
         """
         HDEL
         """
-        self.connection.hdel(self.pk, key)
+        return self._command("hdel", self.pk, key, transform=self._invalidate_cache)
 
     def __contains__(self, key):
         """
         HEXISTS
         """
-        return self.connection.hexists(self.pk, key)
+        if self._flush() or self.cache is None:
+            return self.connection.hexists(self.pk, key)
+        return self._cached(key, lambda transform: self._fetch(key, transform)) is not None
 
     def __len__(self):
         """
         HLEN
         """
-        return self.connection.hlen(self.pk)
+        self._flush()
+        return self._cached(LENGTH, lambda transform: self.connection.hlen(self.pk))
 
     def clear(self):
         """
         Remove all items from the dictionary.
         """
-        self.connection.delete(self.pk)
+        return self._command("delete", self.pk, transform=self._invalidate_cache)
 
     def to_dict(self):
         """
@@ -79,7 +575,53 @@ class Dict(RedisDataStructure):
 
         Return a dict instance with the same key/value pairs
         """
-        return self.connection.hgetall(self.pk)
+        decode = self.codec.decode
+        return self._command("hgetall", self.pk, transform=lambda values: dict((k, decode(v)) for k, v in values.iteritems()))
+
+    def __iter__(self):
+        """
+        HSCAN
+
+        Iterate over the keys without loading the whole hash.
+        """
+        return self.iterkeys()
+
+    def scan(self, count=None, match=None):
+        """
+        HSCAN
+
+        Generate the (key, value) pairs in batches of about count items, 
+        optionally only the keys matching the glob-style pattern match.
+        Memory use is constant on both sides. As with HSCAN, keys changed during 
+        the iteration may be skipped or returned more than once.
+        """
+        self._flush()
+        decode = self.codec.decode
+        return ((k, decode(v)) for k, v in self.connection.hscan_iter(self.pk, match=match, count=count))
+
+    def iteritems(self):
+        """
+        HSCAN
+
+        Return an iterator over the dictionary’s (key, value) pairs.
+        """
+        return self.scan()
+
+    def iterkeys(self):
+        """
+        HSCAN
+
+        Return an iterator over the dictionary’s keys.
+        """
+        return (k for k, v in self.scan())
+
+    def itervalues(self):
+        """
+        HSCAN
+
+        Return an iterator over the dictionary’s values.
+        """
+        return (v for k, v in self.scan())
 
     def get(self, key, *args):
         """
@@ -89,8 +631,10 @@ class Dict(RedisDataStructure):
         If default is not given, it defaults to None, so that this method never raises a KeyError.
         """
         default = args[0] if args else None
-        value = self.connection.hget(self.pk, key)
-        return value if value else default    
+        result = lambda value: self.codec.decode(value) if value else default
+        if self.cache is not None:
+            return self._cached(key, lambda transform: self._fetch(key, transform), result)
+        return self._command("hget", self.pk, key, transform=result)
 
     def items(self):
         """
@@ -98,7 +642,8 @@ class Dict(RedisDataStructure):
 
         Return a copy of the dictionary’s list of (key, value) pairs.
         """
-        return [(k, v) for k, v in self.connection.hgetall(self.pk).iteritems()]
+        decode = self.codec.decode
+        return self._command("hgetall", self.pk, transform=lambda values: [(k, decode(v)) for k, v in values.iteritems()])
 
     def keys(self):
         """
@@ -106,26 +651,23 @@ class Dict(RedisDataStructure):
 
         Return a copy of the dictionary’s list of keys. See the note for dict.items().
         """
-        return self.connection.hkeys(self.pk)
+        return self._command("hkeys", self.pk)
         
     def pop(self, key, *args):
         """
         If key is in the dictionary, remove it and return its value, else return default. 
         If default is not given and key is not in the dictionary, a KeyError is raised.
         """
-        pipe = self.connection.pipeline()
-        pipe.hexists(self.pk, key)
-        pipe.hget(self.pk, key)
-        pipe.hdel(self.pk, key)
-        key_exists, key_value, status = pipe.execute()
-
-        if key_exists: # Key exists...
-            return key_value # return value. Already removed
-        else:
-            if args:
-                return args[0] # default value
+        def result(key_value):
+            self._invalidate_cache()
+            if key_value is not None: # Key existed...
+                return self.codec.decode(key_value) # return value. Already removed
             else:
-                raise KeyError(key)
+                if args:
+                    return args[0] # default value
+                else:
+                    raise KeyError(key)
+        return self._script(scripts.DICT_POP, [self.pk], [key], transform=result)
 
     def setdefault(self, key, *args):
         """
@@ -135,12 +677,11 @@ class Dict(RedisDataStructure):
         If not, insert key with a value of default and return default. default defaults to None.
         """
         default = args[0] if args else None
-        pipe = self.connection.pipeline()
-        pipe.hexists(self.pk, key)
-        pipe.hget(self.pk, key)
-        pipe.hsetnx(self.pk, key, default)
-        key_exists, key_value, status = pipe.execute()
-        return key_value if key_exists else default
+
+        def result(key_value):
+            self._invalidate_cache()
+            return self.codec.decode(key_value) if key_value is not None else default
+        return self._script(scripts.DICT_SETDEFAULT, [self.pk], [key, self._encode(default)], transform=result)
 
     def update(self, *args, **kwargs):
         """
@@ -152,21 +693,21 @@ class Dict(RedisDataStructure):
         If keyword arguments are specified, the dictionary is then updated with those key/value pairs: 
         d.update(red=1, blue=2).
         """
-        pipe = self.connection.pipeline()
+        pipe = self._pipeline()
 
         for arg in args:
             _type = type(arg)
             if _type == dict:
                 if arg:
-                    pipe.hmset(self.pk, arg)
+                    pipe.hmset(self.pk, dict((k, self._encode(v)) for k, v in arg.iteritems()))
             elif _type == list or _type == tuple:
                 for tup in arg:
-                    pipe.hset(self.pk, tup[0], tup[1])
+                    pipe.hset(self.pk, tup[0], self._encode(tup[1]))
 
         if kwargs:
-            pipe.hmset(self.pk, kwargs)
+            pipe.hmset(self.pk, dict((k, self._encode(v)) for k, v in kwargs.iteritems()))
 
-        pipe.execute()
+        return self._execute(pipe, lambda replies: self._invalidate_cache())
 
     def values(self):
         """
@@ -174,7 +715,45 @@ class Dict(RedisDataStructure):
 
         Return a copy of the dictionary’s list of values.
         """
-        return self.connection.hvals(self.pk)
+        return self._command("hvals", self.pk, transform=self._decode_all)
+
+    def to_numpy(self, dtype=None, key_dtype=None):
+        """
+        HGETALL
+
+        Return (keys, values), the keys and values as two numpy arrays in the same
+        order. Values are decoded by the codec into dtype (float64 by default) in one
+        vectorized step, keys are strings or parsed into key_dtype. As with
+        List.to_numpy(), numbers stored as text are joined server side. Requires numpy.
+        """
+        key_dtype = key_dtype if key_dtype is not None else str
+        if self.codec.joins(dtype):
+            join_keys = RAW.joins(key_dtype)
+            def joined(replies):
+                count, keys, values = replies[0]
+                keys = RAW.decode_joined(keys, count, key_dtype) if join_keys else RAW.decode_array(keys, key_dtype)
+                return keys, self.codec.decode_joined(values, count, dtype)
+            pipe = self._pipeline()
+            scripts.HASH_JOIN.queue(pipe, [self.pk], [int(join_keys)])
+            return self._execute(pipe, joined, command="hgetall")
+
+        def result(values):
+            return RAW.decode_array(values.keys(), key_dtype), self.codec.decode_array(values.values(), dtype)
+        return self._command("hgetall", self.pk, transform=result)
+
+    def from_numpy(self, keys, values):
+        """
+        HMSET
+
+        Set the keys of an array (or sequence) to the values of an array of the same length.
+        """
+        if len(keys) != len(values):
+            raise ValueError("%d keys for %d values" % (len(keys), len(values)))
+        if not len(keys):
+            return None
+        keys = keys.tolist() if hasattr(keys, "tolist") else keys
+        mapping = dict(zip(keys, self.codec.encode_array(values)))
+        return self._command("hmset", self.pk, mapping, transform=lambda reply: self._invalidate_cache())
 
 
     def incrby(self, key, value=1):
@@ -182,42 +761,83 @@ class Dict(RedisDataStructure):
         HINCRBY
         HINCRBYFLOAT
 
-        Increment a key by value
+        Increment a key by value. Returns the new value, or None with write_behind,
+        where the increment is sent later.
         """
         if type(value) == int:
-            op = self.connection.hincrby
+            op = "hincrby"
         elif type(value) == float:
-            op = self.connection.hincrbyfloat
+            op = "hincrbyfloat"
         else:
             raise TypeError("value must be int or float")
 
-        try:
-            op(self.pk, key, value)
-        except redis.exceptions.ResponseError, e:
-            raise TypeError("key's value must be int or float")
+        if self.counters is not None:
+            return self.counters.add(self, key, value)
+        return self._command(op, self.pk, key, value, transform=self._invalidate_cache,
+                             error=TypeError("key's value must be int or float"))
+
+    def flush(self):
+        """
+        Write the pending write_behind increments, those of every Dict sharing
+        the buffer. Returns how many fields were written.
+        """
+        return self.counters.flush() if self.counters is not None else 0
 
 
 class Set(RedisDataStructure):
     def __init__(self, *args, **kwargs):
         super(Set, self).__init__(*args, **kwargs)
         if args: # initial data
-            elements = list(args[0])
-            self.connection.sadd(self.pk, *elements)
+            elements = [self._encode(e) for e in args[0]]
+            self._write("sadd", args=elements)
+
+    def _write(self, command, changed=None, keys=(), args=(), transform=None):
+        """
+        Run command on the keys of the changed sets (the set by default), then keys,
+        then args, and return transform(reply). The command runs in a script that
+        also bumps the versions of the changed sets memoized results use, checked
+        on the server, so that these results are not reused whichever instance writes.
+        """
+        changed = [self] if changed is None else changed
+        return self._script(scripts.SET_WRITE, [VERSIONS] + [s.pk for s in changed] + list(keys),
+                            [command, len(changed)] + list(args), transform=transform)
 
     def __contains__(self, key):
         """
         SISMEMBER
         """
-        return self.connection.sismember(self.pk, key)
+        self._flush()
+        return self._cached(key, lambda transform: self.connection.sismember(self.pk, self._encode(key)))
 
     def __len__(self):
         """
         SCARD
         """
-        return self.connection.scard(self.pk)
+        self._flush()
+        return self._cached(LENGTH, lambda transform: self.connection.scard(self.pk))
+
+    def __iter__(self):
+        """
+        SSCAN
+        """
+        return self.scan()
+
+    def scan(self, count=None, match=None):
+        """
+        SSCAN
+
+        Generate the members in batches of about count items, optionally only 
+        the ones matching the glob-style pattern match.
+        Memory use is constant on both sides. As with SSCAN, members changed during 
+        the iteration may be skipped or returned more than once.
+        """
+        self._flush()
+        decode = self.codec.decode
+        return (decode(m) for m in self.connection.sscan_iter(self.pk, match=match, count=count))
 
     def __str__(self):
-        return "Set([%s])" % (", ".join([m for m in self.connection.smembers(self.pk)]))
+        self._flush()
+        return "Set([%s])" % (", ".join([str(m) for m in self._decode_all(self.connection.smembers(self.pk))]))
 
     def update(self, *other_sets):
         """
@@ -232,34 +852,39 @@ class Set(RedisDataStructure):
         SADD
         Add element element to the set.
         """
-        self.connection.sadd(self.pk, *elements)
+        elements = [self._encode(e) for e in elements]
+        return self._write("sadd", args=elements, transform=self._invalidate_cache)
 
     def remove(self, element):
         """
         SREM
         Remove element from the set. Raises KeyError if elem is not contained in the set.
         """
-        count = self.connection.srem(self.pk, element)
-        if not count:
-            raise KeyError("")
+        def result(count):
+            self._invalidate_cache()
+            if not count:
+                raise KeyError("")
+        return self._write("srem", args=[self._encode(element)], transform=result)
 
     def discard(self, element):
         """
         SREM
         Remove element from the set if it is present.
         """
-        self.connection.srem(self.pk, element)
+        return self._write("srem", args=[self._encode(element)], transform=self._invalidate_cache)
 
     def pop(self):
         """
         SPOP
         Remove and return an arbitrary element from the set. Raises KeyError if the set is empty.
         """
-        random_value = self.connection.spop(self.pk)
-        if random_value:
-            return random_value
-        else:
-            raise KeyError("empty set")
+        def result(random_value):
+            self._invalidate_cache()
+            if random_value:
+                return self.codec.decode(random_value)
+            else:
+                raise KeyError("empty set")
+        return self._write("spop", transform=result)
 
     def random(self, count=1):
         """
@@ -269,21 +894,28 @@ class Set(RedisDataStructure):
         is allowed to return the same element multiple times. In this case the numer of returned 
         elements is the absolute value of the specified count.
         """
-        return self.connection.srandmember(self.pk, count)
+        return self._command("srandmember", self.pk, count, transform=self._decode_all)
 
     def clear(self):
         """
-        Remove all elements from the set.
+        DEL
+        HDEL
+
+        Remove all elements from the set, and its version.
         """
-        pass
+        pipe = self._pipeline()
+        pipe.delete(self.pk)
+        pipe.hdel(VERSIONS, self.pk)
+        return self._execute(pipe, lambda replies: self._invalidate_cache(), command="delete")
 
     def _set_operation(self, operator, *other_sets, **kwargs):
-        if "destination" in kwargs and kwargs["destination"]:
+        if "destination" in kwargs and kwargs["destination"] is not None: # empty ones are false
             destination = kwargs["destination"]
             if not isinstance(destination, Set):
                 raise TypeError("destination not a Set")
         else:
-            destination = Set()
+            ttl = kwargs["ttl"] if "ttl" in kwargs and kwargs["ttl"] else TEMPORARY_TTL
+            destination = Set(connection=self._connection_spec(), codec=self.codec, ttl=ttl)
         
         # Sets to be intersected
         ids = [self.pk]
@@ -292,7 +924,9 @@ class Set(RedisDataStructure):
                 raise TypeError("not a Set")
             ids.append(os.pk)
 
-        operator(destination.pk, *ids)
+        # Inside a batch the destination is returned right away:
+        # commands queued on it later run after the store
+        destination._write(operator, [destination], ids, transform=destination._invalidate_cache)
         return destination
 
     def intersection_update(self, *other_sets):
@@ -307,9 +941,13 @@ class Set(RedisDataStructure):
         """
         SINTER
         Accepts an destination parameter, which must be a Set instance. 
-        If ommited, a new Set will be created, with elements common to the set and all others.
+        If ommited, a new Set will be created, with elements common to the set and all others,
+        that expires after ttl seconds (TEMPORARY_TTL by default).
+        With memoize=seconds, the result is memoized instead, see SetExpression.memoize().
         """
-        op = self.connection.sinterstore
+        if "memoize" in kwargs and kwargs["memoize"]:
+            return SetExpression("&", (self,) + other_sets).memoize(kwargs["memoize"])
+        op = "sinterstore"
         return self._set_operation(op, *other_sets, **kwargs)
 
     def difference_update(self, *other_sets):
@@ -324,8 +962,11 @@ class Set(RedisDataStructure):
         SDIFF
         set - other - ...
         Return a new set with elements in the set that are not in the others.
+        Accepts destination, ttl and memoize, as intersection().
         """
-        op = self.connection.sdiffstore
+        if "memoize" in kwargs and kwargs["memoize"]:
+            return SetExpression("-", (self,) + other_sets).memoize(kwargs["memoize"])
+        op = "sdiffstore"
         return self._set_operation(op, *other_sets, **kwargs)
 
     def union(self, *other_sets, **kwargs):
@@ -333,8 +974,11 @@ class Set(RedisDataStructure):
         SUNION
         set | other | ...
         Return a new set with elements from the set and all others.
+        Accepts destination, ttl and memoize, as intersection().
         """
-        op = self.connection.sunionstore
+        if "memoize" in kwargs and kwargs["memoize"]:
+            return SetExpression("|", (self,) + other_sets).memoize(kwargs["memoize"])
+        op = "sunionstore"
         return self._set_operation(op, *other_sets, **kwargs)
 
     def isdisjoint(self, other):
@@ -344,7 +988,7 @@ class Set(RedisDataStructure):
         """
         if not isinstance(other, Set):
             raise TypeError("not a Set")
-        return not len(self.connection.sinter(self.pk, other.pk))
+        return self._command("sinter", self.pk, other.pk, transform=lambda members: not len(members))
 
     def issubset(self, other):
         """
@@ -353,15 +997,8 @@ class Set(RedisDataStructure):
         """
         if not isinstance(other, Set):
             raise TypeError("not a Set")
-
-        tempid = "temp:%d:%s:%s" % (random.randint(0,1000), self.pk, other.pk)
-        pipe = self.connection.pipeline()
-        pipe.scard(self.pk) # Current set size
-        pipe.sinterstore(tempid, self.pk, other.pk) # intersection result
-        pipe.scard(tempid) # intersection result size
-        pipe.delete(tempid) # removes intersection resulte
-        len_self, inter, len_inter, delete = pipe.execute()
-        return len_inter == len_self
+        return self._script(scripts.SET_SUBSET, [self.pk, other.pk], [],
+                            transform=lambda replies: bool(replies[2]))
 
     def __le__(self, other):
         """
@@ -378,15 +1015,10 @@ class Set(RedisDataStructure):
         if not isinstance(other, Set):
             raise TypeError("not a Set")
 
-        tempid = "temp:%d:%s:%s" % (random.randint(0,1000), self.pk, other.pk)
-        pipe = self.connection.pipeline()
-        pipe.scard(self.pk) # Current set size
-        pipe.scard(other.pk) # other set size
-        pipe.sinterstore(tempid, self.pk, other.pk) # intersection result
-        pipe.scard(tempid) # intersection result size
-        pipe.delete(tempid) # removes intersection resulte
-        len_self, len_other, inter, len_inter, delete = pipe.execute()
-        return len_inter == len_self and len_other > len_self
+        def result(replies):
+            len_self, len_other, subset = replies
+            return bool(subset) and len_other > len_self
+        return self._script(scripts.SET_SUBSET, [self.pk, other.pk], [], transform=result)
            
     def issuperset(self, other):
         """
@@ -394,15 +1026,8 @@ class Set(RedisDataStructure):
         """
         if not isinstance(other, Set):
             raise TypeError("not a Set")
-
-        tempid = "temp:%d:%s:%s" % (random.randint(0,1000), self.pk, other.pk)
-        pipe = self.connection.pipeline()
-        pipe.scard(other.pk) # Current set size
-        pipe.sinterstore(tempid, self.pk, other.pk) # intersection result
-        pipe.scard(tempid) # intersection result size
-        pipe.delete(tempid) # removes intersection resulte
-        len_other, inter, len_inter, delete = pipe.execute()
-        return len_inter == len_other
+        return self._script(scripts.SET_SUBSET, [other.pk, self.pk], [],
+                            transform=lambda replies: bool(replies[2]))
 
     def __ge__(self, other):
         """
@@ -417,22 +1042,61 @@ class Set(RedisDataStructure):
         if not isinstance(other, Set):
             raise TypeError("not a Set")
 
-        tempid = "temp:%d:%s:%s" % (random.randint(0,1000), self.pk, other.pk)
-        pipe = self.connection.pipeline()
-        pipe.scard(self.pk) # Current set size
-        pipe.scard(other.pk) # other set size
-        pipe.sinterstore(tempid, self.pk, other.pk) # intersection result
-        pipe.scard(tempid) # intersection result size
-        pipe.delete(tempid) # removes intersection resulte
-        len_self, len_other, inter, len_inter, delete = pipe.execute()
-        return len_inter == len_other and len_other < len_self
+        def result(replies):
+            len_other, len_self, superset = replies
+            return bool(superset) and len_other < len_self
+        return self._script(scripts.SET_SUBSET, [other.pk, self.pk], [], transform=result)
+
+    def __and__(self, other):
+        """
+        set & other
+        A lazy SetExpression, evaluated on the server when consumed.
+        """
+        return SetExpression("&", [self, other])
+
+    def __or__(self, other):
+        """
+        set | other
+        A lazy SetExpression, evaluated on the server when consumed.
+        """
+        return SetExpression("|", [self, other])
+
+    def __sub__(self, other):
+        """
+        set - other
+        A lazy SetExpression, evaluated on the server when consumed.
+        """
+        return SetExpression("-", [self, other])
+
+    def __xor__(self, other):
+        """
+        set ^ other
+        A lazy SetExpression, evaluated on the server when consumed.
+        """
+        return SetExpression("^", [self, other])
+
+    def __iand__(self, other):
+        (self & other).store(self)
+        return self
+
+    def __ior__(self, other):
+        (self | other).store(self)
+        return self
+
+    def __isub__(self, other):
+        (self - other).store(self)
+        return self
+
+    def __ixor__(self, other):
+        (self ^ other).store(self)
+        return self
 
     def members(self):
         """
         Returns all the members of the set
         SMEMBERS
         """
-        return self.connection.smembers(self.pk)
+        return self._command("smembers", self.pk, transform=lambda members: set(self._decode_all(members)))
 
     def move(self, element, other_set):
         """
@@ -443,13 +1107,851 @@ class Set(RedisDataStructure):
         """
         if not isinstance(other_set, Set):
             raise TypeError("not a Set")
-        result = self.connection.smove(self.pk, other_set.pk, element)
-        if not result:
-            raise KeyError("element not a member of source")
+        def result(moved):
+            self._invalidate_cache()
+            other_set._invalidate_cache()
+            if not moved:
+                raise KeyError("element not a member of source")
+        return self._write("smove", [self, other_set], args=[self._encode(element)], transform=result)
+
+
+class SetExpression(object):
+    """
+    a & b, a | b, a - b and a ^ b on Sets, and on expressions, build an expression
+    tree instead of storing intermediate sets. It is evaluated on the server,
+    in a single script call, when consumed: len(), in, iteration, members(),
+    or store() to write the result into a Set.
+    Membership only runs SISMEMBER on every set, and len() only returns the
+    count, with SINTERCARD (redis 7) for an intersection of sets.
+    Every set must use the same connection. Values are decoded with the codec
+    of the first set.
+    """
+    def __init__(self, operator, operands):
+        self.operator = operator
+        self.operands = []
+        for operand in operands:
+            # a & b & c is one intersection, a - b - c one difference
+            if isinstance(operand, SetExpression) and operand.operator == operator and \
+                    (operator != "-" or not self.operands):
+                self.operands.extend(operand.operands)
+            elif isinstance(operand, (Set, SetExpression)):
+                self.operands.append(operand)
+            else:
+                raise TypeError("not a Set")
+
+        self.sets = []
+        for leaf in self._leaves():
+            if leaf.pk not in [s.pk for s in self.sets]:
+                self.sets.append(leaf)
+        self.first = self.sets[0]
+        self.codec = self.first.codec
+        if any(s.connection is not self.first.connection for s in self.sets):
+            raise ValueError("sets on different connections")
+
+    def _leaves(self):
+        for operand in self.operands:
+            if isinstance(operand, SetExpression):
+                for leaf in operand._leaves():
+                    yield leaf
+            else:
+                yield operand
+
+    def _postfix(self, positions):
+        tokens = []
+        for operand in self.operands:
+            if isinstance(operand, SetExpression):
+                tokens.extend(operand._postfix(positions))
+            else:
+                tokens.append("k%d" % positions[operand.pk])
+        tokens.append("%s%d" % (self.operator, len(self.operands)))
+        return tokens
+
+    def _arguments(self, mode, argument="", destination=None):
+        positions = dict((s.pk, i + 1) for i, s in enumerate(self.sets))
+        keys = [s.pk for s in self.sets]
+        if mode == "store":
+            keys += [destination.pk, VERSIONS]
+        elif mode == "memo":
+            keys += [destination.pk]
+        return keys, [mode, argument] + self._postfix(positions)
+
+    def _evaluate(self, mode, argument="", destination=None, transform=None):
+        keys, args = self._arguments(mode, argument, destination)
+        runner = destination if mode == "store" else self.first # keeps the destination's expiry
+        return runner._script(scripts.SET_EXPRESSION, keys, args, transform=transform)
+
+    def _read(self, mode, argument=""):
+        """
+        Execute the active batch, if any, and return the reply of the expression
+        in mode, run on the connection: never a Deferred.
+        """
+        self.first._flush()
+        keys, args = self._arguments(mode, argument)
+        return scripts.SET_EXPRESSION(self.first.connection, keys, args)
+
+    def __and__(self, other):
+        return SetExpression("&", [self, other])
+
+    def __or__(self, other):
+        return SetExpression("|", [self, other])
+
+    def __sub__(self, other):
+        return SetExpression("-", [self, other])
+
+    def __xor__(self, other):
+        return SetExpression("^", [self, other])
+
+    def __len__(self):
+        """
+        SINTERCARD
+        """
+        self.first._flush()
+        if self.operator == "&" and all(isinstance(o, Set) for o in self.operands):
+            pool = self.first.connection.connection_pool
+            if _SINTERCARD.get(id(pool), True):
+                try:
+                    return self.first.connection.execute_command("SINTERCARD", len(self.sets),
+                                                                 *[s.pk for s in self.sets])
+                except redis.exceptions.ResponseError: # before redis 7
+                    _SINTERCARD[id(pool)] = False
+        return self._read("count")
+
+    def __contains__(self, member):
+        return bool(self._read("contains", self.codec.encode(member)))
+
+    def __iter__(self):
+        return iter(self.first._decode_all(self._read("members")))
+
+    def members(self):
+        """
+        Returns all the members of the result
+        """
+        return self._evaluate("members", transform=lambda members: set(self.first._decode_all(members)))
+
+    def store(self, destination=None, ttl=TEMPORARY_TTL):
+        """
+        Write the result into destination and return it. By default a new Set,
+        expiring after ttl seconds.
+        """
+        if destination is None:
+            destination = Set(connection=self.first._connection_spec(), codec=self.codec, ttl=ttl)
+        elif not isinstance(destination, Set):
+            raise TypeError("destination not a Set")
+        elif destination.connection is not self.first.connection:
+            raise ValueError("destination on a different connection")
+        self._evaluate("store", destination=destination, transform=destination._invalidate_cache)
+        return destination
+
+    def memoize(self, ttl=MEMO_TTL):
+        """
+        HSETNX
+        HMGET
+
+        Return a Set holding the result, stored under a key made of the expression
+        and the versions of its sets, that the Set methods changing them bump.
+        The same expression then reuses the stored result until one of its sets
+        changes. Each reuse extends the key's life to ttl seconds: read the returned
+        Set within that time, and do not change it.
+        Sets changed by other means than Set methods do not invalidate results.
+        Empty results cannot be stored, they are computed every time.
+        """
+        self.first._flush()
+        pipe = self.first.connection.pipeline()
+        for s in self.sets: # start tracking the versions of the sets,
+            # from a random version: a set tracked again never reuses the results of its past versions
+            pipe.hsetnx(VERSIONS, s.pk, uuid.uuid4().int >> 80)
+        pipe.hmget(VERSIONS, [s.pk for s in self.sets])
+        versions = pipe.execute()[-1]
+        positions = dict((s.pk, i + 1) for i, s in enumerate(self.sets))
+        signature = self._postfix(positions) + ["%s@%s" % (s.pk, v) for s, v in zip(self.sets, versions)]
+        destination = Set(name=MEMO_PREFIX + hashlib.sha1("\n".join(signature)).hexdigest(),
+                          connection=self.first._connection_spec(), codec=self.codec)
+        self._evaluate("memo", ttl, destination=destination, transform=destination._invalidate_cache)
+        return destination
+
+    def __repr__(self):
+        return "(%s)" % (" %s " % self.operator).join(
+            repr(o) if isinstance(o, SetExpression) else o.pk for o in self.operands)
+
+
+class SortedSet(RedisDataStructure):
+    def __init__(self, *args, **kwargs):
+        super(SortedSet, self).__init__(*args, **kwargs)
+        if args: # initial data
+            self.update(args[0])
+
+    def __len__(self):
+        """
+        ZCARD
+        """
+        self._flush()
+        return self.connection.zcard(self.pk)
+
+    def __contains__(self, member):
+        """
+        ZSCORE
+        """
+        self._flush()
+        return self.connection.zscore(self.pk, self._encode(member)) is not None
+
+    def __iter__(self):
+        """
+        ZRANGE in pages
+        """
+        return self.range()
+
+    def __getitem__(self, member_or_slice):
+        """
+        ZSCORE / ZRANGE
+
+        The score of a member, or the members between two ranks for a slice.
+        """
+        if type(member_or_slice) == slice:
+            return self._get_range(member_or_slice.start, member_or_slice.stop)
+        return self.score(member_or_slice)
+
+    def __setitem__(self, member, score):
+        """
+        ZADD
+        """
+        return self.update({member: score})
+
+    def __delitem__(self, member):
+        """
+        ZREM
+        """
+        def result(count):
+            if not count:
+                raise KeyError(member)
+        return self._command("zrem", self.pk, self._encode(member), transform=result)
+
+    def _check_index(self, value):
+        try:
+            return long(value)
+        except ValueError, e:
+            raise TypeError("sorted set indices must be integers")
+
+    def _get_range(self, start, stop):
+        """
+        ZRANGE
+        """
+        start = 0 if start is None else self._check_index(start)
+        if stop is None:
+            return self._command("zrange", self.pk, start, -1, transform=self._decode_all)
+        stop = self._check_index(stop)
+        if start == stop or stop == 0:
+            return []
+         # python end index exclusive, redis inclusive
+        return self._command("zrange", self.pk, start, stop-1, transform=self._decode_all)
+
+    def update(self, *args, **kwargs):
+        """
+        ZADD
+
+        Add members or update their scores, all in one command.
+        Accepts a dict of member: score, an iterable of (member, score) pairs 
+        and member=score keyword arguments.
+        """
+        arguments = []
+        for arg in args:
+            pairs = arg.iteritems() if isinstance(arg, dict) else arg
+            for member, score in pairs:
+                arguments.extend([score, self._encode(member)])
+        for member, score in kwargs.iteritems():
+            arguments.extend([score, self._encode(member)])
+
+        if arguments:
+            # Redis and StrictRedis disagree on the zadd argument order
+            return self._command("execute_command", "ZADD", self.pk, *arguments)
+
+    def remove(self, *members):
+        """
+        ZREM
+
+        Remove members, ignoring the ones not in the sorted set. Return how many were removed.
+        """
+        members = [self._encode(m) for m in members]
+        return self._command("zrem", self.pk, *members)
+
+    def clear(self):
+        """
+        Remove all members.
+        """
+        return self._command("delete", self.pk)
+
+    def score(self, member):
+        """
+        ZSCORE
+
+        Raises KeyError if member is not in the sorted set.
+        """
+        def result(score):
+            if score is None:
+                raise KeyError(member)
+            return score
+        return self._command("zscore", self.pk, self._encode(member), transform=result)
+
+    def rank(self, member, reverse=False):
+        """
+        ZRANK / ZREVRANK
+
+        Position of member, from the lowest score or from the highest one if reverse.
+        Raises KeyError if member is not in the sorted set.
+        """
+        def result(rank):
+            if rank is None:
+                raise KeyError(member)
+            return rank
+        return self._command("zrevrank" if reverse else "zrank", self.pk, self._encode(member), transform=result)
+
+    def incrby(self, member, value=1):
+        """
+        ZINCRBY
+
+        Increment the score of member by value and return the new score.
+        """
+        if type(value) not in (int, long, float):
+            raise TypeError("value must be int or float")
+        return self._command("zincrby", self.pk, self._encode(member), value)
+
+    def count(self, min="-inf", max="+inf"):
+        """
+        ZCOUNT
+
+        Number of members with min <= score <= max. Prefix a bound with "(" to exclude it.
+        """
+        return self._command("zcount", self.pk, min, max)
+
+    def _pop(self, command, count):
+        def result(reply):
+            return [(self.codec.decode(reply[i]), float(reply[i + 1])) for i in range(0, len(reply), 2)]
+        return self._command("execute_command", command, self.pk, count, transform=result)
 
+    def popmin(self, count=1):
+        """
+        ZPOPMIN
+
+        Remove and return up to count (member, score) pairs with the lowest scores.
+        """
+        return self._pop("ZPOPMIN", count)
+
+    def popmax(self, count=1):
+        """
+        ZPOPMAX
+
+        Remove and return up to count (member, score) pairs with the highest scores.
+        """
+        return self._pop("ZPOPMAX", count)
+
+    def range(self, start=0, stop=None, reverse=False, withscores=False, count=100):
+        """
+        ZRANGE / ZREVRANGE in pages
+
+        Generate the members from rank start to stop (exclusive, None for the end),
+        lowest score first or highest first if reverse, as (member, score) pairs if withscores.
+        Each round trip reads count members in O(log(n) + count).
+        Members added or removed during the iteration shift the following pages.
+        """
+        self._flush()
+        decode = self.codec.decode
+        command = self.connection.zrevrange if reverse else self.connection.zrange
+        if start < 0 or (stop is not None and stop < 0):
+            length = self.connection.zcard(self.pk)
+            start = max(start + length, 0) if start < 0 else start
+            stop = max(stop + length, 0) if stop is not None and stop < 0 else stop
+        while stop is None or start < stop:
+            end = start + count - 1
+            if stop is not None:
+                end = min(end, stop - 1)
+            page = command(self.pk, start, end, withscores=withscores)
+            for item in page:
+                yield (decode(item[0]), item[1]) if withscores else decode(item)
+            if len(page) < end - start + 1:
+                return
+            start = end + 1
+
+    def range_by_score(self, min="-inf", max="+inf", reverse=False, withscores=False, count=100):
+        """
+        ZRANGEBYSCORE / ZREVRANGEBYSCORE in pages
+
+        Generate the members with min <= score <= max, lowest score first or highest 
+        first if reverse, as (member, score) pairs if withscores. Prefix a bound with "(" 
+        to exclude it.
+        Each page starts from the last score read instead of an offset, so every round 
+        trip costs O(log(n) + count) however deep the page is.
+        """
+        self._flush()
+        bound = max if reverse else min
+        last_score = None
+        ties = 0 # members already read with the last score
+        while True:
+            if reverse:
+                page = self.connection.zrevrangebyscore(self.pk, bound, min, start=ties, num=count, withscores=True)
+            else:
+                page = self.connection.zrangebyscore(self.pk, bound, max, start=ties, num=count, withscores=True)
+            for member, score in page:
+                member = self.codec.decode(member)
+                yield (member, score) if withscores else member
+            if len(page) < count:
+                return
+
+            score = page[-1][1]
+            same = len([s for m, s in page if s == score])
+            ties = ties + same if score == last_score else same
+            last_score = score
+            bound = repr(score)
+
+    def range_by_lex(self, min="-", max="+", reverse=False, count=100):
+        """
+        ZRANGEBYLEX / ZREVRANGEBYLEX in pages
+
+        Generate the members between min and max in lexicographic order, for sorted 
+        sets where every member has the same score. Bounds are "[value" (inclusive),
+        "(value" (exclusive), "-" and "+".
+        Each page starts after the last member read, in O(log(n) + count).
+        """
+        self._flush()
+        while True:
+            if reverse:
+                page = self.connection.zrevrangebylex(self.pk, max, min, start=0, num=count)
+            else:
+                page = self.connection.zrangebylex(self.pk, min, max, start=0, num=count)
+            for member in page:
+                yield self.codec.decode(member)
+            if len(page) < count:
+                return
+            if reverse:
+                max = "(" + page[-1]
+            else:
+                min = "(" + page[-1]
+
+    def scan(self, count=None, match=None):
+        """
+        ZSCAN
+
+        Generate the (member, score) pairs in batches of about count items, in no 
+        particular order, optionally only the members matching the glob-style pattern match.
+        """
+        self._flush()
+        decode = self.codec.decode
+        return ((decode(m), score) for m, score in self.connection.zscan_iter(self.pk, match=match, count=count))
+
+    def _set_operation(self, operator, *other_sets, **kwargs):
+        if "destination" in kwargs and kwargs["destination"] is not None: # empty ones are false
+            destination = kwargs["destination"]
+            if not isinstance(destination, SortedSet):
+                raise TypeError("destination not a SortedSet")
+        else:
+            ttl = kwargs["ttl"] if "ttl" in kwargs and kwargs["ttl"] else TEMPORARY_TTL
+            destination = SortedSet(connection=self._connection_spec(), codec=self.codec, ttl=ttl)
+
+        ids = [self.pk]
+        for os in other_sets:
+            if not isinstance(os, SortedSet):
+                raise TypeError("not a SortedSet")
+            ids.append(os.pk)
+
+        if "weights" in kwargs and kwargs["weights"]:
+            weights = kwargs["weights"]
+            if len(weights) != len(ids):
+                raise ValueError("one weight per sorted set")
+            ids = dict(zip(ids, weights))
+
+        aggregate = kwargs["aggregate"] if "aggregate" in kwargs else None
+        destination._command(operator, destination.pk, ids, aggregate=aggregate)
+        return destination
+
+    def union(self, *other_sets, **kwargs):
+        """
+        ZUNIONSTORE
+
+        Return a new sorted set with the members of the sorted set and all others.
+        Accepts destination (a SortedSet instance, by default a new one expiring after ttl
+        seconds, TEMPORARY_TTL unless given), weights (one per sorted set, self first) 
+        and aggregate ("SUM", "MIN" or "MAX") parameters.
+        """
+        return self._set_operation("zunionstore", *other_sets, **kwargs)
+
+    def intersection(self, *other_sets, **kwargs):
+        """
+        ZINTERSTORE
+
+        Return a new sorted set with the members common to the sorted set and all others.
+        Accepts the same parameters as union().
+        """
+        return self._set_operation("zinterstore", *other_sets, **kwargs)
+
+
+class IntBitSet(RedisDataStructure):
+    """
+    A Set of non negative integers (up to 2^32 - 1) stored as a bitmap, bit n
+    set when n is a member: one bit per possible member instead of tens of
+    bytes per member, and set algebra as BITOP on the server.
+    Memory is the highest member / 8 bytes, so this is for dense ids.
+
+    Has the Set API, except random() and move(), and operators build the result
+    right away. Members come back as ints, in increasing order when iterated.
+    """
+    def __init__(self, *args, **kwargs):
+        if "cache_size" in kwargs and kwargs["cache_size"]:
+            raise ValueError("IntBitSet has no near cache")
+        super(IntBitSet, self).__init__(*args, **kwargs)
+        if args: # initial data
+            self.add(*args[0])
+
+    def _offset(self, element):
+        if not isinstance(element, (int, long)):
+            raise TypeError("IntBitSet members are integers")
+        if not 0 <= element <= BITMAP_MAX:
+            raise ValueError("IntBitSet members are between 0 and %d" % BITMAP_MAX)
+        return element
+
+    def _check(self, others):
+        for other in others:
+            if not isinstance(other, IntBitSet):
+                raise TypeError("not an IntBitSet")
+        return [other.pk for other in others]
+
+    def add(self, *elements):
+        """
+        SETBIT
+
+        Add the elements, sent packed to a script, BITMAP_CHUNK per call, in one round trip.
+        Returns the number of elements that were not members.
+        """
+        offsets = [self._offset(e) for e in elements]
+        if not offsets:
+            return 0
+        pipe = self._pipeline()
+        for start in xrange(0, len(offsets), BITMAP_CHUNK):
+            chunk = offsets[start:start + BITMAP_CHUNK]
+            scripts.BITSET_ADD.queue(pipe, [self.pk], [struct.pack("<%dI" % len(chunk), *chunk)])
+        return self._execute(pipe, sum)
+
+    def remove(self, element):
+        """
+        SETBIT
+        Remove element from the set. Raises KeyError if it is not a member.
+        """
+        def result(previous):
+            if not previous:
+                raise KeyError(element)
+        return self._command("setbit", self.pk, self._offset(element), 0, transform=result)
+
+    def discard(self, element):
+        """
+        SETBIT
+        Remove element from the set if it is present.
+        """
+        return self._command("setbit", self.pk, self._offset(element), 0, transform=lambda previous: None)
+
+    def pop(self):
+        """
+        BITPOS
+        SETBIT
+        Remove and return the smallest member. Raises KeyError if the set is empty.
+        """
+        def result(position):
+            if position < 0:
+                raise KeyError("empty set")
+            return position
+        return self._script(scripts.BITSET_POP, [self.pk], [], transform=result)
+
+    def clear(self):
+        """
+        DEL
+        """
+        return self._command("delete", self.pk)
+
+    def __contains__(self, element):
+        """
+        GETBIT
+        """
+        self._flush()
+        if not isinstance(element, (int, long)) or not 0 <= element <= BITMAP_MAX:
+            return False
+        return bool(self.connection.getbit(self.pk, element))
+
+    def __len__(self):
+        """
+        BITCOUNT
+        """
+        self._flush()
+        return self.connection.bitcount(self.pk)
+
+    def __iter__(self):
+        return self.scan()
+
+    def scan(self, count=None):
+        """
+        GETRANGE
+
+        Generate the members in increasing order, reading count bytes
+        (BITMAP_SCAN by default) of the bitmap at a time.
+        """
+        self._flush()
+        count = count or BITMAP_SCAN
+        start = 0
+        while True:
+            data = self.connection.getrange(self.pk, start, start + count - 1)
+            for member in _bitmap_members(data, start):
+                yield member
+            if len(data) < count:
+                return
+            start += count
+
+    def members(self):
+        """
+        GET
+        Returns all the members of the set.
+        """
+        return self._command("get", self.pk, transform=lambda data: set(_bitmap_members(data or "")))
+
+    def __str__(self):
+        self._flush()
+        return "IntBitSet([%s])" % ", ".join(str(m) for m in self.scan())
+
+    def _set_operation(self, operator, *other_sets, **kwargs):
+        """
+        BITOP operator into destination: a given IntBitSet, or a new one
+        expiring after ttl seconds (TEMPORARY_TTL by default).
+        """
+        if "destination" in kwargs and kwargs["destination"] is not None: # empty ones are false
+            destination = kwargs["destination"]
+            if not isinstance(destination, IntBitSet):
+                raise TypeError("destination not an IntBitSet")
+        else:
+            ttl = kwargs["ttl"] if "ttl" in kwargs and kwargs["ttl"] else TEMPORARY_TTL
+            destination = IntBitSet(connection=self._connection_spec(), ttl=ttl)
+        ids = self._check(other_sets)
+
+        pipe = destination._pipeline()
+        if operator == "DIFF" and not ids: # a copy
+            pipe.bitop("OR", destination.pk, self.pk)
+        elif operator == "DIFF":
+            # no ANDNOT: self - others = self ^ (self & (others | ...))
+            # the temporary key expires if the DEL is never reached
+            temporary = "%s:%s" % (destination.pk, uuid.uuid4().hex)
+            pipe.bitop("OR", temporary, *ids)
+            pipe.bitop("AND", temporary, self.pk, temporary)
+            pipe.expire(temporary, TEMPORARY_TTL)
+            pipe.bitop("XOR", destination.pk, self.pk, temporary)
+            pipe.delete(temporary)
+        else:
+            pipe.bitop(operator, destination.pk, self.pk, *ids)
+        destination._execute(pipe, lambda replies: None)
+        return destination
+
+    def union(self, *other_sets, **kwargs):
+        """
+        BITOP OR
+        set | other | ...
+        Return a new set with elements from the set and all others.
+        Accepts destination and ttl, as Set.intersection().
+        """
+        return self._set_operation("OR", *other_sets, **kwargs)
+
+    def intersection(self, *other_sets, **kwargs):
+        """
+        BITOP AND
+        set & other & ...
+        Return a new set with elements common to the set and all others.
+        Accepts destination and ttl, as Set.intersection().
+        """
+        return self._set_operation("AND", *other_sets, **kwargs)
+
+    def difference(self, *other_sets, **kwargs):
+        """
+        BITOP
+        set - other - ...
+        Return a new set with elements in the set that are not in the others.
+        Accepts destination and ttl, as Set.intersection().
+        """
+        return self._set_operation("DIFF", *other_sets, **kwargs)
+
+    def symmetric_difference(self, other, **kwargs):
+        """
+        BITOP XOR
+        set ^ other
+        Return a new set with elements in either the set or other but not both.
+        Accepts destination and ttl, as Set.intersection().
+        """
+        return self._set_operation("XOR", other, **kwargs)
+
+    def update(self, *other_sets):
+        return self.union(*other_sets, destination=self)
+
+    def intersection_update(self, *other_sets):
+        return self.intersection(*other_sets, destination=self)
+
+    def difference_update(self, *other_sets):
+        return self.difference(*other_sets, destination=self)
+
+    def symmetric_difference_update(self, other):
+        return self.symmetric_difference(other, destination=self)
+
+    def _compare(self, other, result):
+        """
+        BITCOUNT
+        BITOP AND
+
+        Return result(members of the set, members of other, members in common).
+        """
+        self._check([other])
+        temporary = "%s:%s" % (self.pk, uuid.uuid4().hex)
+        pipe = self._pipeline()
+        pipe.bitcount(self.pk)
+        pipe.bitcount(other.pk)
+        pipe.bitop("AND", temporary, self.pk, other.pk)
+        pipe.expire(temporary, TEMPORARY_TTL) # if the DEL is never reached
+        pipe.bitcount(temporary)
+        pipe.delete(temporary)
+        return self._execute(pipe, lambda replies: result(replies[0], replies[1], replies[4]), command="bitcount")
+
+    def isdisjoint(self, other):
+        """
+        Return True if the set has no elements in common with other.
+        """
+        return self._compare(other, lambda len_self, len_other, common: common == 0)
+
+    def issubset(self, other):
+        """
+        set <= other
+        Test whether every element in the set is in other.
+        """
+        return self._compare(other, lambda len_self, len_other, common: common == len_self)
+
+    def issuperset(self, other):
+        """
+        set >= other
+        Test whether every element in other is in the set.
+        """
+        return self._compare(other, lambda len_self, len_other, common: common == len_other)
+
+    def __le__(self, other):
+        return self.issubset(other)
+
+    def __lt__(self, other):
+        return self._compare(other, lambda len_self, len_other, common: common == len_self < len_other)
+
+    def __ge__(self, other):
+        return self.issuperset(other)
+
+    def __gt__(self, other):
+        return self._compare(other, lambda len_self, len_other, common: common == len_other < len_self)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __xor__(self, other):
+        return self.symmetric_difference(other)
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
+
+
+class HyperLogLog(RedisDataStructure):
+    """
+    Approximate count of distinct items: at most 12KB however many items are
+    added, with a standard error of 0.81%. The items themselves are not kept.
+    """
+    def __init__(self, *args, **kwargs):
+        super(HyperLogLog, self).__init__(*args, **kwargs)
+        if args: # initial data
+            self.add(*args[0])
 
-class SortedSet(object):
-    pass
+    def _others(self, others):
+        for other in others:
+            if not isinstance(other, HyperLogLog):
+                raise TypeError("not a HyperLogLog")
+        return [other.pk for other in others]
+
+    def add(self, *items):
+        """
+        PFADD
+
+        Count the items. Returns whether the estimate changed.
+        """
+        if not items:
+            return False
+        return self._command("pfadd", self.pk, *[self._encode(i) for i in items], transform=bool)
+
+    def __len__(self):
+        """
+        PFCOUNT
+
+        Estimate of the number of distinct items added.
+        """
+        self._flush()
+        return self.connection.pfcount(self.pk)
+
+    def count(self):
+        """
+        PFCOUNT
+
+        As len(), but returns a Deferred inside a batch.
+        """
+        return self._command("pfcount", self.pk)
+
+    def union_count(self, *others):
+        """
+        PFCOUNT
+
+        Estimate of the number of distinct items added to this or any of the
+        others, without storing their union.
+        """
+        return self._command("pfcount", self.pk, *self._others(others))
+
+    def merge(self, *others, **kwargs):
+        """
+        PFMERGE
+
+        Return a HyperLogLog counting the items of this one and all others.
+        Accepts destination (a HyperLogLog instance, by default a new one expiring
+        after ttl seconds, TEMPORARY_TTL unless given).
+        """
+        if "destination" in kwargs and kwargs["destination"] is not None: # empty ones are false
+            destination = kwargs["destination"]
+            if not isinstance(destination, HyperLogLog):
+                raise TypeError("destination not a HyperLogLog")
+        else:
+            ttl = kwargs["ttl"] if "ttl" in kwargs and kwargs["ttl"] else TEMPORARY_TTL
+            destination = HyperLogLog(connection=self._connection_spec(), codec=self.codec, ttl=ttl)
+        destination._command("pfmerge", destination.pk, self.pk, *self._others(others))
+        return destination
+
+    def update(self, *others):
+        """
+        PFMERGE
+
+        Add the items counted by all others.
+        """
+        return self.merge(*others, destination=self)
+
+    def clear(self):
+        """
+        DEL
+        """
+        return self._command("delete", self.pk)
 
 
 class List(RedisDataStructure):
@@ -462,6 +1964,7 @@ class List(RedisDataStructure):
         """
         LLEN
         """
+        self._flush()
         return self.connection.llen(self.pk)
 
     def _check_index(self, value):
@@ -475,10 +1978,7 @@ class List(RedisDataStructure):
         LSET
         """
         index = self._check_index(index)
-        try:
-            self.connection.lset(self.pk, index, value)
-        except redis.exceptions.ResponseError:
-            raise IndexError("list index out of range")
+        return self._command("lset", self.pk, index, self._encode(value), error=IndexError("list index out of range"))
 
     def _get_range(self, start, stop):
         """
@@ -486,25 +1986,25 @@ class List(RedisDataStructure):
         """
         # empty start equals range from first element
         if start is None and stop is None:
-            return self.connection.lrange(self.pk, 0, -1)
+            return self._command("lrange", self.pk, 0, -1, transform=self._decode_all)
 
         if not start is None and stop is None:
             start = self._check_index(start)
-            return self.connection.lrange(self.pk, start, -1)
+            return self._command("lrange", self.pk, start, -1, transform=self._decode_all)
 
         if start is None and not stop is None:
             stop = self._check_index(stop)
             if stop == 0:
                 return []
              # python end index exclusive, redis inclusive
-            return self.connection.lrange(self.pk, 0, stop-1)
+            return self._command("lrange", self.pk, 0, stop-1, transform=self._decode_all)
 
         if not start is None and not stop is None:
             start = self._check_index(start)
             stop = self._check_index(stop)
             if start == stop or stop == 0:
                 return []
-            return self.connection.lrange(self.pk, start, stop-1)
+            return self._command("lrange", self.pk, start, stop-1, transform=self._decode_all)
 
 
     def __getitem__(self, index_or_slice):
@@ -515,64 +2015,112 @@ class List(RedisDataStructure):
             return self._get_range(index_or_slice.start, index_or_slice.stop)    
         else:
             index = self._check_index(index_or_slice)
-            pipe = self.connection.pipeline()
-            pipe.llen(self.pk)
-            pipe.lindex(self.pk, index)
-            llen, value = pipe.execute()
-            if llen and llen > index:
-                return value
-            else:
-                raise IndexError("list index out of range") 
+
+            def result(value):
+                if value is None:
+                    raise IndexError("list index out of range")
+                return self.codec.decode(value)
+            return self._command("lindex", self.pk, index, transform=result)
+
+    def __iter__(self):
+        """
+        LRANGE in chunks
+        """
+        return self.scan()
+
+    def scan(self, count=100, match=None):
+        """
+        LRANGE in chunks
+
+        Generate the elements reading count of them per round trip, optionally 
+        only the ones matching the glob-style pattern match.
+        Elements pushed or popped at the head during the iteration shift the 
+        following chunks.
+        """
+        self._flush()
+        start = 0
+        while True:
+            chunk = self.connection.lrange(self.pk, start, start + count - 1)
+            for value in chunk:
+                if match is None or fnmatch.fnmatchcase(value, match):
+                    yield self.codec.decode(value)
+            if len(chunk) < count:
+                return
+            start += count
+
+    def to_numpy(self, dtype=None):
+        """
+        LRANGE
+
+        Return the whole list as a numpy array, decoded by the codec into dtype
+        (float64 by default) in one vectorized step. Numbers stored as text are
+        joined server side and parsed from a single string. Requires numpy.
+        """
+        if self.codec.joins(dtype):
+            pipe = self._pipeline()
+            scripts.LIST_JOIN.queue(pipe, [self.pk])
+            return self._execute(pipe, lambda replies: self.codec.decode_joined(replies[0][1], replies[0][0], dtype),
+                                 command="lrange")
+        return self._command("lrange", self.pk, 0, -1, transform=lambda values: self.codec.decode_array(values, dtype))
+
+    def from_numpy(self, array):
+        """
+        RPUSH
+
+        Append the elements of a numpy array (its rows with a NumpyArray codec).
+        """
+        elements = self.codec.encode_array(array)
+        if elements:
+            return self._command("rpush", self.pk, *elements)
 
     def append(self, *values):
         """
         RPUSH
         """
         if values:
-            self.connection.rpush(self.pk, *values)
+            values = [self._encode(v) for v in values]
+            return self._command("rpush", self.pk, *values)
   
     def extend(self, other_list):
         """
         RPUSH revisited
         """
-        elements = list(other_list)
+        elements = [self._encode(e) for e in other_list]
         if elements:
-            self.connection.rpush(self.pk, *elements)
+            return self._command("rpush", self.pk, *elements)
 
     def insert(self, index, value):
         """
-        LINSERT
+        LINSERT by position, in one atomic server-side call
         """
         index = self._check_index(index)
-        pipe = self.connection.pipeline()
-        pipe.llen(self.pk)
-        pipe.lindex(self.pk, index)
-        llen, reference_value = pipe.execute()
-        if llen and llen > index:
-            self.connection.linsert(self.pk, "BEFORE", reference_value, value)
-        else:
-            raise IndexError("list index out of range") 
+        marker = "datastore:insert:%s" % uuid.uuid4().hex
+
+        def result(length):
+            if length < 0:
+                raise IndexError("list index out of range")
+        return self._script(scripts.LIST_INSERT, [self.pk], [index, self._encode(value), marker], transform=result)
      
     def push(self, value):
         """
         LPUSH
         """
-        return self.connection.lpush(self.pk, value)
+        return self._command("lpush", self.pk, self._encode(value))
 
     def pop(self):
         """
         LPOP
         """
-        return self.connection.lpop(self.pk)
+        return self._command("lpop", self.pk, transform=self._decode)
 
     def rpop(self):
         """
         RPOP
         """
-        return self.connection.rpop(self.pk)
+        return self._command("rpop", self.pk, transform=self._decode)
 
     def trim(self, start, stop):
         """
         LTRIM
         """
-        return self.connection.ltrim(self.pk, start, stop)
+        return self._command("ltrim", self.pk, start, stop)
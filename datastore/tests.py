@@ -1,9 +1,42 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import gc
+import gzip
+import json
+import os
 import random
 import redis
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import asynchronous
+import bucketed
+import buffered
+import cache
+import codec
+import counters
+import loader
+import metrics
+import probabilistic
+import queues
+import registry
+import scripts
+import sharded
 import structs
 
 class TestDict(unittest.TestCase):
@@ -205,6 +238,19 @@ class TestDict(unittest.TestCase):
         self.assertEqual(d["d"], "11")
         self.assertEqual(d["f"], "20")
 
+    def test_iteration(self):
+        d = structs.Dict()
+        self.assertEqual(list(d), [])
+        self.assertEqual(list(d.iteritems()), [])
+        data = dict(("k%d" % i, str(i)) for i in range(250))
+        d.update(data)
+        self.assertEqual(sorted(d), sorted(data.keys()))
+        self.assertEqual(sorted(d.iterkeys()), sorted(data.keys()))
+        self.assertEqual(sorted(d.itervalues()), sorted(data.values()))
+        self.assertEqual(dict(d.iteritems()), data)
+        self.assertEqual(dict(d.scan(count=7)), data)
+        self.assertEqual(sorted(k for k, v in d.scan(match="k1?")), ["k%d" % i for i in range(10, 20)])
+
 
 class TestList(unittest.TestCase):
 
@@ -327,6 +373,14 @@ class TestList(unittest.TestCase):
             d.insert("bla", "c")
         with self.assertRaises(IndexError):
             d.insert(3, "c")
+
+        d = structs.List(["a", "b", "a", "b"])
+        d.insert(2, "x")
+        self.assertEqual(d[:], ["a", "b", "x", "a", "b"])
+        d.insert(-1, "y")
+        self.assertEqual(d[:], ["a", "b", "x", "a", "y", "b"])
+        with self.assertRaises(IndexError):
+            d.insert(-7, "c")
             
     def test_range(self):
         python_list = ["0", "1", "2", "3", "4", "5", "6"]
@@ -360,6 +414,17 @@ class TestList(unittest.TestCase):
             d[10:"a"]
 
 
+    def test_iteration(self):
+        d = structs.List()
+        self.assertEqual(list(d), [])
+        values = [str(i) for i in range(250)]
+        d.extend(values)
+        self.assertEqual(list(d), values)
+        self.assertEqual(list(d.scan(count=7)), values)
+        self.assertEqual(list(d.scan(count=250)), values)
+        self.assertEqual(list(d.scan(count=1000)), values)
+        self.assertEqual(list(d.scan(match="1?")), [str(i) for i in range(10, 20)])
+
 
 class TestSet(unittest.TestCase):
 
@@ -572,6 +637,11 @@ class TestSet(unittest.TestCase):
         with self.assertRaises(TypeError):
             d2.difference(d1, d2, ["bla"])
 
+    def test_update_empty(self):
+        d1 = structs.Set()
+        self.assertEqual(d1.update(structs.Set("ab")), d1)
+        self.assertEqual(len(d1), 2)
+
     def test_update(self):
         d1 = structs.Set("abcd")
         d2 = structs.Set("cd")
@@ -775,6 +845,15 @@ class TestSet(unittest.TestCase):
         with self.assertRaises(TypeError):
             d1 < ["bla"]
 
+    def test_comparison_no_temp_keys(self):
+        d1 = structs.Set(["a", "b"])
+        d2 = structs.Set(["a"])
+        self.assertTrue(d2 <= d1)
+        self.assertTrue(d2 < d1)
+        self.assertTrue(d1 >= d2)
+        self.assertTrue(d1 > d2)
+        self.assertEqual(sorted(self.redis.keys("*")), sorted([d1.pk, d2.pk]))
+
     def test_members(self):
         d1 = structs.Set("a")
         self.assertEqual(d1.members(), set(["a"]))
@@ -800,5 +879,1911 @@ class TestSet(unittest.TestCase):
         with self.assertRaises(KeyError):
             d1.move("bla", d2)
 
+    def test_iteration(self):
+        d = structs.Set()
+        self.assertEqual(list(d), [])
+        values = set(str(i) for i in range(250))
+        d.add(*values)
+        self.assertEqual(set(d), values)
+        self.assertEqual(set(d.scan(count=7)), values)
+        self.assertEqual(set(d.scan(match="1?")), set(str(i) for i in range(10, 20)))
+
+
+class TestScripts(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.redis.script_flush()
+
+    def test_noscript_fallback(self):
+        self.assertEqual(self.redis.script_exists(scripts.DICT_POP.sha), [False])
+        d = structs.Dict({"a": 1, "b": 2})
+        self.assertEqual(d.pop("a"), "1")
+        self.assertEqual(self.redis.script_exists(scripts.DICT_POP.sha), [True])
+        self.redis.script_flush()
+        self.assertEqual(d.pop("b"), "2")
+
+    def test_load_scripts(self):
+        scripts.load_scripts(self.redis)
+        self.assertTrue(all(self.redis.script_exists(*[s.sha for s in scripts.SCRIPTS])))
+
+    def test_queued_evalsha(self):
+        d = structs.Dict({"a": 1, "b": 2}, name="d", ttl=100)
+        with structs.batch() as b:
+            popped = d.pop("a")
+            commands = [args[0] for args, options in b.pipeline.command_stack]
+            self.assertTrue("EVALSHA" in commands)
+            self.assertFalse("EVAL" in commands)
+        self.assertEqual(popped.value, "1")
+        self.assertEqual(self.redis.script_exists(scripts.DICT_POP.sha), [True])
+
+    def test_noscript_in_pipeline(self):
+        d = structs.Dict({"a": 1, "b": 2, "c": 3}, name="d", ttl=100)
+        s = structs.Set(["x"], name="s")
+        self.redis.script_flush() # as a restarted server
+        with structs.batch():
+            popped = d.pop("a")
+            added = s.add("y")
+        self.assertEqual((popped.value, added.value), ("1", 1))
+        self.redis.script_flush()
+        self.assertEqual(d.pop("b"), "2")
+        self.assertTrue(0 < d.ttl() <= 100)
+
+    def test_script_flush_before_batch(self):
+        d = structs.Dict({"a": "1", "n": "0"}, name="d")
+        self.redis.script_flush()
+        with structs.batch():
+            d.incrby("n")
+            popped = d.pop("a")
+            d["a"] = "2"
+            d.incrby("n")
+        self.assertEqual(popped.value, "1")
+        self.assertEqual(self.redis.hgetall("d"), {"a": "2", "n": "2"})
+
+
+class TestNearCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        cache.enable_keyspace_events(self.redis)
+
+    def settle(self):
+        # let the notifications of our own writes arrive
+        time.sleep(0.1)
+
+    def wait_invalidation(self, structure, invalidations):
+        deadline = time.time() + 2
+        while structure.cache.invalidations <= invalidations and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_lru(self):
+        c = cache.LRUCache(2)
+        c.store("a", 1, c.generation)
+        c.store("b", 2, c.generation)
+        self.assertEqual(c.lookup("a"), (True, 1))
+        c.store("c", 3, c.generation)
+        self.assertEqual(c.lookup("b"), (False, None))
+        self.assertEqual(c.lookup("a"), (True, 1))
+        self.assertEqual(c.lookup("c"), (True, 3))
+        stats = c.stats()
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["size"], 2)
+
+        generation = c.generation
+        c.invalidate()
+        c.store("d", 4, generation)
+        self.assertEqual(c.lookup("d"), (False, None))
+        self.assertEqual(len(c), 0)
+
+    def test_dict_hits(self):
+        d = structs.Dict({"a": 1}, cache_size=10)
+        self.settle()
+        self.assertEqual(d["a"], "1")
+        self.assertEqual(d["a"], "1")
+        self.assertEqual(d.get("a"), "1")
+        self.assertTrue("a" in d)
+        self.assertFalse("b" in d)
+        self.assertFalse("b" in d)
+        self.assertEqual(d.get("b", 5), 5)
+        with self.assertRaises(KeyError):
+            d["b"]
+        self.assertEqual(len(d), 1)
+        self.assertEqual(len(d), 1)
+        stats = d.cache.stats()
+        self.assertEqual(stats["misses"], 3)
+        self.assertEqual(stats["hits"], 7)
+
+    def test_dict_own_writes(self):
+        d = structs.Dict({"a": 1}, cache_size=10)
+        self.assertEqual(d["a"], "1")
+        d["a"] = 2
+        self.assertEqual(d["a"], "2")
+        self.assertEqual(len(d), 1)
+        d["b"] = 3
+        self.assertEqual(len(d), 2)
+        del d["a"]
+        self.assertFalse("a" in d)
+        self.assertEqual(d.pop("b"), "3")
+        self.assertEqual(len(d), 0)
+        d.incrby("c", 2)
+        self.assertEqual(d["c"], "2")
+        d.update({"c": 5})
+        self.assertEqual(d["c"], "5")
+        d.clear()
+        self.assertEqual(len(d), 0)
+
+    def test_dict_remote_writes(self):
+        d = structs.Dict({"a": 1}, cache_size=10)
+        self.settle()
+        self.assertEqual(d["a"], "1")
+        invalidations = d.cache.invalidations
+        self.redis.hset(d.pk, "a", "2")
+        self.wait_invalidation(d, invalidations)
+        self.assertEqual(d["a"], "2")
+
+        invalidations = d.cache.invalidations
+        self.redis.delete(d.pk)
+        self.wait_invalidation(d, invalidations)
+        self.assertFalse("a" in d)
+
+    def test_set_contains(self):
+        s = structs.Set(["a"], cache_size=10)
+        self.settle()
+        self.assertTrue("a" in s)
+        self.assertTrue("a" in s)
+        self.assertEqual(s.cache.stats()["hits"], 1)
+        s.remove("a")
+        self.assertFalse("a" in s)
+
+        invalidations = s.cache.invalidations
+        self.redis.sadd(s.pk, "a")
+        self.wait_invalidation(s, invalidations)
+        self.assertTrue("a" in s)
+        self.assertEqual(len(s), 1)
+
+        other = structs.Set(["b"])
+        s.update(other)
+        self.assertTrue("b" in s)
+        self.assertEqual(len(s), 2)
+
+    def test_keyspace_events(self):
+        self.redis.config_set("notify-keyspace-events", "")
+        try:
+            cache.ENABLE_KEYSPACE_EVENTS = False
+            with self.assertRaises(RuntimeError):
+                structs.Dict(connection=redis.Redis(), cache_size=10)
+            cache.ENABLE_KEYSPACE_EVENTS = True
+            d = structs.Dict({"a": 1}, connection=redis.Redis(), cache_size=10)
+            events = self.redis.config_get("notify-keyspace-events")["notify-keyspace-events"]
+            self.assertTrue(all(flag in events for flag in cache.KEYSPACE_EVENTS))
+            self.settle()
+            self.assertEqual(d["a"], "1")
+            invalidations = d.cache.invalidations
+            self.redis.hset(d.pk, "a", "2")
+            self.wait_invalidation(d, invalidations)
+            self.assertEqual(d["a"], "2")
+        finally:
+            cache.ENABLE_KEYSPACE_EVENTS = True
+            cache.enable_keyspace_events(self.redis)
+
+    def test_unsubscribe(self):
+        d = structs.Dict({"a": 1}, name="short-lived", cache_size=10)
+        channel = cache.get_invalidator(d.connection).channel(d.pk)
+        self.settle()
+        self.assertEqual(self.redis.pubsub_numsub(channel), [(channel, 1)])
+        del d
+        gc.collect()
+        deadline = time.time() + 2
+        while self.redis.pubsub_numsub(channel) != [(channel, 0)] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.redis.pubsub_numsub(channel), [(channel, 0)])
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_single_round_trip(self):
+        d = structs.Dict({"a": 1})
+        s = structs.Set(["x", "y"])
+        l = structs.List(["1", "2"])
+        with structs.batch() as b:
+            d["b"] = 2
+            a = d["a"]
+            missing = d.get("z", "default")
+            popped = d.pop("a")
+            added = s.add("z")
+            members = s.members()
+            first = l[0]
+            values = l[:]
+            l.append("3")
+            self.assertFalse(a.ready)
+            self.assertEqual(len(b), 9)
+            self.assertFalse(self.redis.hexists(d.pk, "b"))
+        self.assertEqual(len(b), 0)
+        self.assertEqual(a.value, "1")
+        self.assertEqual(missing.value, "default")
+        self.assertEqual(popped.value, "1")
+        self.assertEqual(added.value, 1)
+        self.assertEqual(members.value, set(["x", "y", "z"]))
+        self.assertEqual(first.value, "1")
+        self.assertEqual(values.value, ["1", "2"])
+        self.assertEqual(d.to_dict(), {"b": "2"})
+        self.assertEqual(l[:], ["1", "2", "3"])
+
+    def test_errors(self):
+        d = structs.Dict({"text": "bla"})
+        s = structs.Set()
+        with structs.batch() as b:
+            missing = d["missing"]
+            incr = d.incrby("text", 1)
+            removed = s.remove("x")
+            other = d.setdefault("other", 5)
+        with self.assertRaises(KeyError):
+            missing.value
+        with self.assertRaises(TypeError):
+            incr.value
+        with self.assertRaises(KeyError):
+            removed.value
+        self.assertEqual(other.value, 5)
+        self.assertEqual(d["other"], "5")
+
+    def test_pending(self):
+        with structs.batch() as b:
+            d = structs.Dict()
+            d["a"] = 1
+            value = d["a"]
+            with self.assertRaises(RuntimeError):
+                value.value
+            with self.assertRaises(RuntimeError):
+                bool(value)
+            self.assertEqual(len(d), 1) # runs the queued commands first
+            self.assertTrue(value.ready)
+            self.assertTrue("a" in d)
+
+    def test_set_operations(self):
+        s1 = structs.Set(["a", "b", "c"])
+        s2 = structs.Set(["b", "c"])
+        with structs.batch() as b:
+            inter = s1.intersection(s2)
+            subset = s2.issubset(s1)
+            proper = s2 < s1
+            disjoint = s1.isdisjoint(s2)
+            inter.add("z")
+        self.assertEqual(inter.members(), set(["b", "c", "z"]))
+        self.assertTrue(subset.value)
+        self.assertTrue(proper.value)
+        self.assertFalse(disjoint.value)
+
+    def test_abort(self):
+        d = structs.Dict()
+        with self.assertRaises(ValueError):
+            with structs.batch() as b:
+                d["a"] = 1
+                raise ValueError()
+        self.assertEqual(len(d), 0)
+        d["a"] = 1
+        self.assertEqual(d["a"], "1")
+
+    def test_other_connection(self):
+        other = redis.Redis()
+        d = structs.Dict(connection=other)
+        with structs.batch() as b:
+            d["a"] = 1
+            self.assertEqual(d["a"], "1")
+
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_dict(self):
+        d = asynchronous.AsyncDict({"a": 1})
+        self.assertEqual(len(d), 1)
+        d["b"] = 2
+        self.assertTrue("b" in d)
+        a, b, missing = asynchronous.gather(d["a"], d["b"], d.get("c"))
+        self.assertEqual((a, b, missing), ("1", "2", None))
+        self.assertEqual(d.setdefault("c", 3).get(), 3)
+        self.assertEqual(d.pop("c").get(), "3")
+        with self.assertRaises(KeyError):
+            d["c"].get()
+        self.assertEqual(d.to_dict().get(), {"a": "1", "b": "2"})
+        self.assertEqual(self.redis.hgetall(d.pk), {"a": "1", "b": "2"})
+
+    def test_set(self):
+        s1 = asynchronous.AsyncSet(["a", "b"])
+        s2 = asynchronous.AsyncSet(["a"])
+        self.assertTrue(s2.issubset(s1).get())
+        self.assertFalse(s1.issubset(s2).get())
+        self.assertTrue(s2 < s1)
+        inter = s1.intersection(s2).get()
+        self.assertTrue(isinstance(inter, asynchronous.AsyncSet))
+        self.assertEqual(inter.members().get(), set(["a"]))
+        s1.update(structs.Set(["c"])).get()
+        self.assertEqual(len(s1), 3)
+
+    def test_list(self):
+        l = asynchronous.AsyncList(["a", "b"])
+        results = [l.append(str(i)) for i in range(10)]
+        asynchronous.gather(*results)
+        self.assertEqual(len(l), 12)
+        self.assertEqual(l[0].get(), "a")
+        self.assertEqual(sorted(l[2:].get()), sorted(str(i) for i in range(10)))
+
+
+class TestSortedSet(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_empty(self):
+        z = structs.SortedSet()
+        self.assertEqual(len(z), 0)
+        self.assertFalse("a" in z)
+        self.assertEqual(list(z), [])
+        self.assertEqual(z[:], [])
+        self.assertEqual(list(z.range_by_score()), [])
+        self.assertFalse(self.redis.keys("*"))
+
+    def test_add_score_rank(self):
+        z = structs.SortedSet({"a": 1, "b": 2})
+        self.assertEqual(self.redis.type(z.pk), "zset")
+        z.update([("c", 3), ("d", 0.5)], e=10)
+        z["a"] = 4
+        self.assertEqual(len(z), 5)
+        self.assertTrue("a" in z)
+        self.assertEqual(z["a"], 4.0)
+        self.assertEqual(z.score("d"), 0.5)
+        self.assertEqual(z.rank("d"), 0)
+        self.assertEqual(z.rank("d", reverse=True), 4)
+        self.assertEqual(z.incrby("d", 2), 2.5)
+        self.assertEqual(z.incrby("d", -0.5), 2.0)
+        self.assertEqual(z.count(2, 3), 3)
+        self.assertEqual(z.count("(2", 3), 1)
+        with self.assertRaises(KeyError):
+            z["missing"]
+        with self.assertRaises(KeyError):
+            z.rank("missing")
+        del z["a"]
+        self.assertFalse("a" in z)
+        with self.assertRaises(KeyError):
+            del z["a"]
+        self.assertEqual(z.remove("b", "c", "missing"), 2)
+        self.assertEqual(z[:], ["d", "e"])
+        z.clear()
+        self.assertEqual(len(z), 0)
+
+    def test_slices(self):
+        members = ["m%02d" % i for i in range(10)]
+        z = structs.SortedSet((m, i) for i, m in enumerate(members))
+        for i in range(-10, 10):
+            self.assertEqual(z[i:], members[i:])
+            self.assertEqual(z[:i], members[:i])
+            for j in range(-10, 10):
+                if members[i:j]:
+                    self.assertEqual(z[i:j], members[i:j])
+
+    def test_range_pages(self):
+        members = ["m%03d" % i for i in range(250)]
+        z = structs.SortedSet((m, i) for i, m in enumerate(members))
+        self.assertEqual(list(z), members)
+        self.assertEqual(list(z.range(count=7)), members)
+        self.assertEqual(list(z.range(10, 20, count=3)), members[10:20])
+        self.assertEqual(list(z.range(-5)), members[-5:])
+        self.assertEqual(list(z.range(0, 10, reverse=True)), members[::-1][:10])
+        self.assertEqual(list(z.range(0, 2, withscores=True)), [("m000", 0.0), ("m001", 1.0)])
+
+    def test_range_by_score_pages(self):
+        # many ties across page boundaries
+        z = structs.SortedSet(("m%03d" % i, i // 10) for i in range(250))
+        expected = ["m%03d" % i for i in range(250)]
+        for count in (1, 3, 7, 10, 25, 1000):
+            self.assertEqual(list(z.range_by_score(count=count)), expected)
+            self.assertEqual(list(z.range_by_score(reverse=True, count=count)), expected[::-1])
+        self.assertEqual(list(z.range_by_score(2, 3, count=4)), expected[20:40])
+        self.assertEqual(list(z.range_by_score("(2", 3, count=4)), expected[30:40])
+        self.assertEqual(list(z.range_by_score(0, 0, withscores=True, count=3)),
+                         [(m, 0.0) for m in expected[:10]])
+
+    def test_range_by_lex_pages(self):
+        members = ["m%03d" % i for i in range(250)]
+        z = structs.SortedSet((m, 0) for m in members)
+        for count in (1, 7, 1000):
+            self.assertEqual(list(z.range_by_lex(count=count)), members)
+            self.assertEqual(list(z.range_by_lex(reverse=True, count=count)), members[::-1])
+        self.assertEqual(list(z.range_by_lex("[m010", "(m020", count=3)), members[10:20])
+
+    def test_pop(self):
+        z = structs.SortedSet({"a": 1, "b": 2, "c": 3})
+        self.assertEqual(z.popmin(), [("a", 1.0)])
+        self.assertEqual(z.popmax(2), [("c", 3.0), ("b", 2.0)])
+        self.assertEqual(z.popmin(), [])
+
+    def test_set_operations(self):
+        z1 = structs.SortedSet({"a": 1, "b": 2})
+        z2 = structs.SortedSet({"b": 3, "c": 4})
+        union = z1.union(z2)
+        self.assertEqual(list(union.range(withscores=True)), [("a", 1.0), ("c", 4.0), ("b", 5.0)])
+        inter = z1.intersection(z2, aggregate="MAX")
+        self.assertEqual(list(inter.range(withscores=True)), [("b", 3.0)])
+        weighted = z1.union(z2, weights=[2, 1])
+        self.assertEqual(weighted["a"], 2.0)
+        self.assertEqual(weighted["b"], 7.0)
+        z1.union(z2, destination=z1)
+        self.assertEqual(len(z1), 3)
+        with self.assertRaises(TypeError):
+            z1.union(structs.Set(["a"]))
+        with self.assertRaises(ValueError):
+            z1.union(z2, weights=[1])
+
+
+class TestSharded(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.other = redis.Redis(db=1)
+        self.other.flushdb()
+
+    def test_ring(self):
+        connections = [redis.Redis(db=i) for i in range(4)]
+        ring = sharded.HashRing(connections)
+        names = ["name%d" % i for i in range(1000)]
+        owners = dict((name, ring.node(name)) for name in names)
+        self.assertEqual(set(owners.values()), set(connections))
+        smaller = sharded.HashRing(connections[:3])
+        moved = [name for name in names if smaller.node(name) is not owners[name]]
+        self.assertEqual(set(owners[name] for name in moved), set([connections[3]]))
+
+    def test_dict(self):
+        d = sharded.ShardedDict({"a": 1}, name="big", shards=4, connections=[self.redis, self.other])
+        data = dict(("k%d" % i, str(i)) for i in range(100))
+        d.update(data)
+        data["a"] = "1"
+        self.assertEqual(len(d), 101)
+        self.assertEqual(d["k5"], "5")
+        self.assertTrue("k5" in d)
+        self.assertEqual(d.get("missing", 2), 2)
+        self.assertEqual(d.to_dict(), data)
+        self.assertEqual(sorted(d), sorted(data))
+        self.assertEqual(sorted(d.keys()), sorted(data))
+        self.assertEqual(dict(d.iteritems()), data)
+        self.assertEqual(d.pop("k5"), "5")
+        d.incrby("counter", 2)
+        self.assertEqual(d["counter"], "2")
+        del d["counter"]
+        self.assertEqual(len(d), 100)
+        keys = self.redis.keys("big:*") + self.other.keys("big:*")
+        self.assertEqual(sorted(keys), ["big:0", "big:1", "big:2", "big:3"])
+        self.assertTrue(self.redis.keys("big:*"))
+        self.assertTrue(self.other.keys("big:*"))
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertFalse(self.redis.keys("*") + self.other.keys("*"))
+
+    def test_set(self):
+        connections = [self.redis, self.other]
+        s1 = sharded.ShardedSet(range(100), shards=8, connections=connections)
+        s2 = sharded.ShardedSet(range(50, 150), shards=8, connections=connections)
+        self.assertEqual(len(s1), 100)
+        self.assertTrue("5" in s1)
+        self.assertEqual(s1.members(), set(str(i) for i in range(100)))
+        self.assertEqual(set(s1), set(str(i) for i in range(100)))
+        self.assertEqual(s1.intersection(s2).members(), set(str(i) for i in range(50, 100)))
+        self.assertEqual(len(s1.union(s2)), 150)
+        self.assertEqual(s1.difference(s2).members(), set(str(i) for i in range(50)))
+        self.assertTrue(s1.intersection(s2).issubset(s1))
+        self.assertFalse(s1.issubset(s2))
+        self.assertTrue(s1.union(s2).issuperset(s2))
+        self.assertFalse(s1.isdisjoint(s2))
+        self.assertTrue(s1.difference(s2).isdisjoint(s2))
+        s1.remove("5")
+        self.assertFalse("5" in s1)
+        with self.assertRaises(KeyError):
+            s1.remove("5")
+        popped = s1.pop()
+        self.assertFalse(popped in s1)
+        with self.assertRaises(ValueError):
+            s1.union(sharded.ShardedSet(shards=4, connections=connections))
+        with self.assertRaises(TypeError):
+            s1.union(structs.Set())
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_dict(self):
+        d = structs.Dict({"a": 1}, codec=codec.INTEGER)
+        d["b"] = 2
+        d.update(c=3)
+        d.update([("d", 4)])
+        self.assertEqual(d["a"], 1)
+        self.assertEqual(d.get("b"), 2)
+        self.assertEqual(d.get("missing", 0), 0)
+        self.assertEqual(d.to_dict(), {"a": 1, "b": 2, "c": 3, "d": 4})
+        self.assertEqual(sorted(d.values()), [1, 2, 3, 4])
+        self.assertEqual(sorted(d.items()), [("a", 1), ("b", 2), ("c", 3), ("d", 4)])
+        self.assertEqual(sorted(d.itervalues()), [1, 2, 3, 4])
+        d.incrby("a", 5)
+        self.assertEqual(d["a"], 6)
+        self.assertEqual(d.pop("a"), 6)
+        self.assertEqual(d.setdefault("e", 7), 7)
+        self.assertEqual(d.setdefault("e", 8), 7)
+
+    def test_cached_dict(self):
+        d = structs.Dict({"a": 1.5}, codec=codec.FLOAT, cache_size=10)
+        self.assertEqual(d["a"], 1.5)
+        self.assertEqual(d["a"], 1.5)
+        self.assertEqual(d.get("a"), 1.5)
+
+    def test_list(self):
+        l = structs.List([1.5, 2], codec=codec.FLOAT)
+        l.append(3)
+        l.push(0.25)
+        l.insert(1, 0.5)
+        l[0] = 0.125
+        self.assertEqual(l[:], [0.125, 0.5, 1.5, 2.0, 3.0])
+        self.assertEqual(l[1], 0.5)
+        self.assertEqual(list(l), [0.125, 0.5, 1.5, 2.0, 3.0])
+        self.assertEqual(l.pop(), 0.125)
+        self.assertEqual(l.rpop(), 3.0)
+        self.assertEqual(structs.List(codec=codec.FLOAT).pop(), None)
+
+    def test_set(self):
+        s = structs.Set([{"b": 2, "a": 1}], codec=codec.JSON)
+        self.assertTrue({"a": 1, "b": 2} in s)
+        s.add([1, 2])
+        self.assertTrue([1, 2] in s)
+        self.assertEqual(len(s), 2)
+        self.assertEqual(sorted(s.random(2)), sorted([{"a": 1, "b": 2}, [1, 2]]))
+        s.remove([1, 2])
+        self.assertEqual(list(s), [{"a": 1, "b": 2}])
+        other = structs.Set([{"a": 1, "b": 2}], codec=codec.JSON)
+        self.assertEqual(list(s.intersection(other)), [{"a": 1, "b": 2}])
+
+    def test_sorted_set(self):
+        z = structs.SortedSet({1: 1.0, 2: 2.0, 10: 0.5}, codec=codec.INTEGER)
+        self.assertEqual(z[:], [10, 1, 2])
+        self.assertEqual(list(z.range(withscores=True)), [(10, 0.5), (1, 1.0), (2, 2.0)])
+        self.assertEqual(list(z.range_by_score(1, 2)), [1, 2])
+        self.assertEqual(z.score(10), 0.5)
+        self.assertTrue(2 in z)
+        self.assertEqual(z.popmax(), [(2, 2.0)])
+
+    def test_struct(self):
+        import collections
+        Point = collections.namedtuple("Point", "x y")
+        c = codec.Struct("<ii", Point)
+        self.assertEqual(len(c.encode((1, 2))), 8)
+        d = structs.Dict(codec=c)
+        d["p"] = Point(1, -2)
+        self.assertEqual(d["p"], Point(1, -2))
+        self.assertEqual(d["p"].y, -2)
+        l = structs.List([3, 4], codec=codec.Struct("<d"))
+        self.assertEqual(l[:], [3.0, 4.0])
+
+    def test_sharded(self):
+        d = sharded.ShardedDict({"a": 1, "b": 2}, shards=2, codec=codec.INTEGER)
+        self.assertEqual(d.to_dict(), {"a": 1, "b": 2})
+        self.assertEqual(sorted(d.values()), [1, 2])
+        s = sharded.ShardedSet([1, 2, 3], shards=4, codec=codec.INTEGER)
+        self.assertTrue(1 in s)
+        self.assertEqual(s.members(), set([1, 2, 3]))
+        j = sharded.ShardedSet([{"a": 1, "b": 2}], shards=4, codec=codec.JSON)
+        self.assertTrue({"b": 2, "a": 1} in j)
+
+    @unittest.skipIf(msgpack is None, "msgpack not installed")
+    def test_msgpack(self):
+        d = structs.Dict(codec=codec.Msgpack())
+        d["a"] = {"list": [1, 2.5, u"text"]}
+        self.assertEqual(d["a"], {"list": [1, 2.5, u"text"]})
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_threshold(self):
+        c = codec.Compressed(threshold=100)
+        self.assertEqual(c.encode("small"), "small")
+        self.assertEqual(c.decode("small"), "small")
+        big = "blob " * 100
+        self.assertEqual(c.encode(big)[:4], c.MAGIC + "\x01")
+        self.assertEqual(c.decode(c.encode(big)), big)
+        noise = "".join(chr(random.randint(0, 255)) for i in range(200))
+        self.assertEqual(c.encode(noise), noise) # would not shrink
+        tricky = c.MAGIC + "\x01not compressed"
+        self.assertEqual(c.encode(tricky), c.MAGIC + c.PLAIN + tricky)
+        self.assertEqual(c.decode(c.encode(tricky)), tricky)
+        stats = c.stats()
+        self.assertEqual(stats["values"], 6)
+        self.assertEqual(stats["compressed"], 2)
+        self.assertTrue(stats["ratio"] > 1)
+        with self.assertRaises(ValueError):
+            c.decode(c.MAGIC + "\x09")
+        with self.assertRaises(ValueError):
+            codec.Compressed(method="unknown")
+
+    def test_methods(self):
+        big = {"text": "blob " * 1000}
+        zlib_codec = codec.Compressed(codec.JSON, threshold=0)
+        bz2_codec = codec.Compressed(codec.JSON, method="bz2", threshold=0)
+        self.assertEqual(bz2_codec.encode(big)[:4], bz2_codec.MAGIC + "\x02")
+        self.assertEqual(zlib_codec.decode(bz2_codec.encode(big)), big)
+
+    def test_plain_values(self):
+        structs.Dict({"old": "written before"}, name="plain")
+        d = structs.Dict(name="plain", codec=codec.Compressed(threshold=64))
+        self.assertEqual(d["old"], "written before")
+        d = structs.Dict(name="counts", codec=codec.Compressed(codec.INTEGER, threshold=64))
+        d["hits"] = 5
+        self.assertEqual(d.incrby("hits", 2), 7)
+        self.assertEqual(d["hits"], 7)
+        f = structs.Dict(name="floats", codec=codec.Compressed(codec.FLOAT))
+        f["x"] = 1.5
+        self.assertEqual(f.incrby("x", 0.25), 1.75)
+
+    def test_structures(self):
+        c = codec.Compressed(codec.JSON, threshold=64)
+        blob = {"items": ["entry %d" % i for i in range(100)]}
+        d = structs.Dict({"a": blob}, codec=c)
+        d["b"] = "small"
+        d.update(c=blob)
+        self.assertEqual(d["a"], blob)
+        self.assertEqual(d["b"], "small")
+        self.assertEqual(d.to_dict(), {"a": blob, "b": "small", "c": blob})
+        self.assertTrue(len(self.redis.hget(d.pk, "a")) < len(codec.JSON.encode(blob)) / 2)
+
+        l = structs.List([blob], codec=c)
+        l.append(blob)
+        l.append("small")
+        l.extend([blob])
+        self.assertEqual(l[:], [blob, blob, "small", blob])
+        self.assertEqual(l.pop(), blob)
+
+        s = structs.Set(codec=codec.Compressed(threshold=64))
+        s.add("x" * 100)
+        s.add("y")
+        self.assertTrue("x" * 100 in s)
+        self.assertEqual(sorted(s), ["x" * 100, "y"])
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.other = redis.Redis(db=1)
+        self.other.flushdb()
+
+    def tearDown(self):
+        registry.reset()
+        self.other.flushdb()
+
+    def test_lazy(self):
+        registry.configure("other", db=1, max_connections=5)
+        self.assertEqual(registry._clients.get("other"), None)
+        client = registry.get_connection("other")
+        self.assertTrue(registry.get_connection("other") is client)
+        self.assertEqual(client.connection_pool.max_connections, 5)
+        registry.configure("other", url="redis://localhost:6379/1", blocking=True, timeout=1)
+        blocking = registry.get_connection("other")
+        self.assertFalse(blocking is client)
+        self.assertTrue(isinstance(blocking.connection_pool, redis.BlockingConnectionPool))
+        self.assertEqual(blocking.connection_pool.timeout, 1)
+        with self.assertRaises(KeyError):
+            registry.get_connection("missing")
+
+    def test_routing(self):
+        registry.load({"connections": {"other": {"db": 1}},
+                       "routes": {"session:": "other", "session:admin:": "default"}})
+        structs.Dict({"a": 1}, connection="other", name="d1")
+        structs.Dict({"a": 1}, name="session:1")
+        structs.Dict({"a": 1}, name="session:admin:1")
+        structs.Dict({"a": 1}, name="d2")
+        self.assertEqual(sorted(self.other.keys("*")), ["d1", "session:1"])
+        self.assertEqual(sorted(self.redis.keys("*")), ["d2", "session:admin:1"])
+
+        s1 = structs.Set(["a", "b"], name="session:s1")
+        s2 = structs.Set(["b"], name="session:s2")
+        self.assertEqual(s1.difference(s2).members(), set(["a"]))
+        with structs.batch("other"):
+            s1.add("c")
+        self.assertEqual(len(s1), 3)
+
+        sd = sharded.ShardedDict({"a": 1}, name="session:sharded", shards=2)
+        self.assertEqual(sd["a"], "1")
+        self.assertTrue(all(shard.connection is registry.get_connection("other") for shard in sd.shards))
+
+    def test_fork(self):
+        d = structs.Dict({"a": 1}, cache_size=10)
+        self.assertEqual(d["a"], "1")
+        parent = d.connection
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                d["b"] = 2
+                if d.connection is not parent and d["a"] == "1" and d["b"] == "2":
+                    code = 0
+            finally:
+                os._exit(code)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(d.connection is parent)
+        self.assertEqual(d.to_dict(), {"a": "1", "b": "2"})
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        metrics.REGISTRY.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+
+    def test_disable(self):
+        getitem = structs.Dict.__getitem__
+        metrics.disable()
+        self.assertFalse(metrics.enabled())
+        self.assertFalse(structs.Dict.__getitem__ is getitem)
+        structs.Dict({"a": 1}, name="plain")["a"]
+        self.assertEqual(metrics.REGISTRY.snapshot(), [])
+
+    def test_commands(self):
+        d = structs.Dict(name="user:1")
+        d["a"] = 1
+        d["a"]
+        d.update({"b": 2}, [("c", 3)]) # MULTI, HMSET, HSET, EXEC in one round trip
+        with self.assertRaises(KeyError):
+            d["missing"]
+
+        stats = metrics.REGISTRY.get("Dict", "user", "__getitem__")
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.errors, 1)
+        self.assertEqual(stats.commands, 2)
+        self.assertEqual(stats.round_trips, 2)
+        self.assertEqual(stats.request_bytes, len("*3\r\n$4\r\nHGET\r\n$6\r\nuser:1\r\n$1\r\na\r\n") +
+                                              len("*3\r\n$4\r\nHGET\r\n$6\r\nuser:1\r\n$7\r\nmissing\r\n"))
+        self.assertEqual(stats.response_bytes, len("$1\r\n1\r\n") + len("$-1\r\n"))
+        self.assertEqual(stats.latency.count, 2)
+        self.assertTrue(stats.latency.percentile(0.5) > 0)
+
+        stats = metrics.REGISTRY.get("Dict", "user", "update")
+        self.assertEqual((stats.calls, stats.commands, stats.round_trips), (1, 4, 1))
+        self.assertEqual(stats.pipeline_sizes.counts[:4], [0, 0, 1, 0]) # 3 to 4 commands
+
+    def test_nested_and_generators(self):
+        s1 = structs.Set(range(10), name="s1")
+        s2 = structs.Set(name="s2")
+        s1.update(s2) # calls union
+        self.assertEqual(metrics.REGISTRY.get("Set", "", "union"), None)
+        self.assertEqual(metrics.REGISTRY.get("Set", "", "update").calls, 1)
+
+        d = structs.Dict(dict(("k%d" % i, i) for i in range(1000)), name="big") # not a listpack
+        iterator = d.scan(count=10)
+        self.assertEqual(metrics.REGISTRY.get("Dict", "", "scan"), None)
+        self.assertEqual(len(list(iterator)), 1000)
+        stats = metrics.REGISTRY.get("Dict", "", "scan")
+        self.assertEqual(stats.calls, 1)
+        self.assertTrue(stats.round_trips > 1)
+        self.assertEqual(stats.errors, 0)
+
+    def test_batch_and_hooks(self):
+        calls = []
+        metrics.add_hook(calls.append)
+        try:
+            d = structs.Dict(name="b")
+            with structs.batch():
+                d["a"] = 1
+                d["b"] = 2
+        finally:
+            metrics.remove_hook(calls.append)
+        self.assertEqual([(c.structure, c.method, c.commands) for c in calls],
+                         [("Dict", "__setitem__", 0), ("Dict", "__setitem__", 0), ("Batch", "execute", 4)])
+        self.assertEqual(calls[-1].pipelines, [4])
+        snapshot = metrics.REGISTRY.snapshot()
+        self.assertEqual([s["method"] for s in snapshot], ["execute", "__setitem__"])
+
+    def test_all_structures(self):
+        q = queues.Queue(name="jobs:1")
+        q.append("a") # inherited from List
+        h = structs.HyperLogLog(name="visits")
+        h.add("x")
+        a = structs.Set(["x"], name="a")
+        len(a | structs.Set(["y"], name="b"))
+        probabilistic.BloomFilter(name="seen", capacity=100).add("x")
+        self.assertEqual(metrics.REGISTRY.get("Queue", "jobs", "append").calls, 1)
+        self.assertEqual(metrics.REGISTRY.get("List", "jobs", "append"), None)
+        self.assertEqual(metrics.REGISTRY.get("HyperLogLog", "", "add").calls, 1)
+        self.assertEqual(metrics.REGISTRY.get("SetExpression", "", "__len__").commands, 1)
+        self.assertEqual(metrics.REGISTRY.get("BloomFilter", "", "add").calls, 1)
+        self.assertTrue(queues.Queue in metrics.structures())
+        self.assertTrue(bucketed.BucketedDict in metrics.structures())
+
+    def test_disable_during_calls(self):
+        connection = self.redis.connection_pool.get_connection("PING")
+        pack, read = redis.Connection.pack_command, redis.Connection.read_response
+        metrics.disable() # a call in another thread is still inside the wrappers
+        try:
+            connection.send_packed_command(pack(connection, "PING"))
+            self.assertEqual(read(connection), "PONG")
+        finally:
+            self.redis.connection_pool.release(connection)
+
+
+class TestBucketed(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_sizing(self):
+        entries, value = bucketed.listpack_limits(self.redis)
+        self.assertTrue(entries > 0 and value > 0)
+        self.assertEqual(bucketed.bucket_count(1, self.redis), 1)
+        self.assertEqual(bucketed.bucket_count(entries * 10, self.redis), 20)
+        d = bucketed.BucketedDict(name="u1", namespace="users", items=entries * 10)
+        self.assertEqual(d.buckets, 20)
+        with self.assertRaises(ValueError):
+            bucketed.BucketedDict(name="u1")
+        with self.assertRaises(ValueError):
+            bucketed.BucketedDict(name="u1", buckets=1, cache_size=10)
+
+    def test_dict_api(self):
+        d = bucketed.BucketedDict({"a": 1, "b": 2}, name="u1", namespace="users", buckets=1, codec=codec.INTEGER)
+        other = bucketed.BucketedDict({"a": 10}, name="u", namespace="users", buckets=1, codec=codec.INTEGER)
+        self.assertEqual(self.redis.keys("*"), ["users:0"])
+        self.assertEqual(self.redis.object("encoding", "users:0"), "ziplist")
+
+        self.assertEqual(d["a"], 1)
+        self.assertEqual(other["a"], 10)
+        self.assertEqual(len(d), 2)
+        self.assertEqual(sorted(d.keys()), ["a", "b"])
+        self.assertEqual(sorted(d.values()), [1, 2])
+        self.assertEqual(d.to_dict(), {"a": 1, "b": 2})
+        self.assertEqual(sorted(d), ["a", "b"])
+        self.assertEqual(list(d.scan(match="b*")), [("b", 2)])
+        self.assertTrue("a" in d)
+        self.assertFalse("c" in d)
+        with self.assertRaises(KeyError):
+            d["c"]
+        self.assertEqual(d.get("c", 3), 3)
+
+        d["c"] = 3
+        self.assertEqual(d.incrby("c", 2), 5)
+        self.assertEqual(d.setdefault("c", 0), 5)
+        self.assertEqual(d.setdefault("d", 4), 4)
+        self.assertEqual(d.pop("d"), 4)
+        self.assertEqual(d.pop("d", None), None)
+        del d["c"]
+        d.update([("e", 5)], f=6)
+        self.assertEqual(d.to_dict(), {"a": 1, "b": 2, "e": 5, "f": 6})
+
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(other.to_dict(), {"a": 10})
+
+    def test_batch(self):
+        d = bucketed.BucketedDict(name="u1", buckets=4)
+        with structs.batch() as b:
+            d["a"] = 1
+            items = d.items()
+        self.assertEqual(items.value, [("a", "1")])
+
+    def test_map(self):
+        entries, value = bucketed.listpack_limits(self.redis)
+        m = bucketed.BucketedMap(dict(("k%d" % i, i) for i in range(entries * 2)), name="map", items=entries * 2)
+        self.assertEqual(len(m.shards), 4)
+        self.assertEqual(len(m), entries * 2)
+        self.assertEqual(m["k1"], "1")
+        for key in self.redis.keys("map:*"):
+            self.assertEqual(self.redis.object("encoding", key), "ziplist")
+
+
+class TestSetExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.a = structs.Set(range(0, 10), codec=codec.INTEGER)
+        self.b = structs.Set(range(5, 15), codec=codec.INTEGER)
+        self.c = structs.Set(range(8, 20), codec=codec.INTEGER)
+        self.python = dict((s, set(range(start, stop))) for s, start, stop in
+                           [(self.a, 0, 10), (self.b, 5, 15), (self.c, 8, 20)])
+
+    def test_lazy(self):
+        keys = set(self.redis.keys("*"))
+        expression = (self.a & self.b) - self.c
+        self.assertEqual(repr(expression), "((%s & %s) - %s)" % (self.a.pk, self.b.pk, self.c.pk))
+        self.assertEqual(expression.members(), set([5, 6, 7]))
+        self.assertEqual(len(expression), 3)
+        self.assertEqual(sorted(expression), [5, 6, 7])
+        self.assertTrue(5 in expression)
+        self.assertFalse(8 in expression)
+        self.assertEqual(set(self.redis.keys("*")), keys)
+
+    def test_operators(self):
+        a, b, c = self.a, self.b, self.c
+        pa, pb, pc = self.python[a], self.python[b], self.python[c]
+        cases = [
+            (a & b, pa & pb), (a | b, pa | pb), (a - b, pa - pb), (a ^ b, pa ^ pb),
+            (a & b & c, pa & pb & pc), (a - b - c, pa - pb - pc), (a - (b - c), pa - (pb - pc)),
+            ((a | b) & c, (pa | pb) & pc), (a ^ b ^ c, pa ^ pb ^ pc), ((a - b) ^ (b & c), (pa - pb) ^ (pb & pc)),
+            (a & (b | c) & a, pa & (pb | pc)),
+        ]
+        for expression, expected in cases:
+            self.assertEqual(expression.members(), expected, repr(expression))
+            self.assertEqual(len(expression), len(expected), repr(expression))
+            for member in range(-1, 21):
+                self.assertEqual(member in expression, member in expected, repr(expression))
+        self.assertEqual(len((a & b & c).operands), 3)
+        self.assertEqual(len((a - (b - c)).operands), 2)
+        with self.assertRaises(TypeError):
+            a & set([1])
+        with self.assertRaises(ValueError):
+            a & structs.Set(connection=redis.Redis(db=1))
+
+    def test_store(self):
+        result = ((self.a | self.b) - self.c).store()
+        self.assertEqual(result.members(), set(range(0, 8)))
+        self.assertEqual(result.codec, codec.INTEGER)
+        (self.a ^ self.c).store(result)
+        self.assertEqual(result.members(), set(range(0, 8) + range(10, 20)))
+        empty = (self.a & structs.Set()).store(result)
+        self.assertEqual(len(empty), 0)
+        self.assertFalse(self.redis.exists(result.pk))
+
+        a = self.a
+        a &= self.b
+        self.assertTrue(a is self.a)
+        self.assertEqual(a.members(), set(range(5, 10)))
+        a |= self.c
+        a -= self.b
+        self.assertEqual(a.members(), set(range(15, 20)))
+        a ^= self.c
+        self.assertEqual(a.members(), set(range(8, 15)))
+
+    def test_batch(self):
+        with structs.batch() as b:
+            self.a.add(100)
+            members = (self.a - self.b).members()
+            result = (self.a & self.b).store()
+        self.assertEqual(members.value, set(range(0, 5) + [100]))
+        self.assertEqual(result.members(), set(range(5, 10)))
+
+    def test_batch_reads(self):
+        with structs.batch():
+            self.a.add(100)
+            self.assertEqual(len(self.a | self.b), 16)
+            self.assertEqual(len(self.a & self.b), 5)
+            self.assertTrue(7 in (self.a & self.b))
+            self.assertFalse(100 in (self.a & self.b))
+            self.assertEqual(sorted(self.a - self.b), range(0, 5) + [100])
+
+
+class TestMemoize(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.a = structs.Set(range(0, 10), codec=codec.INTEGER)
+        self.b = structs.Set(range(5, 15), codec=codec.INTEGER)
+
+    def test_reuse(self):
+        first = self.a.intersection(self.b, memoize=60)
+        self.assertTrue(first.pk.startswith(structs.MEMO_PREFIX))
+        self.assertEqual(first.members(), set(range(5, 10)))
+        self.assertTrue(0 < self.redis.ttl(first.pk) <= 60)
+        self.redis.sadd(first.pk, 100) # shows whether the stored result is reused
+        again = (self.a & self.b).memoize(60)
+        self.assertEqual(again.pk, first.pk)
+        self.assertTrue(100 in again)
+        self.assertNotEqual((self.a | self.b).memoize(60).pk, first.pk)
+        self.assertNotEqual((self.b & self.a).memoize(60).pk, first.pk)
+
+    def test_invalidation(self):
+        memo = lambda: self.a.intersection(self.b, memoize=60)
+        changes = [
+            lambda: self.a.add(7),
+            lambda: self.a.add(20),
+            lambda: self.b.remove(5),
+            lambda: self.b.discard(6),
+            lambda: self.a.pop(),
+            lambda: self.a.move(min(self.a.members()), self.b),
+            lambda: self.a.update(structs.Set([30])),
+            lambda: self.b.difference_update(structs.Set([14])),
+            lambda: (self.b | structs.Set([40])).store(self.b),
+        ]
+        previous = memo().pk
+        for change in changes:
+            change()
+            current = memo()
+            self.assertNotEqual(current.pk, previous)
+            self.assertEqual(current.members(), self.a.members() & self.b.members())
+            previous = current.pk
+        self.b.clear()
+        self.assertEqual(len(memo()), 0)
+
+    def test_untracked(self):
+        self.a.add(100)
+        self.assertEqual(self.redis.keys(structs.VERSIONS), [])
+        self.a.difference(self.b, memoize=60)
+        self.assertEqual(sorted(self.redis.hgetall(structs.VERSIONS)), sorted([self.a.pk, self.b.pk]))
+        big = structs.Set(range(12000))
+        self.assertEqual(len(big), 12000)
+
+    def test_other_instances(self):
+        first = self.a.intersection(self.b, memoize=60)
+        self.assertEqual(first.members(), set(range(5, 10)))
+        structs.Set(name=self.b.pk, codec=codec.INTEGER).discard(7) # a fresh instance, never memoized
+        again = self.a.intersection(self.b, memoize=60)
+        self.assertNotEqual(again.pk, first.pk)
+        self.assertEqual(again.members(), set([5, 6, 8, 9]))
+        version = self.redis.hget(structs.VERSIONS, self.a.pk)
+        structs.Set(name=self.a.pk, codec=codec.INTEGER).add(200)
+        self.assertNotEqual(self.redis.hget(structs.VERSIONS, self.a.pk), version)
+
+    def test_versions_dropped(self):
+        first = self.a.intersection(self.b, memoize=60)
+        self.a.clear()
+        self.assertFalse(self.redis.hexists(structs.VERSIONS, self.a.pk))
+        self.a.add(*range(0, 10))
+        self.a.add(100) # same members as the memoized result, with a new version
+        self.assertNotEqual(self.a.intersection(self.b, memoize=60).pk, first.pk)
+        for member in list(self.b.members()):
+            self.b.remove(member)
+        self.assertFalse(self.redis.hexists(structs.VERSIONS, self.b.pk))
+
+
+class TestExpiry(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_fixed(self):
+        d = structs.Dict(name="expiring", ttl=10)
+        d["a"] = 1
+        self.assertTrue(0 < d.ttl() <= 10)
+        d.expire(100)
+        d["b"] = 2 # a fixed expiry is not pushed back by writes
+        self.assertTrue(10 < d.ttl() <= 100)
+        d.persist()
+        self.assertEqual(d.ttl(), None)
+        d["c"] = 3
+        self.assertEqual(d.ttl(), None)
+
+    def test_one_command_per_write(self):
+        d = structs.Dict(name="expiring", ttl=10)
+        l = structs.List(name="list", ttl=10)
+        with structs.batch() as b:
+            d["a"] = 1
+            length = l.append("x")
+            self.assertEqual(len(b), 2)
+        self.assertEqual(length.value, 1)
+        self.assertTrue(0 < d.ttl() <= 10 and 0 < l.ttl() <= 10)
+        self.redis.delete("list") # as when it expires
+        self.assertEqual(l.append("y"), 1)
+        self.assertTrue(0 < l.ttl() <= 10)
+        self.assertEqual(d.to_dict(), {"a": "1"})
+
+    def test_multi_key_writes(self):
+        z1 = structs.SortedSet({"a": 1, "b": 2}, name="z1")
+        z2 = structs.SortedSet({"b": 3}, name="z2")
+        for operation, command in ((z1.union, "ZUNIONSTORE"), (z1.intersection, "ZINTERSTORE")):
+            with structs.batch() as b:
+                result = operation(z2, ttl=10)
+                self.assertEqual(b.pipeline.command_stack[0][0][0], command) # not in a WRITE_EXPIRE script
+            self.assertTrue(0 < result.ttl() <= 10)
+        self.assertEqual(self.redis.zrange(result.pk, 0, -1, withscores=True), [("b", 5.0)])
+
+    def test_recreated(self):
+        d = structs.Dict(name="expiring", ttl=10)
+        d.update({"a": 1})
+        d.clear()
+        self.assertEqual(d.ttl(), None)
+        d.setdefault("b", 2)
+        self.assertTrue(0 < d.ttl() <= 10)
+
+    def test_sliding(self):
+        d = structs.Dict(name="sliding", ttl=100, sliding=True)
+        d["a"] = 1
+        d.expire(5)
+        self.assertTrue(d.ttl() <= 5)
+        self.assertEqual(d["a"], "1")
+        self.assertTrue(d.ttl() > 5)
+
+    def test_batch(self):
+        d = structs.Dict(name="expiring", ttl=10)
+        with structs.batch():
+            d["a"] = 1
+            value = d.get("a")
+        self.assertEqual(value.value, "1")
+        self.assertTrue(0 < d.ttl() <= 10)
+
+    def test_temporary_results(self):
+        a = structs.Set([1, 2, 3], codec=codec.INTEGER)
+        b = structs.Set([2, 3, 4], codec=codec.INTEGER)
+        self.assertEqual(a.ttl(), None)
+        result = a.intersection(b)
+        self.assertTrue(0 < result.ttl() <= structs.TEMPORARY_TTL)
+        self.assertTrue(0 < (a | b).store().ttl() <= structs.TEMPORARY_TTL)
+        a.intersection_update(b)
+        self.assertEqual(a.ttl(), None)
+        self.assertEqual(a.union(b, ttl=50).ttl() <= 50, True)
+
+    def test_sharded(self):
+        d = sharded.ShardedDict(name="expiring", shards=4, ttl=10)
+        d.update(dict((str(i), i) for i in range(20)))
+        self.assertTrue(all(0 < self.redis.ttl(shard.pk) <= 10 for shard in d.shards))
+        self.assertTrue(0 < d.ttl() <= 10)
+        d.persist()
+        self.assertEqual(d.ttl(), None)
+        a = sharded.ShardedSet([1, 2], shards=2, codec=codec.INTEGER)
+        self.assertTrue(0 < a.union(a).ttl() <= structs.TEMPORARY_TTL)
+
+    def test_bucketed(self):
+        self.assertRaises(ValueError, bucketed.BucketedDict, name="d", buckets=4, ttl=10)
+        self.assertRaises(TypeError, bucketed.BucketedDict(name="d", buckets=4).expire, 10)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_size(self):
+        self.assertEqual(probabilistic.bloom_size(1000, 0.01), (9586, 7))
+        self.assertRaises(ValueError, probabilistic.BloomFilter)
+        self.assertRaises(ValueError, probabilistic.BloomFilter, capacity=10 ** 10)
+
+    def test_add(self):
+        f = probabilistic.BloomFilter(name="seen", capacity=1000)
+        self.assertTrue(f.add("a"))
+        self.assertFalse(f.add("a"))
+        self.assertTrue("a" in f)
+        self.assertFalse("b" in f)
+        f.clear()
+        self.assertFalse("a" in f)
+
+    def test_many(self):
+        f = probabilistic.BloomFilter([-1], name="seen", capacity=1000, codec=codec.INTEGER)
+        elements = range(500)
+        self.assertEqual(f.add_many(elements + [0], batch_size=100), [True] * 500 + [False])
+        self.assertEqual(f.contains_many(elements, batch_size=100), [True] * 500)
+        false_positives = sum(f.contains_many(range(1000, 11000)))
+        self.assertTrue(false_positives < 10000 * 0.02, false_positives)
+        self.assertTrue(450 < len(f) < 550)
+
+    def test_batch(self):
+        f = probabilistic.BloomFilter(name="seen", capacity=1000, ttl=10)
+        with structs.batch():
+            added = f.add("a")
+            many = f.add_many(["b", "c"])
+            self.assertTrue("a" in f)
+            self.assertFalse("d" in f)
+        self.assertEqual((added.value, many.value), (True, [True, True]))
+        self.assertEqual(f.contains_many(["a", "b", "d"]), [True, True, False])
+        self.assertTrue(0 < f.ttl() <= 10)
+
+    def test_scalable(self):
+        f = probabilistic.ScalableBloomFilter(name="seen", capacity=100, codec=codec.INTEGER)
+        added = f.add_many(range(1000) + [5], batch_size=64)
+        self.assertTrue(sum(added) > 990)
+        self.assertFalse(added[-1])
+        self.assertTrue(f._count > 3)
+        self.assertTrue(all(f.contains_many(range(1000))))
+        false_positives = sum(f.contains_many(range(1000, 11000)))
+        self.assertTrue(false_positives < 10000 * 0.01, false_positives)
+        self.assertEqual(len(f), sum(added))
+        other = probabilistic.ScalableBloomFilter(name="seen", capacity=100, codec=codec.INTEGER)
+        self.assertTrue(999 in other)
+        self.assertFalse(other.add(999))
+        f.expire(100)
+        self.assertTrue(all(0 < self.redis.ttl(key) <= 100 for key in f._keys()))
+        f.clear()
+        self.assertEqual(self.redis.keys("seen*"), [])
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_count(self):
+        h = structs.HyperLogLog(["a", "b"], name="visitors")
+        self.assertTrue(h.add("c", "a"))
+        self.assertFalse(h.add("a"))
+        self.assertFalse(h.add())
+        self.assertEqual(len(h), 3)
+        h.add(*range(10000))
+        self.assertTrue(abs(len(h) - 10003) < 10003 * 0.03, len(h))
+        self.assertTrue(self.redis.strlen("visitors") <= 12 * 1024 + 16)
+        h.clear()
+        self.assertEqual(len(h), 0)
+
+    def test_union(self):
+        days = [structs.HyperLogLog(range(day * 100, day * 100 + 500), codec=codec.INTEGER) for day in range(3)]
+        self.assertTrue(abs(days[0].union_count(*days[1:]) - 700) < 700 * 0.03)
+        merged = days[0].merge(*days[1:])
+        self.assertEqual(len(merged), days[0].union_count(*days[1:]))
+        self.assertTrue(0 < merged.ttl() <= structs.TEMPORARY_TTL)
+        empty = structs.HyperLogLog()
+        self.assertEqual(days[1].merge(destination=empty), empty)
+        self.assertEqual(len(empty), len(days[1]))
+        days[0].update(days[1])
+        self.assertEqual(len(days[0]), days[0].union_count(days[1]))
+        self.assertEqual(days[0].ttl(), None)
+        self.assertRaises(TypeError, days[0].union_count, structs.Set())
+        self.assertRaises(TypeError, days[0].merge, days[1], destination=structs.Set())
+
+    def test_batch(self):
+        days = [structs.HyperLogLog(["a", "b%d" % day], name="day:%d" % day) for day in range(3)]
+        with structs.batch() as b:
+            counts = [day.count() for day in days]
+            union = days[0].union_count(*days[1:])
+            days[0].add("c")
+            self.assertEqual(len(days[0]), 3)
+        self.assertEqual([c.value for c in counts], [2, 2, 2])
+        self.assertEqual(union.value, 4)
+
+
+class TestIntBitSet(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_members(self):
+        s = structs.IntBitSet([1, 5, 9], name="ids")
+        self.assertEqual(s.add(2, 5, 3, 3, 100000), 3)
+        self.assertEqual(len(s), 6)
+        self.assertTrue(5 in s)
+        self.assertFalse(4 in s)
+        self.assertFalse("5" in s)
+        self.assertEqual(s.members(), set([1, 2, 3, 5, 9, 100000]))
+        self.assertEqual(list(s.scan(count=3)), [1, 2, 3, 5, 9, 100000])
+        s.remove(9)
+        self.assertRaises(KeyError, s.remove, 9)
+        s.discard(9)
+        self.assertEqual(s.pop(), 1)
+        self.assertEqual(str(s), "IntBitSet([2, 3, 5, 100000])")
+        self.assertRaises(TypeError, s.add, "a")
+        self.assertRaises(ValueError, s.add, -1)
+        self.assertRaises(ValueError, s.add, 2 ** 32)
+        s.clear()
+        self.assertRaises(KeyError, s.pop)
+        self.assertEqual(list(s), [])
+
+    def test_algebra(self):
+        a = structs.IntBitSet([1, 2, 3, 1000])
+        b = structs.IntBitSet([2, 3, 4])
+        c = structs.IntBitSet([3, 5000])
+        cases = [
+            (a.intersection(b, c), set([3])),
+            (a.union(b, c), set([1, 2, 3, 4, 1000, 5000])),
+            (a.difference(b, c), set([1, 1000])),
+            (b.difference(a), set([4])),
+            (a.difference(), a.members()),
+            (a ^ b, set([1, 4, 1000])),
+            (a - b, set([1, 1000])),
+        ]
+        for result, members in cases:
+            self.assertEqual(result.members(), members)
+            self.assertTrue(0 < result.ttl() <= structs.TEMPORARY_TTL)
+            self.assertEqual(self.redis.keys(result.pk + ":*"), []) # no temporary key left
+        self.assertRaises(TypeError, a.union, structs.Set([1]))
+
+        empty = structs.IntBitSet()
+        empty.update(a)
+        self.assertEqual(empty.members(), a.members())
+        a &= b
+        self.assertEqual(a.members(), set([2, 3]))
+        self.assertEqual(a.ttl(), None)
+
+    def test_compare(self):
+        a = structs.IntBitSet([2, 3])
+        b = structs.IntBitSet([2, 3, 4])
+        self.assertTrue(a.issubset(b))
+        self.assertTrue(a < b)
+        self.assertFalse(b <= a)
+        self.assertTrue(b.issuperset(a))
+        self.assertTrue(b > a)
+        self.assertFalse(a < a)
+        self.assertTrue(a <= a)
+        self.assertFalse(a.isdisjoint(b))
+        self.assertTrue(a.isdisjoint(structs.IntBitSet([10])))
+
+    def test_batch(self):
+        a = structs.IntBitSet(name="a")
+        b = structs.IntBitSet([1, 2, 3], name="b")
+        with structs.batch():
+            added = a.add(1, 2)
+            subset = a.issubset(b)
+            members = a.members()
+            a.add(5)
+            self.assertTrue(2 in a)
+            self.assertFalse(3 in a)
+            self.assertEqual(len(a), 3)
+        self.assertEqual((added.value, subset.value, members.value), (2, True, set([1, 2])))
+
+    def test_temporary_keys_expire(self):
+        a = structs.IntBitSet([1, 2, 3], name="a")
+        b = structs.IntBitSet([2], name="b")
+        with structs.batch(transaction=False) as batch:
+            a.difference(b, destination=a)
+            a.issubset(b)
+            commands = [command[0][:2] for command in batch.pipeline.command_stack]
+        temporaries = set(args[1] for args in commands if args[0] == "EXPIRE")
+        self.assertEqual(len(temporaries), 2)
+        self.assertTrue(all(key.startswith("a:") for key in temporaries))
+        self.assertEqual(a.members(), set([1, 3]))
+
+
+class TestQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_get(self):
+        q = queues.Queue(["a", "b"], name="jobs")
+        q.append("c")
+        self.assertEqual(q.get(), "a")
+        self.assertEqual(q.get(block=False), "b")
+        self.assertEqual(q.get(timeout=0.1), "c")
+        self.assertEqual(q.get(block=False), None)
+        start = time.time()
+        self.assertEqual(q.get(timeout=0.2), None)
+        self.assertTrue(time.time() - start >= 0.15)
+
+    def test_get_many(self):
+        q = queues.Queue(range(10), name="jobs", codec=codec.INTEGER)
+        self.assertEqual(q.get_many(4), [0, 1, 2, 3])
+        self.assertEqual(q.get_many(10), [4, 5, 6, 7, 8, 9])
+        self.assertEqual(q.get_many(10), [])
+        self.assertEqual(q.get_many(10, block=True, timeout=0.1), [])
+        q.append(10, 11)
+        self.assertEqual(q.get_many(10, block=True, timeout=0.1), [10, 11])
+
+    def test_blocking(self):
+        q = queues.Queue(name="jobs")
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(0.2)
+            queues.Queue(name="jobs").append("late", "later")
+            os._exit(0)
+        self.assertEqual(q.get_many(5, block=True, timeout=5), ["late", "later"])
+        os.waitpid(pid, 0)
+
+    def test_reliable(self):
+        q = queues.Queue(["a", "b", "c", "d"], name="jobs", reliable=True, consumer="worker1")
+        self.assertEqual(q.processing.pk, "jobs:processing:worker1")
+        self.assertEqual(q.get(), "a")
+        self.assertEqual(q.get_many(2), ["b", "c"])
+        self.assertEqual(list(q.processing), ["a", "b", "c"])
+        self.assertTrue(q.ack("a"))
+        self.assertFalse(q.ack("a"))
+        q.ack_many(["c"])
+        self.assertTrue(q.nack("b"))
+        self.assertEqual(list(q), ["b", "d"])
+        self.assertEqual(q.get(block=False), "b")
+
+        # worker1 dies, worker2 recovers its items
+        other = queues.Queue(name="jobs", reliable=True, consumer="worker2")
+        self.assertEqual(other.recover("worker1"), 1)
+        self.assertEqual(list(q.processing), [])
+        self.assertEqual(other.get_many(5), ["b", "d"])
+        self.assertEqual(len(other.processing), 2)
+
+    def test_fork(self):
+        q = queues.Queue(["a", "b"], name="jobs", reliable=True)
+        parent = q.processing.pk
+        self.assertEqual(q.get(), "a")
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                if q.get() == "b" and q.processing.pk != parent and q.recover() == 1:
+                    code = 0
+            finally:
+                os._exit(code)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(q.processing.pk, parent)
+        self.assertEqual(list(q.processing), ["a"]) # not taken back by the child
+        self.assertEqual(list(q), ["b"])
+
+
+@unittest.skipIf(numpy is None, "numpy not installed")
+class TestNumpy(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_list(self):
+        l = structs.List(name="vector")
+        l.from_numpy(numpy.array([1.5, -2.0, 3e10]))
+        l.append("inf")
+        array = l.to_numpy()
+        self.assertEqual(array.dtype, numpy.float64)
+        self.assertEqual(array.tolist(), [1.5, -2.0, 3e10, float("inf")])
+        self.assertEqual(l.to_numpy(dtype="float32").dtype, numpy.float32)
+        self.assertEqual(len(structs.List(name="empty").to_numpy()), 0)
+
+    def test_list_integers(self):
+        l = structs.List(name="counts", codec=codec.INTEGER)
+        l.from_numpy(numpy.arange(1000, dtype=numpy.int64))
+        self.assertEqual(l[999], 999)
+        self.assertEqual(l.to_numpy(dtype=numpy.int64).tolist(), range(1000))
+
+    def test_not_numbers(self):
+        for values in (["1", "x"], ["1 2", "x"], ["1", ""]):
+            self.assertRaises(ValueError, structs.List(values).to_numpy)
+        l = structs.List(["a", "b"])
+        self.assertEqual(l.to_numpy(dtype="S1").tolist(), ["a", "b"])
+
+    def test_other_codecs(self):
+        l = structs.List(name="json", codec=codec.JSON)
+        l.from_numpy(numpy.array([1, 2, 3]))
+        self.assertEqual(l[:], [1, 2, 3])
+        self.assertEqual(l.to_numpy(dtype=int).tolist(), [1, 2, 3])
+
+    def test_dict(self):
+        d = structs.Dict(name="scores")
+        d.from_numpy(numpy.array([3, 1, 2]), numpy.array([0.3, 0.1, 0.2]))
+        self.assertEqual(d["1"], "0.1")
+        keys, values = d.to_numpy()
+        self.assertEqual(sorted(zip(keys.tolist(), values.tolist())), [("1", 0.1), ("2", 0.2), ("3", 0.3)])
+        keys, values = d.to_numpy(dtype=numpy.float32, key_dtype=int)
+        self.assertEqual(keys.dtype, numpy.int64)
+        self.assertEqual(dict(zip(keys, values.astype(float).round(3))), {1: 0.1, 2: 0.2, 3: 0.3})
+        self.assertRaises(ValueError, d.from_numpy, numpy.arange(2), numpy.arange(3))
+        self.assertIsNone(d.from_numpy([], []))
+        keys, values = structs.Dict(name="empty").to_numpy()
+        self.assertEqual((len(keys), len(values)), (0, 0))
+
+    def test_packed(self):
+        d = structs.Dict(name="features", codec=codec.NumpyArray("<f4"))
+        d["a"] = [1, 2, 3]
+        d["b"] = numpy.array([4, 5, 6], dtype=numpy.float64)
+        self.assertEqual(len(self.redis.hget("features", "a")), 12)
+        vector = d["a"]
+        self.assertEqual(vector.dtype, numpy.float32)
+        self.assertEqual(vector.tolist(), [1, 2, 3])
+        self.assertFalse(vector.flags.writeable) # a view on the reply
+        keys, matrix = d.to_numpy()
+        self.assertEqual(matrix.shape, (2, 3))
+        self.assertEqual(dict(zip(keys, matrix.tolist())), {"a": [1, 2, 3], "b": [4, 5, 6]})
+
+    def test_packed_list(self):
+        l = structs.List(name="rows", codec=codec.NumpyArray("<i2", shape=(2, 2)))
+        l.from_numpy(numpy.arange(12).reshape(3, 2, 2))
+        self.assertEqual(len(l), 3)
+        self.assertEqual(l[1].tolist(), [[4, 5], [6, 7]])
+        matrix = l.to_numpy(dtype=float)
+        self.assertEqual((matrix.shape, matrix.dtype), ((3, 2, 2), numpy.float64))
+        self.assertEqual(matrix[2, 1, 1], 11)
+        self.redis.delete("rows")
+        self.assertEqual(l.to_numpy().shape, (0, 2, 2))
+
+
+class TestCounters(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.buffer = counters.CounterBuffer(interval=0)
+
+    def test_write_behind(self):
+        d = structs.Dict(name="hits", write_behind=self.buffer)
+        self.assertIsNone(d.incrby("a"))
+        d.incrby("a", 2)
+        d.incrby("b", 0.5)
+        d.incrby("b", 1)
+        self.assertFalse(self.redis.exists("hits"))
+        self.assertEqual(self.buffer.pending(), 2)
+        self.assertEqual(d.flush(), 2)
+        self.assertEqual(d.to_dict(), {"a": "3", "b": "1.5"})
+        self.assertEqual(d.flush(), 0)
+        self.assertRaises(TypeError, d.incrby, "a", "1")
+
+    def test_shared_buffer(self):
+        a = structs.Dict(name="a", write_behind=self.buffer)
+        b = structs.Dict(name="b", write_behind=self.buffer)
+        a.incrby("x")
+        b.incrby("x", 5)
+        self.assertEqual(a.flush(), 2)
+        self.assertEqual((self.redis.hget("a", "x"), self.redis.hget("b", "x")), ("1", "5"))
+        self.assertIs(structs.Dict(write_behind=True).counters, counters.get_buffer())
+        self.assertIsNone(structs.Dict().counters)
+
+    def test_same_name_other_db(self):
+        other = redis.Redis(db=1)
+        other.flushdb()
+        here = structs.Dict(name="hits", write_behind=self.buffer)
+        there = structs.Dict(name="hits", connection=other, write_behind=self.buffer)
+        here.incrby("a")
+        there.incrby("a", 5)
+        self.assertEqual(self.buffer.pending(), 2)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual((self.redis.hget("hits", "a"), other.hget("hits", "a")), ("1", "5"))
+        other.flushdb()
+
+    def test_thresholds(self):
+        buffer = counters.CounterBuffer(max_pending=3, interval=0.05)
+        d = structs.Dict(name="hits", write_behind=buffer)
+        d.incrby("a")
+        d.incrby("b")
+        self.assertFalse(self.redis.exists("hits"))
+        d.incrby("c")
+        self.assertEqual(self.redis.hlen("hits"), 3) # full
+        d.incrby("a")
+        time.sleep(0.3)
+        self.assertEqual(self.redis.hget("hits", "a"), "2") # interval
+        self.assertEqual(buffer.pending(), 0)
+
+    def test_threads(self):
+        d = structs.Dict(name="hits", write_behind=self.buffer)
+        def run():
+            for i in range(1000):
+                d.incrby("a")
+                d.incrby("f%d" % (i % 10))
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        d.flush()
+        self.assertEqual(d["a"], "4000")
+        self.assertEqual(sum(int(d["f%d" % i]) for i in range(10)), 4000)
+
+    def test_not_a_number(self):
+        d = structs.Dict(name="hits", write_behind=self.buffer)
+        d["a"] = "x"
+        d.incrby("a")
+        d.incrby("b")
+        self.assertRaises(TypeError, d.flush)
+        self.assertEqual(self.redis.hgetall("hits"), {"a": "x", "b": "1"})
+        self.assertEqual(self.buffer.dropped, 1)
+
+    def test_connection_error(self):
+        down = structs.Dict(name="hits", connection=redis.Redis(port=1), write_behind=self.buffer)
+        up = structs.Dict(name="other", write_behind=self.buffer)
+        down.incrby("a")
+        up.incrby("a")
+        self.assertRaises(redis.exceptions.ConnectionError, self.buffer.flush)
+        self.assertEqual(self.redis.hget("other", "a"), "1")
+        self.assertEqual(self.buffer.pending(), 1) # still pending
+        down.incrby("a")
+        self.assertEqual(self.buffer._pending[(id(down.connection), "hits", "a")], 2)
+        self.buffer._take() # nothing left for the exit flush
+
+    def test_ttl(self):
+        d = structs.Dict(name="hits", ttl=100, write_behind=self.buffer)
+        d.incrby("a")
+        d.flush()
+        self.assertTrue(0 < self.redis.ttl("hits") <= 100)
+
+    def test_exit(self):
+        code = "import structs; structs.Dict(name='hits', write_behind=True).incrby('a', 7)"
+        subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(self.redis.hget("hits", "a"), "7")
+
+
+class TestBufferedDict(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+
+    def test_coalesce(self):
+        self.redis.hmset("d", {"old": "1", "kept": "2"})
+        d = buffered.BufferedDict(name="d")
+        for i in range(10):
+            d["a"] = i
+        d[1] = "one"
+        d["1"] = "uno"
+        del d["old"]
+        d.update({"b": "x"}, c="y")
+        self.assertEqual(d.pending(), 5)
+        self.assertEqual(self.redis.hgetall("d"), {"old": "1", "kept": "2"})
+        self.assertEqual(d.flush(), 5)
+        self.assertEqual(self.redis.hgetall("d"), {"a": "9", "1": "uno", "kept": "2", "b": "x", "c": "y"})
+        self.assertEqual(d.pending(), 0)
+
+    def test_reads_see_pending(self):
+        self.redis.hmset("d", {"a": "1", "b": "2"})
+        d = buffered.BufferedDict(name="d")
+        d["a"] = "new"
+        del d["b"]
+        d["c"] = "3"
+        self.assertEqual(d["a"], "new")
+        self.assertRaises(KeyError, d.__getitem__, "b")
+        self.assertEqual(d.get("b", "default"), "default")
+        self.assertTrue("c" in d)
+        self.assertFalse("b" in d)
+        self.assertEqual(d.setdefault("c", "x"), "3")
+        self.assertEqual(d.setdefault("b", "x"), "x")
+        self.assertEqual(d.pop("c"), "3")
+        self.assertRaises(KeyError, d.pop, "c")
+        self.assertEqual(self.redis.hgetall("d"), {"a": "1", "b": "2"})
+        self.assertEqual(d.to_dict(), {"a": "new", "b": "x"}) # flushed
+        self.assertEqual(self.redis.hgetall("d"), {"a": "new", "b": "x"})
+
+    def test_pending_none(self):
+        self.redis.hset("d", "a", "old")
+        d = buffered.BufferedDict(name="d", codec=codec.Codec()) # encodes None as None
+        d["a"] = None
+        self.assertEqual(d["a"], None)
+        self.assertEqual(d.get("a", "default"), None)
+        self.assertTrue("a" in d)
+        self.assertEqual(d.setdefault("a", "x"), None)
+        self.assertEqual(d.pop("a"), None)
+        self.assertFalse("a" in d)
+
+    def test_thresholds(self):
+        d = buffered.BufferedDict(name="d", max_pending=3, interval=0)
+        d["a"] = 1
+        d["b"] = 2
+        self.assertFalse(self.redis.exists("d"))
+        d["c"] = 3
+        self.assertEqual(self.redis.hlen("d"), 3)
+        d = buffered.BufferedDict(name="e", interval=0.05)
+        d["a"] = 1
+        time.sleep(0.1)
+        self.assertFalse(self.redis.exists("e"))
+        d["b"] = 2
+        self.assertEqual(self.redis.hlen("e"), 2)
+
+    def test_context_manager(self):
+        with buffered.BufferedDict(name="d", codec=codec.INTEGER) as d:
+            d["a"] = 1
+            d["b"] = 2
+            self.assertFalse(self.redis.exists("d"))
+        self.assertEqual(self.redis.hgetall("d"), {"a": "1", "b": "2"})
+        try:
+            with d:
+                d["a"] = 5
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(d["a"], 1)
+
+    def test_increments_and_clear(self):
+        d = buffered.BufferedDict(name="d")
+        d["a"] = 1
+        d["b"] = 2
+        self.assertEqual(d.incrby("a", 2), 3)
+        self.assertEqual(self.redis.hget("d", "b"), "2")
+        d["c"] = 3
+        d.clear()
+        self.assertEqual(d.pending(), 0)
+        self.assertFalse(self.redis.exists("d"))
+        self.assertEqual(len(d), 0)
+
+    def test_ttl(self):
+        d = buffered.BufferedDict(name="d", ttl=100)
+        d["a"] = 1
+        d.flush()
+        self.assertTrue(0 < self.redis.ttl("d") <= 100)
+
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        f = gzip.open(path, "wb") if name.endswith(".gz") else open(path, "wb")
+        f.write("".join(line + "\n" for line in lines))
+        f.close()
+        return path
+
+    def test_dict_csv(self):
+        path = self.write("prices.csv", ["sku,name,price"] + ["s%d,item %d,%d" % (i, i, i * 10) for i in range(1000)])
+        d = structs.Dict({"old": 1}, name="prices", codec=codec.INTEGER)
+        result = loader.load(d, path, key="sku", value="price", header=True, chunk_size=100, processes=2)
+        self.assertEqual((result["rows"], result["chunks"]), (1000, 10))
+        self.assertTrue(result["rows_per_second"] > 0)
+        self.assertEqual(len(d), 1000)
+        self.assertEqual(d["s42"], 420)
+        self.assertFalse("old" in d)
+        self.assertEqual(self.redis.keys("prices:loading:*"), [])
+        self.assertIsNone(self.redis.ttl("prices")) # not the staging TTL
+
+    def test_list_order(self):
+        path = self.write("events.jsonl.gz", [json.dumps({"id": i, "type": "click"}) for i in range(1000)] + [""])
+        l = structs.List(name="events", codec=codec.JSON)
+        loader.load(l, path, value=loader.ROW, chunk_size=64, processes=3)
+        self.assertEqual(len(l), 1000)
+        self.assertEqual([event["id"] for event in l[:]], range(1000))
+
+    def test_set(self):
+        path = self.write("ids.csv", [str(i % 100) for i in range(1000)])
+        s = structs.Set(["x"], name="ids")
+        (s & structs.Set(["x"], name="other")).memoize()
+        version = self.redis.hget(structs.VERSIONS, "ids")
+        loader.load(s, path, processes=1)
+        self.assertEqual(s.members(), set(str(i) for i in range(100)))
+        self.assertNotEqual(self.redis.hget(structs.VERSIONS, "ids"), version)
+
+    def test_ttl_and_empty(self):
+        d = structs.Dict(name="d", ttl=100)
+        loader.load(d, self.write("one.csv", ["a,1"]), processes=1)
+        self.assertTrue(0 < self.redis.ttl("d") <= 100)
+        result = loader.load(d, self.write("empty.csv", []), processes=1)
+        self.assertEqual(result["rows"], 0)
+        self.assertFalse(self.redis.exists("d"))
+
+    def test_errors(self):
+        d = structs.Dict({"a": "1"}, name="d")
+        path = self.write("bad.csv", ["a,1"] * 10 + ["b"])
+        self.assertRaises(ValueError, loader.load, d, path, chunk_size=5, processes=2)
+        self.assertEqual(d.to_dict(), {"a": "1"})
+        self.assertEqual(self.redis.keys("d:loading:*"), [])
+        path = self.write("bad_first.csv", ["b"] + ["a,1"] * 5000) # later chunks still loading
+        self.assertRaises(ValueError, loader.load, d, path, chunk_size=500, processes=2)
+        self.assertEqual(self.redis.keys("d:loading:*"), [])
+        self.assertRaises(ValueError, loader.load, d, self.write("data.txt", ["a"]))
+        self.assertRaises(TypeError, loader.load, structs.SortedSet(), path)
+
+    def test_command_line(self):
+        path = self.write("data.jsonl", [json.dumps([i, i * i]) for i in range(10)])
+        output = subprocess.check_output([sys.executable, "loader.py", "--type", "dict", "--name", "squares",
+                                          "--processes", "2", path], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertTrue(output.startswith("10 rows in 1 chunks"))
+        self.assertEqual(self.redis.hget("squares", "9"), "81")
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = redis.Redis()
+        self.redis.flushdb()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        cases = [
+            (structs.Dict, dict(("k%d" % i, "v%d" % i) for i in range(2500)), lambda d: d.to_dict()),
+            (structs.Set, set("m%d" % i for i in range(2500)), lambda s: s.members()),
+            (structs.List, ["e%d" % (i % 7) for i in range(2500)], lambda l: l[:]),
+        ]
+        for portable in (False, True):
+            for structure_class, data, content in cases:
+                self.redis.flushdb()
+                original = structure_class(data, name="original")
+                size = original.snapshot(self.path, portable=portable)
+                self.assertEqual(size, os.path.getsize(self.path))
+                clone = structure_class(name="clone")
+                self.assertEqual(clone.restore(self.path), 1)
+                self.assertEqual(content(clone), content(original))
+                self.assertEqual(self.redis.keys("*:restoring:*"), [])
+
+    def test_sorted_set_and_strings(self):
+        z = structs.SortedSet(name="z")
+        z.update(dict(("m%d" % i, i / 3.0) for i in range(100)), inf=float("inf"))
+        h = structs.HyperLogLog(name="h")
+        h.add(*range(1000))
+        for portable in (False, True):
+            for structure, clone_class in ((z, structs.SortedSet), (h, structs.HyperLogLog)):
+                structure.snapshot(self.path, portable=portable)
+                clone = clone_class(name="clone")
+                clone.restore(self.path)
+                self.assertEqual(self.redis.dump("clone"), self.redis.dump(structure.pk))
+
+    def test_replace(self):
+        d = structs.Dict({"a": "1"}, name="d", ttl=100)
+        d.snapshot(self.path)
+        d.update({"b": "2"})
+        d.restore(self.path)
+        self.assertEqual(d.to_dict(), {"a": "1"})
+        self.assertTrue(0 < self.redis.ttl("d") <= 100)
+        structs.Dict(name="missing").snapshot(self.path)
+        d.restore(self.path)
+        self.assertFalse(self.redis.exists("d"))
+
+    def test_set_version(self):
+        s = structs.Set(["a"], name="s")
+        (s & structs.Set(["a"], name="t")).memoize()
+        version = self.redis.hget(structs.VERSIONS, "s")
+        s.snapshot(self.path)
+        s.restore(self.path)
+        self.assertNotEqual(self.redis.hget(structs.VERSIONS, "s"), version)
+
+    def test_several_keys(self):
+        f = probabilistic.ScalableBloomFilter(name="f", capacity=100)
+        elements = [str(i) for i in range(500)]
+        f.add_many(elements)
+        f.snapshot(self.path)
+        self.redis.flushdb()
+        clone = probabilistic.ScalableBloomFilter(name="g", capacity=100)
+        self.assertTrue(clone.restore(self.path) > 2)
+        self.assertEqual(len(clone), 500)
+        self.assertTrue(all(clone.contains_many(elements)))
+
+    def test_errors(self):
+        with open(self.path, "wb") as f:
+            f.write("something else")
+        d = structs.Dict({"a": "1"}, name="d")
+        self.assertRaises(ValueError, d.restore, self.path)
+        d.snapshot(self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 5)
+        self.assertRaises(ValueError, d.restore, self.path)
+        self.assertEqual(d.to_dict(), {"a": "1"})
+        self.assertRaises(TypeError, sharded.ShardedDict(name="s").snapshot, self.path)
+        self.assertRaises(TypeError, bucketed.BucketedDict(name="b", buckets=1).snapshot, self.path)
+
+    def test_other_class(self):
+        d = structs.Dict({"a": "1"}, name="d")
+        d.snapshot(self.path)
+        l = structs.List(["x"], name="l")
+        self.assertRaises(TypeError, l.restore, self.path)
+        self.assertEqual(l[:], ["x"])
+        self.assertEqual(self.redis.keys("*:restoring:*"), [])
+
+    def test_swap_in_one_transaction(self):
+        f = probabilistic.ScalableBloomFilter(name="f", capacity=100)
+        f.add_many([str(i) for i in range(500)])
+        f.snapshot(self.path)
+        keys = sorted(self.redis.keys("f*"))
+        payload = self.redis.dump(f._keys()[-1])
+        with open(self.path, "r+b") as snapshot:
+            snapshot.seek(snapshot.read().index(payload) + 2) # in the payload of the last key
+            snapshot.write("\xff")
+        clone = probabilistic.ScalableBloomFilter(name="f", capacity=100)
+        clone.clear()
+        self.assertRaises(redis.exceptions.ResponseError, clone.restore, self.path)
+        self.assertEqual(self.redis.keys("f*"), []) # no key replaced
+        self.assertEqual(self.redis.keys("*:restoring:*"), [])
+        f.add_many([str(i) for i in range(500)])
+        f.snapshot(self.path)
+        clone.clear()
+        self.assertEqual(clone.restore(self.path), len(keys))
+        self.assertEqual(sorted(self.redis.keys("f*")), keys)
+
+    def test_payload_from_another_version(self):
+        d = structs.Dict({"a": "1"}, name="d")
+        d.snapshot(self.path)
+        with open(self.path, "r+b") as f:
+            data = f.read()
+            f.seek(data.index("D", data.index("K")) + 6) # in the payload
+            f.write("\xff")
+        self.assertRaises(redis.exceptions.ResponseError, d.restore, self.path)
+        self.assertEqual(d.to_dict(), {"a": "1"})
+        self.assertEqual(self.redis.keys("*:restoring:*"), [])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file